@@ -0,0 +1,200 @@
+import math
+
+import numpy as np
+
+# Score spaces: raw probability (the original scale), its logarithm, and the log-likelihood
+# per symbol, which lets trips of different lengths be compared
+PROBABILITY = "probability"
+LOG = "log"
+LOG_PER_SYMBOL = "log_per_symbol"
+SCORE_SPACES = (PROBABILITY, LOG, LOG_PER_SYMBOL)
+
+# Trip encodings: string_create's letter groups, or one token per field value (trip_tokens). Both
+# are plain strings to the trees and to TripBatch; defined here so main.py can offer them without pandas
+LETTERS = "letters"
+TOKENS = "tokens"
+TRIP_ENCODINGS = (LETTERS, TOKENS)
+
+INITIAL_PROBABILITY = 10000.0  # Starting value of every walk, as in calculate_sequence_probability
+INITIAL_LOG = math.log(INITIAL_PROBABILITY)
+
+
+def log_weight(weight):
+    return math.log(weight) if weight > 0 else -math.inf
+
+
+class TripBatch:
+    """Trip strings encoded once as a (trips x longest trip) array of code points, zero padded."""
+
+    def __init__(self, codes, lengths):
+        self.codes = codes
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, rows):
+        lengths = self.lengths[rows]
+        width = int(lengths.max(initial=0))
+        return TripBatch(self.codes[rows, :width], lengths)
+
+    @classmethod
+    def from_strings(cls, trips):
+        encoded = np.asarray(list(trips), dtype=str)
+        if encoded.size == 0:
+            return cls(np.zeros((0, 0), dtype=np.uint32), np.zeros(0, dtype=np.int64))
+        width = encoded.dtype.itemsize // 4
+        codes = encoded.view(np.uint32).reshape(len(encoded), width)
+        return cls(codes, np.char.str_len(encoded).astype(np.int64))
+
+
+def as_trip_batch(trips):
+    """Accepts a TripBatch or any sequence/array of trip strings."""
+    if isinstance(trips, TripBatch):
+        return trips
+    return TripBatch.from_strings(trips)
+
+
+def prefers_walk(trips, node_count):
+    """True when walking the tree trip by trip is cheaper than building its transition table.
+
+    Building the table is linear in the size of the tree and the walk in the number of symbols, so
+    a few short trips against a changed tree (the online case) are scored without a table.
+    """
+    return not isinstance(trips, TripBatch) and sum(map(len, trips)) < node_count
+
+
+def walk_trips(tree, trips, space=PROBABILITY):
+    """Scores trips one by one with the tree's own walk; same values as its transition table."""
+    if space == PROBABILITY:
+        return np.array([tree.calculate_sequence_probability(s) for s in trips], dtype=np.float64)
+    per_symbol = space == LOG_PER_SYMBOL
+    return np.array([tree.calculate_sequence_log_probability(s, per_symbol) for s in trips], dtype=np.float64)
+
+
+class TransitionTable:
+    """Scoring walk of a LempelZivTree flattened into a state-transition table.
+
+    State 0 is the root. Column j of next_state/factor is the symbol alphabet[j];
+    the two extra columns handle symbols the tree has never seen and the padding
+    after the end of a shorter trip. Scoring a step multiplies the running
+    probability by factor[state, column] and moves to next_state[state, column],
+    which reproduces calculate_sequence_probability for every trip at once.
+    """
+
+    def __init__(self, alphabet, next_state, factor, log_factor):
+        self.alphabet = alphabet  # Sorted code points
+        self.next_state = next_state
+        self.factor = factor
+        self.log_factor = log_factor  # Log of factor, taken from the trees' stored log-weights
+
+    @property
+    def unknown_column(self):
+        return len(self.alphabet)
+
+    @property
+    def padding_column(self):
+        return len(self.alphabet) + 1
+
+    @classmethod
+    def from_rows(cls, alphabet, next_state, factor, log_factor):
+        """Builds the table from per-symbol rows (one row per state, one column per alphabet symbol)."""
+        n_states, width = next_state.shape
+        table_next = np.empty((n_states, width + 2), dtype=np.int32)
+        table_factor = np.empty((n_states, width + 2), dtype=np.float64)
+        table_log_factor = np.empty((n_states, width + 2), dtype=np.float64)
+        table_next[:, :width] = next_state
+        table_factor[:, :width] = factor
+        table_log_factor[:, :width] = log_factor
+        # Unknown symbols restart from the root without changing the probability
+        table_next[:, width] = 0
+        # Padding keeps the state and the probability as they are
+        table_next[:, width + 1] = np.arange(n_states)
+        table_factor[:, width:] = 1.0
+        table_log_factor[:, width:] = 0.0
+        return cls(np.asarray(alphabet, dtype=np.uint32), table_next, table_factor, table_log_factor)
+
+    @classmethod
+    def stack(cls, tables):
+        """Places several tables side by side over a shared alphabet.
+
+        Returns the combined table and the root state of each input table, for score_many.
+        """
+        alphabet = np.unique(np.concatenate([table.alphabet for table in tables] + [np.zeros(0, np.uint32)]))
+        roots = np.zeros(len(tables), dtype=np.int64)
+        next_parts, factor_parts, log_factor_parts = [], [], []
+        offset = 0
+        for i, table in enumerate(tables):
+            # Column of each shared symbol in this table (unknown if the tree never saw it)
+            mapping = np.full(len(alphabet) + 2, table.unknown_column, dtype=np.intp)
+            if len(table.alphabet):
+                positions = np.minimum(np.searchsorted(table.alphabet, alphabet), len(table.alphabet) - 1)
+                found = table.alphabet[positions] == alphabet
+                mapping[:len(alphabet)][found] = positions[found]
+            mapping[-1] = table.padding_column
+            roots[i] = offset
+            next_parts.append(table.next_state[:, mapping].astype(np.int64) + offset)
+            factor_parts.append(table.factor[:, mapping])
+            log_factor_parts.append(table.log_factor[:, mapping])
+            offset += len(table.next_state)
+        width = len(alphabet) + 2
+        next_state = np.concatenate(next_parts) if next_parts else np.zeros((0, width), dtype=np.int64)
+        factor = np.concatenate(factor_parts) if factor_parts else np.zeros((0, width))
+        log_factor = np.concatenate(log_factor_parts) if log_factor_parts else np.zeros((0, width))
+        return cls(alphabet.astype(np.uint32), next_state, factor, log_factor), roots
+
+    def columns(self, batch):
+        """Maps an encoded batch to table columns."""
+        codes = batch.codes
+        size = int(max(codes.max(initial=0), self.alphabet.max(initial=0))) + 1
+        if size <= 1 << 16:
+            # Small code points (the usual case): direct lookup table
+            lookup = np.full(size, self.unknown_column, dtype=np.intp)
+            lookup[self.alphabet] = np.arange(len(self.alphabet))
+            columns = lookup[codes]
+        else:
+            columns = np.searchsorted(self.alphabet, codes)
+            np.minimum(columns, len(self.alphabet) - 1, out=columns)
+            columns[self.alphabet[columns] != codes] = self.unknown_column
+        columns[np.arange(codes.shape[1]) >= batch.lengths[:, None]] = self.padding_column
+        return columns
+
+    def score(self, trips, space=PROBABILITY):
+        """Walks every trip of the batch through the table together, one symbol position per step."""
+        batch = as_trip_batch(trips)
+        return self._walk(batch, np.zeros((len(batch), 1), dtype=np.int64), space)[:, 0]
+
+    def score_many(self, trips, roots, space=PROBABILITY):
+        """Scores every trip from every root state of a stacked table; returns a (trips x roots) array."""
+        batch = as_trip_batch(trips)
+        return self._walk(batch, np.tile(np.asarray(roots, dtype=np.int64), (len(batch), 1)), space)
+
+    def _walk(self, batch, states, space):
+        columns = self.columns(batch)
+        width = self.next_state.shape[1]
+        next_state = self.next_state.ravel()
+        if space == PROBABILITY:
+            factor = self.factor.ravel()
+            scores = np.full(states.shape, INITIAL_PROBABILITY)
+            for step in range(columns.shape[1]):
+                cells = states * width + columns[:, step, None]
+                scores *= factor[cells]
+                states = next_state[cells]
+            return scores
+
+        log_factor = self.log_factor.ravel()
+        scores = np.zeros(states.shape)
+        for step in range(columns.shape[1]):
+            cells = states * width + columns[:, step, None]
+            scores += log_factor[cells]
+            states = next_state[cells]
+        if space == LOG_PER_SYMBOL:
+            lengths = np.broadcast_to(batch.lengths[:, None], scores.shape)
+            return np.divide(scores, lengths, out=np.zeros(scores.shape), where=lengths > 0)
+        return INITIAL_LOG + scores
+
+
+def top_k(scores, k):
+    """Column indices of the k highest scores in each row, best first (ties keep column order)."""
+    k = min(k, scores.shape[1])
+    return np.argsort(-scores, axis=1, kind="stable")[:, :k]
@@ -0,0 +1,311 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from batch_scoring import PROBABILITY, SCORE_SPACES
+from create_file_process import (build_vehicle_index, calculate_probabilities, calibrate_outputs,
+                                 create_check_dataframe, create_output_dataframe, create_vehicle_profiles,
+                                 load_csv, process_dataframe)
+from report_writers import EXCEL_STREAM, REPORT_FORMATS, open_report_writer
+from trash_hold_calc import add_calibration_columns, process_excel_with_roc
+
+BASELINE_PATH = 'data/benchmark_baseline.json'
+STAGES = ("load_csv", "encode", "build_profiles", "score", "calibrate", "calibrate_vectorized", "report")
+
+# Modules `main.py score` must start without (see main.py); any of them in a cold start is a regression
+HEAVY_MODULES = ("pandas", "openpyxl", "matplotlib", "sklearn")
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+# Column order of Trips.csv
+CSV_COLUMNS = ['vehicle_id', 'drive_id', 'driver_id', 'start_drive', 'start_location', 'start_latitude',
+               'start_longitude', 'end_drive', 'end_location', 'end_latitude', 'end_longitude', 'drive_duration',
+               'idle_duration', 'mileage', 'avg_speed', 'turn1', 'turn2', 'turn3', 'break1', 'break2', 'break3',
+               'acceleration1', 'acceleration2', 'acceleration3', 'speed1', 'speed2', 'speed3', 'driver_grade',
+               'fuel_consumption', 'breaking_system', 'gearbox', 'engine', 'clutch_system', 'start_fuel_level',
+               'end_fuel_level', 'fuel_used', 'path']
+
+
+def generate_trips(n_rows: int, n_vehicles: int, seed: int = 0) -> pd.DataFrame:
+    """Synthetic trips shaped like Trips.csv (same columns and value formats), sorted by vehicle and time.
+
+    Every vehicle has a few home locations and its own daily rhythm, so the profiles tell vehicles
+    apart the way they do on real data; about 2% of the trips have missing coordinates.
+    """
+    rng = np.random.default_rng(seed)
+    vehicles = 100000 + rng.choice(900000, size=n_vehicles, replace=False)
+    vehicle = np.sort(rng.integers(0, n_vehicles, size=n_rows))
+
+    # Per-vehicle habits: 3 places around a city centre and a preferred start hour
+    places = np.array([25.4, -101.0]) + rng.normal(0, 0.15, size=(n_vehicles, 3, 2))
+    start_hour = rng.uniform(5, 20, size=n_vehicles)
+    place = rng.integers(0, 3, size=(n_rows, 2))
+    start = places[vehicle, place[:, 0]] + rng.normal(0, 0.002, size=(n_rows, 2))
+    end = places[vehicle, place[:, 1]] + rng.normal(0, 0.002, size=(n_rows, 2))
+    missing = rng.random(n_rows) < 0.02
+    start[missing] = np.nan
+
+    drive_duration = np.maximum(1, rng.lognormal(3.6, 0.8, size=n_rows)).astype(np.int64)
+    idle_duration = rng.poisson(12, size=n_rows)
+    mileage = np.round(drive_duration * rng.uniform(0.2, 0.6, size=n_rows), 2)
+    day = np.datetime64('2023-06-01T00:00') + rng.integers(0, 60, size=n_rows).astype('timedelta64[D]')
+    minutes = np.clip(rng.normal(start_hour[vehicle] * 60, 120), 0, 24 * 60 - 1).astype(np.int64)
+    start_time = pd.to_datetime(day + minutes.astype('timedelta64[m]'))
+    end_time = start_time + pd.to_timedelta(drive_duration + idle_duration, unit='m')
+
+    df = pd.DataFrame({column: 0 for column in CSV_COLUMNS}, index=range(n_rows))
+    df['vehicle_id'] = vehicles[vehicle]
+    df['drive_id'] = 77000000000 + np.arange(n_rows)
+    df['driver_id'] = np.where(rng.random(n_rows) < 0.3, np.nan, 370000 + vehicle)
+    df['start_drive'] = start_time.strftime('%d/%m/%Y %H:%M')
+    df['end_drive'] = end_time.strftime('%d/%m/%Y %H:%M')
+    df['start_location'] = 'Street ' + place[:, 0].astype(str) + ', Saltillo, Coah., Mexico'
+    df['end_location'] = 'Street ' + place[:, 1].astype(str) + ', Saltillo, Coah., Mexico'
+    df['start_latitude'], df['start_longitude'] = start[:, 0], start[:, 1]
+    df['end_latitude'], df['end_longitude'] = end[:, 0], end[:, 1]
+    df['drive_duration'] = drive_duration
+    df['idle_duration'] = idle_duration
+    df['mileage'] = mileage
+    df['avg_speed'] = np.nan
+    df['start_fuel_level'] = df['end_fuel_level'] = np.nan
+    df['fuel_used'] = np.round(mileage * 0.3, 3)
+    df['path'] = 'Synthetic_Trips.csv.gz'
+    return df.sort_values(['vehicle_id', 'drive_id'], kind='stable').reset_index(drop=True)
+
+
+class StageTimer:
+    """Collects the wall time of every stage and, with trace_memory, the peak memory it allocated."""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        yield
+        result = {"seconds": time.perf_counter() - started}
+        if self.trace_memory:
+            result["peak_mb"] = (tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20
+        self.results[name] = result
+
+
+def run_stages(timer: StageTimer, csv_path: str, output_dir: str, score_space: str = PROBABILITY,
+               report_format: str = EXCEL_STREAM, plot: bool = False):
+    """One run of the pipeline, stage by stage, as create_file runs it (console output is discarded)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        with timer.stage("load_csv"):
+            df = load_csv(csv_path)
+        with timer.stage("encode"):
+            df = process_dataframe(df)
+        with timer.stage("build_profiles"):
+            vehicle_profiles = create_vehicle_profiles(df, score_space)
+        with timer.stage("score"):
+            vehicle_index = build_vehicle_index(df)
+            outputs = {}
+            for vehicle_id in vehicle_index:
+                df_check = create_check_dataframe(df, vehicle_id, vehicle_index)
+                df_check = calculate_probabilities(df_check, vehicle_profiles, vehicle_id)
+                outputs[vehicle_id] = create_output_dataframe(df_check, vehicle_id)
+        with timer.stage("calibrate"):
+            for vehicle_id, df_output in outputs.items():
+                try:
+                    process_excel_with_roc(df_output.copy(), f'Belongs to Vehicle {vehicle_id}', vehicle_id=vehicle_id,
+                                           output_dir=output_dir, plot=plot)
+                except ValueError:
+                    pass
+        with timer.stage("calibrate_vectorized"):
+            calibration = calibrate_outputs(outputs)
+        with timer.stage("report"):
+            extension = '.xlsx' if report_format.startswith('excel') else ''
+            with open_report_writer(report_format, os.path.join(output_dir, f'report{extension}')) as writer:
+                for vehicle_id, df_output in outputs.items():
+                    result = calibration.loc[vehicle_id]
+                    if result['Error'] is None:
+                        writer.write_vehicle(vehicle_id, add_calibration_columns(df_output, result),
+                                             calibration=result)
+
+
+def run_benchmark(n_rows: int, n_vehicles: int, repeat: int = 3, memory: bool = True, seed: int = 0,
+                  **stage_options) -> dict:
+    """Times every stage on synthetic data of the given size.
+
+    Seconds are the best of repeat runs; peak memory (tracemalloc, MB above the stage's starting
+    point) comes from one extra traced run, so tracing does not slow down the timed ones.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'Trips.csv')
+        generate_trips(n_rows, n_vehicles, seed).to_csv(csv_path, index=False)
+        seconds = {stage: [] for stage in STAGES}
+        for _ in range(repeat):
+            timer = StageTimer()
+            run_stages(timer, csv_path, directory, **stage_options)
+            for stage, result in timer.results.items():
+                seconds[stage].append(result["seconds"])
+        stages = {stage: {"seconds": min(times)} for stage, times in seconds.items()}
+        if memory:
+            timer = StageTimer(trace_memory=True)
+            tracemalloc.start()
+            try:
+                run_stages(timer, csv_path, directory, **stage_options)
+            finally:
+                tracemalloc.stop()
+            for stage, result in timer.results.items():
+                stages[stage]["peak_mb"] = result["peak_mb"]
+    return {"rows": n_rows, "vehicles": n_vehicles, "stages": stages}
+
+
+def run_suite(row_counts, n_vehicles: int, **options) -> dict:
+    """Runs run_benchmark for every row count (a scaling curve) and records the environment."""
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "options": {key: value for key, value in options.items() if key != "memory"},
+        "runs": [run_benchmark(n_rows, n_vehicles, **options) for n_rows in row_counts],
+    }
+
+
+def measure_cold_start(store_path: str, vehicle_id: str, trips, repeat: int = 5) -> dict:
+    """Wall time of `main.py score` in a fresh interpreter (best of repeat) and the HEAVY_MODULES it imported.
+
+    The imports come from a separate run under -X importtime; interpreter_seconds is a bare
+    interpreter start, for reference.
+    """
+    command = [MAIN_PATH, "score", "--store", store_path, str(vehicle_id), *trips]
+
+    def best_time(arguments):
+        times = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, *arguments], check=True, capture_output=True)
+            times.append(time.perf_counter() - started)
+        return min(times)
+
+    traced = subprocess.run([sys.executable, "-X", "importtime", *command], check=True, capture_output=True, text=True)
+    imported = {line.rsplit("|", 1)[-1].strip() for line in traced.stderr.splitlines() if line.startswith("import time:")}
+    return {"seconds": best_time(command), "interpreter_seconds": best_time(["-c", "pass"]),
+            "heavy_modules": [module for module in HEAVY_MODULES if module in imported]}
+
+
+def run_cold_start(n_rows: int = 5000, n_vehicles: int = 20, repeat: int = 5, seed: int = 0) -> dict:
+    """measure_cold_start on a profile store built from synthetic trips, scoring three trips of one vehicle."""
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        df = process_dataframe(generate_trips(n_rows, n_vehicles, seed))
+        store_path = os.path.join(directory, 'profiles.vps')
+        create_vehicle_profiles(df).save(store_path)
+        vehicle_id = str(df['vehicle_id'].iloc[0])
+        trips = df.loc[df['vehicle_id'].astype(str) == vehicle_id, 'trip_description'].iloc[:3].tolist()
+        return measure_cold_start(store_path, vehicle_id, trips, repeat)
+
+
+def format_suite(results: dict) -> str:
+    """Scaling table: one line per stage, seconds (and peak MB) for every run size."""
+    runs = results["runs"]
+    header = f"{'stage':<22}" + "".join(f"{run['rows']:>10} rows/{run['vehicles']:<6}" for run in runs)
+    lines = [header]
+    for stage in STAGES:
+        cells = []
+        for run in runs:
+            result = run["stages"][stage]
+            memory = f" {result['peak_mb']:6.1f}MB" if "peak_mb" in result else ""
+            cells.append(f"{result['seconds']:8.3f}s{memory}".rjust(21))
+        lines.append(f"{stage:<22}" + "".join(cells))
+    if "cold_start" in results:
+        cold_start = results["cold_start"]
+        lines.append(f"{'cold_start (score)':<22}{cold_start['seconds']:8.3f}s (interpreter "
+                     f"{cold_start['interpreter_seconds']:.3f}s, heavy imports: "
+                     f"{', '.join(cold_start['heavy_modules']) or 'none'})")
+    return "\n".join(lines)
+
+
+def compare_results(current: dict, baseline: dict, tolerance: float = 0.25, min_seconds: float = 0.05):
+    """Compares stage times of runs with the same size; returns (report lines, regressed).
+
+    A stage has regressed when it takes more than (1 + tolerance) times its baseline time and at
+    least min_seconds longer, so timer noise on the very short stages is not reported.
+    """
+    baseline_runs = {(run["rows"], run["vehicles"]): run for run in baseline["runs"]}
+    lines, regressed = [], False
+    for run in current["runs"]:
+        reference = baseline_runs.get((run["rows"], run["vehicles"]))
+        if reference is None:
+            lines.append(f"{run['rows']} rows/{run['vehicles']} vehicles: no baseline")
+            continue
+        for stage in STAGES:
+            if stage not in reference["stages"]:
+                continue
+            before = reference["stages"][stage]["seconds"]
+            after = run["stages"][stage]["seconds"]
+            ratio = after / before if before > 0 else float("inf")
+            slower = ratio > 1 + tolerance and after - before >= min_seconds
+            verdict = "REGRESSION" if slower else "faster" if ratio < 1 - tolerance else ""
+            regressed |= verdict == "REGRESSION"
+            lines.append(f"{run['rows']:>8} rows {stage:<22}{before:9.3f}s -> {after:9.3f}s  x{ratio:5.2f}  {verdict}")
+    if "cold_start" in current:
+        cold_start = current["cold_start"]
+        if cold_start["heavy_modules"]:
+            regressed = True
+            lines.append(f"cold_start imports {', '.join(cold_start['heavy_modules'])}  REGRESSION")
+        if "cold_start" in baseline:
+            before, after = baseline["cold_start"]["seconds"], cold_start["seconds"]
+            slower = after > before * (1 + tolerance) and after - before >= min_seconds
+            regressed |= slower
+            lines.append(f"{'cold_start':<28}{before:9.3f}s -> {after:9.3f}s  x{after / before:5.2f}  "
+                         f"{'REGRESSION' if slower else ''}")
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the encode -> build -> score -> calibrate -> report pipeline")
+    parser.add_argument("--rows", type=int, nargs="+", default=[5000, 20000, 80000], help="row counts (scaling curve)")
+    parser.add_argument("--vehicles", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--score-space", choices=SCORE_SPACES, default=PROBABILITY)
+    parser.add_argument("--report-format", choices=REPORT_FORMATS, default=EXCEL_STREAM)
+    parser.add_argument("--plot", action="store_true", help="render ROC figures in the calibrate stage")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run for peak memory")
+    parser.add_argument("--save", metavar="PATH", help=f"write the results as JSON (e.g. {BASELINE_PATH})")
+    parser.add_argument("--compare", metavar="PATH", help="compare with a saved baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--cold-start", action="store_true",
+                        help="also time `main.py score` in a fresh interpreter and check its imports")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.rows, args.vehicles, repeat=args.repeat, memory=not args.no_memory, seed=args.seed,
+                        score_space=args.score_space, report_format=args.report_format, plot=args.plot)
+    if args.cold_start:
+        results["cold_start"] = run_cold_start(n_vehicles=args.vehicles, seed=args.seed)
+    print(format_suite(results))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            lines, regressed = compare_results(results, json.load(f), args.tolerance)
+        print("\n".join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,38 @@
+import numpy as np
 import pandas as pd
 from vehicle_profiles import VehicleProfiles
-from string_create import process_row
-from trash_hold_calc import process_excel_with_roc
-from openpyxl.drawing.image import Image
+from lempel_ziv78 import LempelZivTree
+from lempel_ziv78_compact import CompactLempelZivTree
+from batch_scoring import LETTERS, PROBABILITY, TOKENS, TRIP_ENCODINGS
+from string_create import encode_trips
+from trip_tokens import TokenVocabulary, encode_trip_tokens
+from trash_hold_calc import (CALIBRATION_COLUMNS, add_calibration_columns, apply_calibration, calibrate_thresholds,
+                             process_excel_with_roc)
+from report_writers import EXCEL, open_report_writer, write_vehicle_sheet
+from metrics import metrics
+from trip_checks import check_trip_and_add_to_tree, check_trips, check_trips_from_store
+import hashlib
+import heapq
+import multiprocessing
 import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Columns the trip encoding reads (see string_create.process_row). Only the timestamps get a fixed
+# type; the numeric columns are inferred as load_csv infers them, so a value the encoder treats as
+# invalid (e.g. 'N/A' -> "n") makes its chunk an object column instead of stopping the parser.
+TRIP_COLUMNS = ['vehicle_id', 'start_drive', 'start_latitude', 'start_longitude', 'end_drive',
+                'end_latitude', 'end_longitude', 'drive_duration', 'idle_duration', 'mileage']
+TRIP_DTYPES = {
+    'start_drive': str,
+    'end_drive': str,
+}
+CSV_CHUNK_SIZE = 50000
+# A cached calibration is redone once the pool of other vehicles' trips its negative sample is drawn
+# from has grown or shrunk by more than this fraction
+STALE_SAMPLE_FRACTION = 0.1
 
 
 def load_csv(csv_file_path: str) -> pd.DataFrame:
@@ -11,40 +40,192 @@ def load_csv(csv_file_path: str) -> pd.DataFrame:
     return pd.read_csv(csv_file_path, low_memory=False)
 
 
-def process_dataframe(df: pd.DataFrame) -> pd.DataFrame:
-    """Processes the DataFrame by creating a trip description column."""
+def iter_trip_chunks(csv_file_path: str, chunk_size: int = CSV_CHUNK_SIZE, vocabulary: TokenVocabulary = None):
+    """Yields the CSV in chunks of chunk_size rows, each with its trip description column.
+
+    Only TRIP_COLUMNS are read (types as in TRIP_DTYPES), so the wide columns the model never uses
+    (locations, path, driving events, fuel) are skipped by the parser.
+    """
+    with pd.read_csv(csv_file_path, usecols=TRIP_COLUMNS, dtype=TRIP_DTYPES, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            yield process_dataframe(chunk, vocabulary)
+
+
+def process_dataframe(df: pd.DataFrame, vocabulary: TokenVocabulary = None) -> pd.DataFrame:
+    """Processes the DataFrame by creating a trip description column.
+
+    With a vocabulary the trip descriptions are token strings (see trip_tokens), one character per
+    field, and a trip_text column holds their readable form for the report.
+    """
     if 'trip_description' not in df.columns:
-        df['trip_description'] = df.apply(process_row, axis=1)
+        if vocabulary is None:
+            df['trip_description'] = encode_trips(df)
+        else:
+            trips = encode_trip_tokens(df, vocabulary).strings()
+            codes, uniques = pd.factorize(trips)
+            texts = np.array([vocabulary.to_text(trip) for trip in uniques], dtype=object)
+            df['trip_description'] = trips
+            df['trip_text'] = texts[codes] if len(df) else trips
     return df
 
 
-def create_vehicle_profiles(df: pd.DataFrame) -> VehicleProfiles:
-    """Creates vehicle profiles based on trip descriptions."""
-    vehicle_profiles = VehicleProfiles()
+def create_vehicle_profiles(df: pd.DataFrame, score_space: str = PROBABILITY,
+                            keep_history: bool = True, workers: int = 1, node_budget: int = None,
+                            vocabulary: TokenVocabulary = None) -> VehicleProfiles:
+    """Creates vehicle profiles based on trip descriptions.
+
+    workers > 1 builds the trees in that many processes (see build_profiles_parallel); the profiles
+    then hold CompactLempelZivTree trees, identical to a serial build with that tree class.
+    node_budget caps the phrase nodes of every tree (see LempelZivTree.prune); compact trees cannot be
+    pruned, so a budgeted build is always serial.
+    vocabulary is the TokenVocabulary of token trip descriptions; every tree is offered all of it
+    (add_options). Such trees are CompactLempelZivTree, which keeps the option leaves implicit;
+    a LempelZivTree (only with a node_budget) holds one node per token under every phrase node.
+    """
     vehicle_trips = df.groupby('vehicle_id')['trip_description'].apply(''.join).to_dict()
+    if workers > 1 and node_budget is None:
+        return build_profiles_parallel(vehicle_trips, workers, score_space, keep_history, vocabulary=vocabulary)
 
+    tree_class = CompactLempelZivTree if vocabulary is not None and node_budget is None else LempelZivTree
+    vehicle_profiles = VehicleProfiles(tree_class, score_space, keep_history=keep_history, node_budget=node_budget,
+                                       vocabulary=vocabulary)
     for vehicle_id, trip_string in vehicle_trips.items():
         vehicle_profiles.add_trip(vehicle_id, trip_string)
 
     return vehicle_profiles
 
 
+# Per-process state of the profile-building workers, set once by _init_build_worker
+_build_state = {}
+
+
+def _init_build_worker(vehicle_trips: dict, options: frozenset):
+    _build_state['vehicle_trips'] = vehicle_trips
+    _build_state['options'] = options
+
+
+def _build_partition_task(vehicle_ids):
+    """Builds the trees of a partition of vehicles and returns them pickled in compact array form."""
+    started = time.perf_counter()
+    trees = []
+    for vehicle_id in vehicle_ids:
+        tree = CompactLempelZivTree()
+        if _build_state['options']:
+            tree.add_options(_build_state['options'])  # As VehicleProfiles.add_trip offers the vocabulary
+        tree.build_tree(_build_state['vehicle_trips'][vehicle_id])
+        tree.calculate_weights()
+        trees.append((vehicle_id, *tree.to_arrays()))
+    build_seconds = time.perf_counter() - started
+    # Pickled here so the parent can measure exactly what crosses the process boundary
+    return pickle.dumps(trees, protocol=pickle.HIGHEST_PROTOCOL), build_seconds
+
+
+def partition_vehicles(vehicle_trips: dict, n_partitions: int):
+    """Splits the vehicles into n_partitions lists of about equal total trip length (longest first, greedy)."""
+    partitions = [[] for _ in range(n_partitions)]
+    loads = [(0, i) for i in range(n_partitions)]
+    heapq.heapify(loads)
+    for vehicle_id in sorted(vehicle_trips, key=lambda v: len(vehicle_trips[v]), reverse=True):
+        load, i = heapq.heappop(loads)
+        partitions[i].append(vehicle_id)
+        heapq.heappush(loads, (load + len(vehicle_trips[vehicle_id]), i))
+    return [partition for partition in partitions if partition]
+
+
+def build_profiles_parallel(vehicle_trips: dict, workers: int, score_space: str = PROBABILITY,
+                            keep_history: bool = True, partitions_per_worker: int = 4,
+                            vocabulary: TokenVocabulary = None) -> VehicleProfiles:
+    """Builds the profiles of {vehicle_id: trip string} in a process pool.
+
+    Vehicles are independent, so each worker builds whole partitions of them (balanced by trip
+    length) and sends the trees back as their trimmed CompactLempelZivTree arrays. The trip strings
+    (and the vocabulary's tokens, offered to every tree) reach the workers once, at start-up (shared
+    copy-on-write with the fork start method). Build, transfer (pickled bytes) and assembly costs are
+    recorded in metrics.
+    """
+    vehicle_profiles = VehicleProfiles(CompactLempelZivTree, score_space, keep_history=keep_history,
+                                       vocabulary=vocabulary)
+    options = vocabulary.alphabet() if vocabulary is not None else frozenset()
+    partitions = partition_vehicles(vehicle_trips, workers * partitions_per_worker)
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    trees = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_build_worker,
+                             initargs=(vehicle_trips, options)) as executor:
+        for payload, build_seconds in executor.map(_build_partition_task, partitions):
+            started = time.perf_counter()
+            for vehicle_id, arrays, state in pickle.loads(payload):
+                trees[vehicle_id] = CompactLempelZivTree.from_arrays(arrays, state)
+            metrics.add_time("profile_build_worker", build_seconds)
+            metrics.add_time("profile_transfer_decode", time.perf_counter() - started)
+            metrics.increment("profile_transfer_bytes", len(payload))
+
+    # Same vehicle order as the serial build
+    for vehicle_id, trip_string in vehicle_trips.items():
+        # Version 1, like a serial build that adds each vehicle's trips in one add_trip
+        profile = {"tree": trees[vehicle_id], "threshold": vehicle_profiles.default_threshold(), "version": 1}
+        if keep_history:
+            profile["trip_string"] = trip_string
+        vehicle_profiles.profiles[str(vehicle_id)] = profile
+    return vehicle_profiles
+
+
+def create_vehicle_profiles_from_chunks(chunks, score_space: str = PROBABILITY, keep_history: bool = True,
+                                        vocabulary: TokenVocabulary = None) -> VehicleProfiles:
+    """Builds the same profiles as create_vehicle_profiles from processed chunks of the trips.
+
+    Each chunk adds one string per vehicle; the trees continue their parse across chunks, so the
+    result does not depend on where the chunks are cut.
+    """
+    tree_class = LempelZivTree if vocabulary is None else CompactLempelZivTree  # As create_vehicle_profiles
+    vehicle_profiles = VehicleProfiles(tree_class, score_space, keep_history=keep_history, vocabulary=vocabulary)
+    vehicle_ids = set()
+    for chunk in chunks:
+        for vehicle_id, trips in chunk.groupby('vehicle_id', sort=False)['trip_description']:
+            vehicle_profiles.add_trip(vehicle_id, ''.join(trips))
+            vehicle_ids.add(vehicle_id)
+    if vocabulary is not None:
+        # Cells first seen in later chunks are offered to the trees built before them
+        vehicle_profiles.refresh_options()
+
+    # Same vehicle order as create_vehicle_profiles, where groupby sorts the ids. The type of the ids
+    # is inferred per chunk, so numeric ids come first should some chunk have read them as text
+    vehicle_profiles.profiles = {str(v): vehicle_profiles.profiles[str(v)]
+                                 for v in sorted(vehicle_ids, key=lambda v: (isinstance(v, str), v))}
+    return vehicle_profiles
+
+
 def calculate_probabilities(df: pd.DataFrame, vehicle_profiles: VehicleProfiles,
                             vehicle_id_to_check: str) -> pd.DataFrame:
     """Calculates the probability for a specific vehicle across the DataFrame."""
-    df['probability'] = df['trip_description'].apply(
-        lambda trip_desc: vehicle_profiles.calculate_probability_for_vehicle(vehicle_id_to_check, trip_desc)
+    df['probability'] = vehicle_profiles.calculate_probabilities_for_vehicle(
+        vehicle_id_to_check, df['trip_description'].to_numpy()
     )
 
     df['Belongs_to_vehicle'] = df['vehicle_id'].astype(str) == vehicle_id_to_check
     return df
 
 
+def calculate_probability_matrix(df: pd.DataFrame, vehicle_profiles: VehicleProfiles,
+                                 chunk_size: int = 1024) -> pd.DataFrame:
+    """Scores every trip in the DataFrame against every vehicle profile (rows: trips, columns: vehicles)."""
+    scores, vehicle_ids = vehicle_profiles.score_matrix(df['trip_description'].to_numpy(), chunk_size=chunk_size)
+    return pd.DataFrame(scores, index=df.index, columns=vehicle_ids)
+
+
+def calculate_probabilities_from_matrix(df: pd.DataFrame, scores: pd.DataFrame,
+                                        vehicle_id_to_check: str) -> pd.DataFrame:
+    """Same columns as calculate_probabilities, taken from a precomputed probability matrix."""
+    df['probability'] = scores.loc[df.index, vehicle_id_to_check].to_numpy()
+    df['Belongs_to_vehicle'] = df['vehicle_id'].astype(str) == vehicle_id_to_check
+    return df
+
+
 def create_output_dataframe(df: pd.DataFrame, vehicle_id_to_check: str) -> pd.DataFrame:
     """Creates the output DataFrame for saving to Excel."""
     return pd.DataFrame({
         'Index': range(1, len(df) + 1),
-        'Trip String': df['trip_description'].values,
+        'Trip String': df['trip_text' if 'trip_text' in df.columns else 'trip_description'].values,
         'Probability': df['probability'].values,
         f'Belongs to Vehicle {vehicle_id_to_check}': [
             'Belongs' if x else "Doesn't belong" for x in df['Belongs_to_vehicle']
@@ -52,30 +233,12 @@ def create_output_dataframe(df: pd.DataFrame, vehicle_id_to_check: str) -> pd.Da
     })
 
 
-# פונקציה לבדיקת הסתברות מחרוזת עבור מספר רכב
-def check_trip_and_add_to_tree(vehicle_profiles, vehicle_id, trip_string):
-    # לחשב את ההסתברות של הנסיעה
-    probability = vehicle_profiles.calculate_probability_for_vehicle(vehicle_id, trip_string)
-
-    # ערך הסף של הרכב
-    threshold = vehicle_profiles.get_threshold(vehicle_id)
-
-    # הדפסת ההסתברות והסף
-    print(f"Probability of trip: {probability}, Threshold for vehicle {vehicle_id}: {threshold}")
-
-    # בדיקה אם ההסתברות גבוהה מהסף
-    if probability > threshold:
-        print(f"Trip accepted for vehicle {vehicle_id}, adding to tree.")
-        vehicle_profiles.add_trip(vehicle_id, trip_string)  # הוספת הנסיעה לעץ
-    else:
-        print(f"Trip rejected for vehicle {vehicle_id}. Probability too low.")
-
-    return probability > threshold  # מחזיר אם הנסיעה התקבלה או לא
-
+def compute_roc(df_output: pd.DataFrame, vehicle_id_to_check: str, output_dir: str = 'media', plot: bool = True):
+    """Runs the ROC step on an output DataFrame.
 
-def process_and_save_results(writer, df_output: pd.DataFrame, vehicle_id_to_check: str,
-                             vehicle_profiles: VehicleProfiles, output_dir: str = 'media'):
-    """Processes the DataFrame with ROC and saves it to an Excel sheet, and updates the vehicle profile threshold."""
+    Returns (roc curve image path, optimal threshold), or (None, None) when the ROC is not defined.
+    With plot=False no image is rendered and the path is None.
+    """
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
@@ -87,99 +250,430 @@ def process_and_save_results(writer, df_output: pd.DataFrame, vehicle_id_to_chec
             belongs_value='Belongs',
             vehicle_id=vehicle_id_to_check,
             output_dir=output_dir,
+            plot=plot,
         )
     except ValueError as e:
         print(f"Skipping ROC for vehicle {vehicle_id_to_check} due to error: {e}")
-        roc_curve_image = None
-        return  # במקרה של שגיאה, לא להמשיך כדי להימנע מעדכון שגוי של הסף
+        return None, None  # במקרה של שגיאה, לא להמשיך כדי להימנע מעדכון שגוי של הסף
 
-    # עדכון threshold בפרופיל של הרכב לאחר החישוב
     optimal_threshold = df_output['Threshold'].dropna().iloc[0]  # הנחת שזה הערך שחושב
-    vehicle_profiles.set_threshold(vehicle_id_to_check, optimal_threshold)
+    return roc_curve_image, optimal_threshold
 
-    # Save DataFrame to the specific sheet
-    sheet_name = f'Vehicle_{vehicle_id_to_check}'
-    df_output.to_excel(writer, sheet_name=sheet_name, index=False)
 
-    # Access the workbook and sheet via the writer
-    workbook = writer.book
-    if sheet_name in workbook.sheetnames:
-        sheet = workbook[sheet_name]
-    else:
-        sheet = workbook.create_sheet(sheet_name)
+def write_vehicle_results(writer, df_output: pd.DataFrame, vehicle_id_to_check: str, roc_curve_image):
+    """Saves a vehicle's output DataFrame to its own Excel sheet and inserts the ROC curve image."""
+    write_vehicle_sheet(writer, df_output, vehicle_id_to_check, roc_curve_image)
 
-    # Insert the image into the sheet
-    if roc_curve_image and os.path.exists(roc_curve_image):
-        img = Image(roc_curve_image)
-        # Adjust the position as needed; 'A10' is an example
-        sheet.add_image(img, 'A10')
-    else:
-        print(f"No ROC curve image to insert for vehicle {vehicle_id_to_check}.")
 
+def process_and_save_results(writer, df_output: pd.DataFrame, vehicle_id_to_check: str,
+                             vehicle_profiles: VehicleProfiles, output_dir: str = 'media'):
+    """Processes the DataFrame with ROC and saves it to an Excel sheet, and updates the vehicle profile threshold."""
+    roc_curve_image, optimal_threshold = compute_roc(df_output, vehicle_id_to_check, output_dir)
+    if optimal_threshold is None:
+        return
 
-def create_file():
-    """Main function to execute the entire pipeline."""
-    csv_file_path = 'data/Trips.csv'
+    # עדכון threshold בפרופיל של הרכב לאחר החישוב
+    vehicle_profiles.set_threshold(vehicle_id_to_check, optimal_threshold)
+    write_vehicle_results(writer, df_output, vehicle_id_to_check, roc_curve_image)
 
-    # Step 1: Load CSV data
-    df = load_csv(csv_file_path)
 
-    # Step 2: Process the DataFrame once before the loop
-    df = process_dataframe(df)
+def build_vehicle_index(df: pd.DataFrame) -> dict:
+    """Maps each vehicle id (as a string, in order of first appearance) to the row positions of its trips."""
+    codes, uniques = pd.factorize(df['vehicle_id'], use_na_sentinel=False)
+    vehicle_ids = pd.Series(uniques).astype(str)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1]
+    return dict(zip(vehicle_ids, np.split(order, bounds)))
 
-    # Step 3: Create vehicle profiles
-    vehicle_profiles = create_vehicle_profiles(df)
 
-    # Create a new Excel file
-    output_excel_file = 'data/output_with_roc.xlsx'
-    with pd.ExcelWriter(output_excel_file, engine='openpyxl') as writer:
-        unique_vehicle_ids = df['vehicle_id'].unique().astype(str)
-        for vehicle_id in unique_vehicle_ids:
-            vehicle_id_to_check = vehicle_id
+def sample_negative_positions(positions: np.ndarray, n_rows: int, random_state: int = 42) -> np.ndarray:
+    """Row positions of a seeded random sample of the other vehicles' rows, as many as positions.
 
-            # Step 4: Calculate probabilities for vehicle_id_to_check
-            df_belongs = df[df['vehicle_id'].astype(str) == vehicle_id_to_check].copy()
-            df_not_belongs = df[df['vehicle_id'].astype(str) != vehicle_id_to_check].copy()
+    positions must be sorted. Generator.choice draws without replacement in time and memory that
+    follow the sample size (a hash-set draw) unless the sample is a large part of the pool, and the
+    i-th row outside positions is found arithmetically, so the rows of the other vehicles are never
+    collected into a frame, mask or permutation.
+    """
+    n_negative = n_rows - len(positions)
+    if n_negative >= len(positions):
+        picks = np.random.default_rng(random_state).choice(n_negative, size=len(positions), replace=False)
+    else:
+        picks = np.arange(n_negative)
+    # Number of positive rows before each positive row's slot in the negative numbering
+    gaps = positions - np.arange(len(positions))
+    return picks + np.searchsorted(gaps, picks, side='right')
 
-            # Sample negative examples equal to the number of positive examples
-            if len(df_not_belongs) >= len(df_belongs):
-                df_not_belongs_sample = df_not_belongs.sample(n=len(df_belongs), random_state=42)
-            else:
-                df_not_belongs_sample = df_not_belongs.copy()
 
-            # Combine positive and negative examples
-            df_check = pd.concat([df_belongs, df_not_belongs_sample], ignore_index=True)
+def create_check_dataframe(df: pd.DataFrame, vehicle_id_to_check: str, vehicle_index: dict = None) -> pd.DataFrame:
+    """Balanced sample for one vehicle: all of its trips plus as many trips of other vehicles.
 
-            # Step 5: Calculate probabilities
-            df_check = calculate_probabilities(df_check, vehicle_profiles, vehicle_id_to_check)
+    With a vehicle_index (see build_vehicle_index) the vehicle's rows are looked up instead of found
+    by comparing the whole id column; the resulting sample is the same.
+    """
+    if vehicle_index is not None:
+        positions = vehicle_index.get(vehicle_id_to_check, np.zeros(0, dtype=np.intp))
+    else:
+        positions = np.flatnonzero(df['vehicle_id'].astype(str).to_numpy() == vehicle_id_to_check)
+
+    # Sample negative examples equal to the number of positive examples
+    negatives = sample_negative_positions(positions, len(df))
+
+    # Combine positive and negative examples
+    return df.iloc[np.concatenate([positions, negatives])].reset_index(drop=True)
+
+
+def evaluate_vehicle(df: pd.DataFrame, vehicle_profiles: VehicleProfiles, vehicle_id_to_check: str,
+                     output_dir: str = 'media', vehicle_index: dict = None, roc: bool = True):
+    """Scores a balanced sample against one vehicle and runs its ROC, without writing anything to Excel.
+
+    Returns (output DataFrame, ROC curve image path, optimal threshold); the threshold is None
+    when the ROC could not be computed. roc=False stops after scoring (image and threshold are None),
+    leaving the calibration to calibrate_outputs.
+    """
+    # Step 4: Sample positive and negative examples for vehicle_id_to_check
+    df_check = create_check_dataframe(df, vehicle_id_to_check, vehicle_index)
+
+    # Step 5: Calculate probabilities
+    started = time.perf_counter()
+    with metrics.stage("score"):
+        df_check = calculate_probabilities(df_check, vehicle_profiles, vehicle_id_to_check)
+    metrics.set_gauge("scoring_seconds", time.perf_counter() - started, vehicle_id_to_check)
+    metrics.increment("trips_scored", len(df_check))
+
+    # Step 6: Create output DataFrame
+    df_output = create_output_dataframe(df_check, vehicle_id_to_check)
+
+    if not roc:
+        return df_output, None, None
+
+    # Step 7: ROC and optimal threshold
+    started = time.perf_counter()
+    with metrics.stage("calibrate"):
+        roc_curve_image, optimal_threshold = compute_roc(df_output, vehicle_id_to_check, output_dir)
+    metrics.set_gauge("calibration_seconds", time.perf_counter() - started, vehicle_id_to_check)
+    return df_output, roc_curve_image, optimal_threshold
+
+
+def calibrate_outputs(outputs: dict) -> pd.DataFrame:
+    """Calibrates the output DataFrames of many vehicles ({vehicle_id: df_output}) in one pass.
+
+    Returns one row per vehicle with the threshold, confusion counts and rates that
+    process_excel_with_roc would compute for it (see trash_hold_calc.calibrate_thresholds).
+    """
+    vehicle_ids = list(outputs)
+    labels = [outputs[v][f'Belongs to Vehicle {v}'].to_numpy() == 'Belongs' for v in vehicle_ids]
+    scores = [outputs[v]['Probability'].to_numpy(dtype=np.float64) for v in vehicle_ids]
+    groups = np.repeat(np.arange(len(vehicle_ids)), [len(outputs[v]) for v in vehicle_ids])
+    calibration = calibrate_thresholds(np.concatenate(labels + [np.zeros(0, dtype=bool)]),
+                                       np.concatenate(scores + [np.zeros(0)]), groups)
+    calibration.index = [vehicle_ids[code] for code in calibration.index]
+    return calibration
+
+
+def evaluate_node_budgets(df: pd.DataFrame, node_budgets, score_space: str = PROBABILITY) -> pd.DataFrame:
+    """Trade-off of tree node budgets: for unbounded trees and for each budget, the profiles are built,
+    every vehicle's balanced sample is scored and calibrated as in create_file.
+
+    Returns one row per budget (None = unbounded) with the total phrase nodes, mean AUC, mean change
+    and largest drop of a vehicle's AUC against the unbounded trees, and build and scoring seconds.
+    """
+    vehicle_index = build_vehicle_index(df)
+    rows = []
+    baseline = None
+    for node_budget in [None, *node_budgets]:
+        started = time.perf_counter()
+        vehicle_profiles = create_vehicle_profiles(df, score_space, keep_history=False, node_budget=node_budget)
+        build_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        outputs = {vehicle_id: evaluate_vehicle(df, vehicle_profiles, vehicle_id, vehicle_index=vehicle_index,
+                                                roc=False)[0] for vehicle_id in vehicle_index}
+        score_seconds = time.perf_counter() - started
+        auc = calibrate_outputs(outputs)['AUC'].astype(np.float64)
+        if baseline is None:
+            baseline = auc
+        rows.append({
+            'node_budget': node_budget,
+            'nodes': sum(profile['tree'].total_nodes for profile in vehicle_profiles.profiles.values()),
+            'mean_auc': auc.mean(),
+            'mean_auc_change': (auc - baseline).mean(),
+            'max_auc_drop': (baseline - auc).max(),
+            'build_seconds': build_seconds,
+            'score_seconds': score_seconds,
+        })
+    return pd.DataFrame(rows)
+
+
+# Per-process state of the evaluation workers, set once by _init_evaluation_worker
+_worker_state = {}
+
+
+def _init_evaluation_worker(df: pd.DataFrame, vehicle_profiles: VehicleProfiles, output_dir: str,
+                            vehicle_index: dict, roc: bool):
+    _worker_state['df'] = df
+    _worker_state['vehicle_index'] = vehicle_index
+    _worker_state['vehicle_profiles'] = vehicle_profiles
+    _worker_state['output_dir'] = output_dir
+    _worker_state['roc'] = roc
+
+
+def _evaluate_vehicle_task(vehicle_id_to_check: str):
+    return evaluate_vehicle(_worker_state['df'], _worker_state['vehicle_profiles'], vehicle_id_to_check,
+                            _worker_state['output_dir'], _worker_state['vehicle_index'], _worker_state['roc'])
+
+
+def evaluate_vehicles(df: pd.DataFrame, vehicle_profiles: VehicleProfiles, vehicle_ids, workers: int = 1,
+                      output_dir: str = 'media', vehicle_index: dict = None, roc: bool = True):
+    """Yields (vehicle_id, df_output, roc_curve_image, optimal_threshold) in the order of vehicle_ids.
+
+    With workers > 1 the scoring and ROC of each vehicle run in a process pool. The profiles and the
+    trips are handed to every worker once, at start-up (with the fork start method they are shared
+    copy-on-write rather than copied); only the per-vehicle results travel back.
+    """
+    if workers <= 1:
+        for vehicle_id in vehicle_ids:
+            yield (vehicle_id, *evaluate_vehicle(df, vehicle_profiles, vehicle_id, output_dir, vehicle_index, roc))
+        return
+
+    df_trips = df[['vehicle_id', 'trip_description'] + (['trip_text'] if 'trip_text' in df.columns else [])]
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_evaluation_worker,
+                             initargs=(df_trips, vehicle_profiles, output_dir, vehicle_index, roc)) as executor:
+        # map returns results in submission order, which keeps the output deterministic
+        for vehicle_id, result in zip(vehicle_ids, executor.map(_evaluate_vehicle_task, vehicle_ids)):
+            yield (vehicle_id, *result)
+
+
+def create_file(score_space: str = PROBABILITY, workers: int = 1, profile_store_path: str = None,
+                chunk_size: int = None, plot_roc: bool = True, report_format: str = EXCEL, report_path: str = None,
+                metrics_sinks=(), profile_stages=(), keep_history: bool = True, node_budget: int = None,
+                trip_encoding: str = LETTERS, csv_file_path: str = 'data/Trips.csv', interactive: bool = True):
+    """Main function to execute the entire pipeline.
+
+    score_space 'log' or 'log_per_symbol' scores in log space, which avoids underflow on long trips.
+    workers > 1 builds the profiles and spreads the per-vehicle scoring and ROC over that many
+    processes; the Excel file is still written by this process, in vehicle order.
+    profile_store_path, when given, receives the calibrated profiles so that check_trips_from_store
+    can answer queries later without rebuilding them.
+    chunk_size, when given, streams the CSV in chunks of that many rows and keeps only the vehicle id
+    and trip description of each row; the results are the same as loading the whole file.
+    plot_roc=False skips the ROC figures and calibrates all vehicles together in one vectorized pass;
+    the sheets get the same values, without the images.
+    report_format selects the report backend (see report_writers.REPORT_FORMATS): the in-memory
+    Excel workbook, a streaming write-only workbook, or Parquet/CSV files per vehicle plus a summary
+    table. report_path defaults to data/output_with_roc.xlsx, or data/report for the columnar formats.
+    metrics_sinks (e.g. metrics.JsonLinesSink, metrics.PrometheusTextSink) turn on the stage timers,
+    counters and per-vehicle tree gauges and receive them at the end of the run; the stages named in
+    profile_stages also run under cProfile. With workers > 1 the per-vehicle scoring and calibration
+    happen in the workers, so only the stage totals of this process are recorded.
+    keep_history=False builds the profiles without their raw trip strings (the trees score the same).
+    node_budget caps the phrase nodes of every tree; evaluate_node_budgets shows what a budget costs in AUC.
+    trip_encoding 'tokens' encodes every field value as one fixed-width token instead of letter groups
+    (see trip_tokens); the report and the trip prompt keep a readable form of the trips.
+    interactive=False returns the profiles instead of starting the trip prompt.
+    """
+    if trip_encoding not in TRIP_ENCODINGS:
+        raise ValueError(f"Unknown trip encoding: {trip_encoding}")
+    vocabulary = TokenVocabulary() if trip_encoding == TOKENS else None
+    if metrics_sinks or profile_stages:
+        metrics.enable(metrics_sinks, profile_stages)
+    try:
+        vehicle_profiles = _run_pipeline(score_space, workers, profile_store_path, chunk_size, plot_roc,
+                                         report_format, report_path, keep_history, node_budget, vocabulary,
+                                         csv_file_path)
+    finally:
+        # Also writes the accumulated cProfile statistics of the profiled stages
+        metrics.disable()
+
+    if not interactive:
+        return vehicle_profiles
+    check_trips(vehicle_profiles)
+
+
+def _run_pipeline(score_space, workers, profile_store_path, chunk_size, plot_roc, report_format, report_path,
+                  keep_history, node_budget, vocabulary, csv_file_path) -> VehicleProfiles:
+    # Steps 1-7 of create_file, with the metrics it enabled
+    if chunk_size:
+        # Steps 1-3 chunk by chunk
+        trips = []
+        kept_columns = ['vehicle_id', 'trip_description'] + (['trip_text'] if vocabulary else [])
+
+        def keep_trips(chunks):
+            for chunk in chunks:
+                trips.append(chunk[kept_columns])
+                yield chunk
+
+        with metrics.stage("load_encode_build"):
+            vehicle_profiles = create_vehicle_profiles_from_chunks(
+                keep_trips(iter_trip_chunks(csv_file_path, chunk_size, vocabulary)), score_space, keep_history,
+                vocabulary)
+            df = pd.concat(trips, ignore_index=True)
+    else:
+        # Step 1: Load CSV data
+        with metrics.stage("load_csv"):
+            df = load_csv(csv_file_path)
+
+        # Step 2: Process the DataFrame once before the loop
+        with metrics.stage("encode"):
+            df = process_dataframe(df, vocabulary)
+
+        # Step 3: Create vehicle profiles
+        with metrics.stage("build_profiles"):
+            vehicle_profiles = create_vehicle_profiles(df, score_space, keep_history, workers, node_budget,
+                                                       vocabulary)
+    metrics.increment("trips_loaded", len(df))
+
+    # Create the report
+    if report_path is None:
+        report_path = 'data/output_with_roc.xlsx' if report_format.startswith(EXCEL) else 'data/report'
+    with metrics.stage("evaluate_and_report"), open_report_writer(report_format, report_path) as writer:
+        # Row positions of every vehicle, computed once instead of filtering the frame per vehicle
+        vehicle_index = build_vehicle_index(df)
+        unique_vehicle_ids = list(vehicle_index)
+        if plot_roc:
+            # Steps 4-7 for every vehicle, then a single ordered writer stage
+            results = evaluate_vehicles(df, vehicle_profiles, unique_vehicle_ids, workers,
+                                        vehicle_index=vehicle_index)
+            for vehicle_id, df_output, roc_curve_image, optimal_threshold in results:
+                if optimal_threshold is None:
+                    continue
+                # עדכון threshold בפרופיל של הרכב לאחר החישוב
+                vehicle_profiles.set_threshold(vehicle_id, optimal_threshold)
+                writer.write_vehicle(vehicle_id, df_output, roc_curve_image)
+        else:
+            # Steps 4-6 for every vehicle, then step 7 for all of them at once
+            outputs = {vehicle_id: df_output for vehicle_id, df_output, _, _ in
+                       evaluate_vehicles(df, vehicle_profiles, unique_vehicle_ids, workers,
+                                         vehicle_index=vehicle_index, roc=False)}
+            with metrics.stage("calibrate"):
+                calibration = calibrate_outputs(outputs)
+                apply_calibration(vehicle_profiles, calibration)
+            for vehicle_id, auc in calibration['AUC'].items():
+                metrics.set_gauge("auc", auc, vehicle_id)
+            for vehicle_id, df_output in outputs.items():
+                result = calibration.loc[vehicle_id]
+                if result['Error'] is not None:
+                    print(f"Skipping ROC for vehicle {vehicle_id} due to error: {result['Error']}")
+                    continue
+                writer.write_vehicle(vehicle_id, add_calibration_columns(df_output, result), calibration=result)
+
+    print(f"Results saved to {report_path}")
+
+    if profile_store_path:
+        with metrics.stage("save_store"):
+            vehicle_profiles.save(profile_store_path)
+        print(f"Profiles saved to {profile_store_path}")
+
+    if metrics.enabled:
+        for vehicle_id, profile in vehicle_profiles.profiles.items():
+            metrics.record_tree(vehicle_id, profile)
+        metrics.flush()
+    return vehicle_profiles
 
-            # Step 6: Create output DataFrame
-            df_output = create_output_dataframe(df_check, vehicle_id_to_check)
 
-            # Step 7: Process and save results, including inserting ROC image and updating threshold
-            process_and_save_results(writer, df_output, vehicle_id_to_check, vehicle_profiles)
+def build_profile_store(csv_file_path: str, profile_store_path: str, score_space: str = PROBABILITY,
+                        workers: int = 1, chunk_size: int = None, keep_history: bool = True,
+                        node_budget: int = None, trip_encoding: str = LETTERS) -> VehicleProfiles:
+    """Steps 1-3 of create_file only: builds the profiles of a CSV and saves them to a profile store.
+
+    Thresholds keep their default until calibrate_profile_store runs.
+    """
+    if trip_encoding not in TRIP_ENCODINGS:
+        raise ValueError(f"Unknown trip encoding: {trip_encoding}")
+    vocabulary = TokenVocabulary() if trip_encoding == TOKENS else None
+    if chunk_size:
+        vehicle_profiles = create_vehicle_profiles_from_chunks(
+            iter_trip_chunks(csv_file_path, chunk_size, vocabulary), score_space, keep_history, vocabulary)
+    else:
+        df = process_dataframe(load_csv(csv_file_path), vocabulary)
+        vehicle_profiles = create_vehicle_profiles(df, score_space, keep_history, workers, node_budget, vocabulary)
+    vehicle_profiles.save(profile_store_path)
+    print(f"Profiles saved to {profile_store_path}")
+    return vehicle_profiles
 
-    print(f"Results saved to {output_excel_file}")
-    while True:
-        # קבלת מספר רכב מהמשתמש
-        vehicle_id = input("Please enter the vehicle ID (or 'exit' to quit): ")
-        if vehicle_id.lower() == 'exit':
-            print("Exiting the program.")
-            break
 
-        # וידוא שמספר הרכב קיים בפרופילים
-        if vehicle_id not in vehicle_profiles.profiles:
-            print(f"No profile found for vehicle ID: {vehicle_id}")
-            continue
+def update_profile_store(csv_file_path: str, profile_store_path: str) -> VehicleProfiles:
+    """Adds the trips of a CSV (e.g. a day's new trips) to the profiles of a saved store.
 
-        # קבלת מחרוזת נסיעה מהמשתמש
-        trip_string = input("Please enter the trip string to check: ")
+    Every vehicle that gets trips has its tree continued and its version raised, so the next
+    calibrate_profile_store redoes it; vehicles without new trips keep their calibration.
+    """
+    vehicle_profiles = VehicleProfiles.load(profile_store_path, mmap=False)  # The file is replaced below
+    df = process_dataframe(load_csv(csv_file_path), vehicle_profiles.vocabulary)
+    vehicle_trips = df.groupby('vehicle_id')['trip_description'].apply(''.join)
+    for vehicle_id, trip_string in vehicle_trips.items():
+        vehicle_profiles.add_trip(vehicle_id, trip_string)
+    if vehicle_profiles.vocabulary is not None:
+        # Cells of the new trips are offered to the vehicles that got none of them too
+        vehicle_profiles.refresh_options()
+    vehicle_profiles.save(profile_store_path)
+    print(f"Trips of {len(vehicle_trips)} vehicles added to {profile_store_path}")
+    return vehicle_profiles
 
-        # חישוב הסתברות למחרוזת והשוואה לערך הסף
-        accepted = check_trip_and_add_to_tree(vehicle_profiles, vehicle_id, trip_string)
 
-        # שאלת המשתמש אם ברצונו לבדוק נסיעה נוספת
-        check_another = input("Do you want to check another trip? (yes/no): ")
-        if check_another.lower() != 'yes':
-            print("Exiting the program.")
-            break
+def calibration_sample(df: pd.DataFrame, positions: np.ndarray, version: int) -> dict:
+    """What a vehicle's calibration depends on: its tree version, its own trips and the size of the
+    pool of other vehicles' trips that create_check_dataframe draws the negative sample from."""
+    trips = '\n'.join(df['trip_description'].iloc[positions])
+    return {"version": version, "positives": hashlib.blake2b(trips.encode('utf-8'), digest_size=16).hexdigest(),
+            "pool": len(df) - len(positions)}
+
+
+def calibration_is_stale(record, sample: dict, stale_fraction: float = STALE_SAMPLE_FRACTION) -> bool:
+    """True when a cached calibration record no longer holds for the current sample.
+
+    The tree and the positive trips must be unchanged. The negatives are another random draw whenever
+    the data changes at all, so they only count as stale once their pool changed by more than
+    stale_fraction; other vehicles' daily trips do not redo every vehicle.
+    """
+    if record is None or record["version"] != sample["version"] or record["positives"] != sample["positives"]:
+        return True
+    return abs(sample["pool"] - record["pool"]) > stale_fraction * record["pool"]
+
+
+def _json_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def calibrate_profile_store(csv_file_path: str, profile_store_path: str, workers: int = 1,
+                            incremental: bool = True, stale_fraction: float = STALE_SAMPLE_FRACTION) -> pd.DataFrame:
+    """Steps 4-7 without a report: scores the CSV against a saved store, calibrates the vehicles in
+    one vectorized pass and saves the thresholds back to the store. Returns the calibration table.
+
+    Each calibration is saved with the sample it was computed on (calibration_sample). With
+    incremental, a vehicle whose record still holds (see calibration_is_stale) is not scored again:
+    its threshold and cached results are reused, so a recalibration costs what changed since the last
+    one. incremental=False redoes every vehicle.
+    """
+    vehicle_profiles = VehicleProfiles.load(profile_store_path, mmap=False)  # The file is replaced below
+    df = process_dataframe(load_csv(csv_file_path), vehicle_profiles.vocabulary)
+    if vehicle_profiles.vocabulary is not None:
+        # Cells first seen in this CSV must cost their option weight, not be skipped; the trees
+        # that gain them get a new version and are recalibrated
+        vehicle_profiles.refresh_options()
+    vehicle_index = build_vehicle_index(df)
+    vehicle_ids = [vehicle_id for vehicle_id in vehicle_index if vehicle_id in vehicle_profiles.profiles]
+    samples = {vehicle_id: calibration_sample(df, vehicle_index[vehicle_id], vehicle_profiles.version(vehicle_id))
+               for vehicle_id in vehicle_ids}
+    stale = [vehicle_id for vehicle_id in vehicle_ids
+             if not incremental or calibration_is_stale(vehicle_profiles.profiles[vehicle_id].get("calibration"),
+                                                        samples[vehicle_id], stale_fraction)]
+
+    outputs = {vehicle_id: df_output for vehicle_id, df_output, _, _ in
+               evaluate_vehicles(df, vehicle_profiles, stale, workers, vehicle_index=vehicle_index, roc=False)}
+    calibration = calibrate_outputs(outputs) if outputs else pd.DataFrame(columns=CALIBRATION_COLUMNS)
+    for vehicle_id, result in calibration.iterrows():
+        threshold = result['Threshold']
+        if pd.isna(threshold):
+            threshold = vehicle_profiles.get_threshold(vehicle_id)
+        record = {**samples[vehicle_id], "result": {column: _json_value(result[column]) for column in CALIBRATION_COLUMNS}}
+        vehicle_profiles.record_calibration(vehicle_id, threshold, record)
+    metrics.increment("vehicles_recalibrated", len(stale))
+    metrics.increment("vehicles_calibration_reused", len(vehicle_ids) - len(stale))
+
+    vehicle_profiles.save(profile_store_path)
+    print(f"Recalibrated {len(stale)} of {len(vehicle_ids)} vehicles; thresholds saved to {profile_store_path}")
+    cached = {vehicle_id: vehicle_profiles.profiles[vehicle_id]["calibration"]["result"] for vehicle_id in vehicle_ids}
+    return pd.DataFrame.from_dict(cached, orient='index', columns=CALIBRATION_COLUMNS)
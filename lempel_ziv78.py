@@ -1,95 +1,236 @@
+import heapq
+import math
+
+import numpy as np
+
+from batch_scoring import INITIAL_LOG, PROBABILITY, TransitionTable, as_trip_batch, log_weight, prefers_walk, walk_trips
+
+
 class Node:
     def __init__(self, value=""):
         self.value = value
         self.children = {}
         self.probability = 0.0  # Probability of the node
         self.weight = 0.0  # Derived weight based on leaf ratio
+        self.log_weight = 0.0  # Log of the weight, for log-space scoring
         self.leaf_count = 0  # Leaf count
         self.total_descendants = 0  # Total nodes under this node
 
 
+PRUNE_TARGET = 0.9  # prune cuts the tree to this fraction of its budget, so it does not run on every trip
+
+
 class LempelZivTree:
     def __init__(self):
         self.root = Node()
         self.leaves_count = 0  # Total leaves
         self.options = set()  # Set of options initialized with letters a to z
         self.total_nodes = 0  # Total nodes in the tree
+        self.pending = ""  # Unfinished last phrase, continued by the next build_tree call
+        self._dirty = set()  # Nodes whose children need their weights refreshed
+        self._reweight_all = True  # Next calculate_weights must do a full pass
+        self._transition_table = None  # Cached scoring table, dropped whenever the tree changes
+
+
+    def copy(self):
+        """Independent copy of the tree (the pending phrase and weight bookkeeping included)."""
+        tree = LempelZivTree.__new__(LempelZivTree)
+        tree.__dict__.update(self.__dict__)
+        tree.root = self._copy_node(self.root)
+        clones = {id(self.root): tree.root}
+        stack = [(self.root, tree.root)]
+        while stack:
+            source, target = stack.pop()
+            for char, child in source.children.items():
+                clone = self._copy_node(child)
+                target.children[char] = clone
+                clones[id(child)] = clone
+                stack.append((child, clone))
+        tree.options = set(self.options)
+        tree._dirty = {clones[id(node)] for node in self._dirty}
+        return tree
 
+    @staticmethod
+    def _copy_node(node):
+        clone = Node(node.value)
+        clone.probability = node.probability
+        clone.weight = node.weight
+        clone.log_weight = node.log_weight
+        clone.leaf_count = node.leaf_count
+        clone.total_descendants = node.total_descendants
+        return clone
+
+    @staticmethod
+    def _preorder(node):
+        # Nodes of the subtree, every parent before its children (no recursion, so depth is not limited)
+        nodes = [node]
+        for current in nodes:
+            nodes.extend(current.children.values())
+        return nodes
 
     def count_all_children(self, node):
-        count = 0
-        for child in node.children.values():
-            count += 1 + self.count_all_children(child)
-        return count
+        return len(self._preorder(node)) - 1
 
     def is_leaf(self, node):
         return not node.children
 
+    def _is_phrase_node(self, node):
+        # Every node created by the parse is walked at least once; option leaves never are
+        return node.total_descendants > 0
+
     def count_leaves(self, node):
-        if self.is_leaf(node):
-            node.leaf_count = 1  # עלה נחשב לעצמו כעלה אחד
-            return 1
-        leaf_sum = 0
-        for child in node.children.values():
-            leaf_sum += self.count_leaves(child)
-        node.leaf_count = leaf_sum
-        return leaf_sum
+        # Children before parents, so every child's count is ready when its parent sums them
+        for current in reversed(self._preorder(node)):
+            if self.is_leaf(current):
+                current.leaf_count = 1  # עלה נחשב לעצמו כעלה אחד
+            else:
+                current.leaf_count = sum(child.leaf_count for child in current.children.values())
+        return node.leaf_count
 
     def add_options_to_leaves(self):
         self.leaves_count = 0
         self._add_options_to_node(self.root)
 
     def _add_options_to_node(self, node):
-        for option in self.options:
-            if option not in node.children:
-                node.children[option] = Node(option)
-                if self.is_leaf(node.children[option]):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for option in self.options:
+                child = node.children.get(option)
+                if child is None:
+                    child = Node(option)
+                    child.leaf_count = 1
+                    node.children[option] = child
                     self.leaves_count += 1
-            else:
-                self._add_options_to_node(node.children[option])
+                elif self._is_phrase_node(child):
+                    stack.append(child)
+                else:
+                    self.leaves_count += 1  # Option leaf left by an earlier build
 
     def insert(self, s):
         current = self.root
+        path = []
         for char in s:
-            if char not in current.children:
+            path.append(current)
+            child = current.children.get(char)
+            if child is None:
                 # הוספת האפשרויות הישירות מהשורש
                 if current == self.root:
+                    if char not in self.options:
+                        self._reweight_all = True  # A new option adds a leaf under many nodes
                     self.options.add(char)
                 # יצירת צומת חדש
-                current.children[char] = Node(char)
+                parent_was_leaf = self.is_leaf(current)
+                child = Node(char)
+                child.leaf_count = 1
+                current.children[char] = child
+                self._track_new_leaf(path, parent_was_leaf)
                 self.total_nodes += 1  # להוסיף לספירת הצמתים הכללית
-            current = current.children[char]
+            elif not self._is_phrase_node(child):
+                # The parse reached an option leaf, which now becomes a real node
+                self._promote_option_leaf(path, child)
+                self.total_nodes += 1
+            current = child
             # עדכון מספר הצמתים שתחת כל צומת
             current.total_descendants += 1
 
+    def _track_new_leaf(self, path, parent_was_leaf):
+        if self._reweight_all:
+            return
+        self._dirty.add(path[-1])
+        if not parent_was_leaf:
+            for node in path:
+                node.leaf_count += 1
+                self._dirty.add(node)
+
+    def _promote_option_leaf(self, path, node):
+        # Phrase nodes reached through options get every option as a child
+        for option in self.options:
+            leaf = Node(option)
+            leaf.leaf_count = 1
+            node.children[option] = leaf
+        self.leaves_count += len(self.options) - 1
+        if self._reweight_all:
+            return
+        delta = len(self.options) - 1
+        node.leaf_count += delta
+        self._dirty.add(node)
+        for ancestor in path:
+            ancestor.leaf_count += delta
+            self._dirty.add(ancestor)
+
+    def _undo_pending(self):
+        # Takes back the visit counts of the unfinished phrase so it can be parsed again with new input
+        current = self.root
+        for char in self.pending:
+            current = current.children[char]
+            current.total_descendants -= 1
+        pending, self.pending = self.pending, ""
+        return pending
+
     def build_tree(self, s):
+        """Continues the LZ78 parse with s.
+
+        The tree ends up exactly as if all input given so far had been passed in a single call,
+        but only the new symbols (plus the unfinished last phrase) are parsed.
+        """
+        self._transition_table = None
+        s = self._undo_pending() + s
         i = 0
         while i < len(s):
             current = self.root
             j = i
             # למצוא את הפריפיקס הארוך ביותר שכבר קיים בעץ
-            while j < len(s) and s[j] in current.children:
+            while j < len(s) and s[j] in current.children and self._is_phrase_node(current.children[s[j]]):
                 current = current.children[s[j]]
                 j += 1
+            if j == len(s):
+                # The input ended inside an existing phrase; keep it open for the next call
+                self.pending = s[i:]
             # הוספת המחרוזת החדשה לעץ
             self.insert(s[i:j + 1])
             i = j + 1
 
-        self.add_options_to_leaves()
+        if self._reweight_all:
+            self.add_options_to_leaves()
 
     def calculate_weights(self, node=None, parent_leaf_count=None):
         if node is None:
+            self._transition_table = None
+            if not self._reweight_all:
+                self._reweight_dirty()
+                return
+            self._reweight_all = False
+            self._dirty.clear()
             node = self.root
-            self.count_leaves(node)  # נחשב את מספר העלים עבור כל צומת לפני חישוב המשקלות
             parent_leaf_count = self.leaves_count  # השורש יהיה צומת האב הראשון
 
-        if self.is_leaf(node):
-            # אם הצומת הוא עלה, נחשב את המשקל כ-1 חלקי מספר העלים של צומת האב
-            node.weight = 1 / parent_leaf_count if parent_leaf_count > 0 else 0
-        else:
-            node.weight = node.leaf_count / parent_leaf_count if parent_leaf_count > 0 else 0
+        # One post-order sweep: once a node's leaf count is known, its children's weights are too
+        for current in reversed(self._preorder(node)):
+            children = current.children.values()
+            if not children:
+                current.leaf_count = 1  # עלה נחשב לעצמו כעלה אחד
+                continue
+            leaf_count = 0
+            for child in children:
+                leaf_count += child.leaf_count
+            current.leaf_count = leaf_count
+            for child in children:
+                # Leaf count over the parent's leaf count (1 / the parent's count for a leaf), never 0 here
+                child.weight = weight = child.leaf_count / leaf_count
+                child.log_weight = math.log(weight)
+        node.weight = node.leaf_count / parent_leaf_count if parent_leaf_count > 0 else 0
+        node.log_weight = log_weight(node.weight)
+
+    def _reweight_dirty(self):
+        # Leaf counts were kept up to date by insert, so only the touched paths need new weights
+        self.root.weight = self.root.leaf_count / self.leaves_count if self.leaves_count > 0 else 0
+        self.root.log_weight = log_weight(self.root.weight)
+        for node in self._dirty:
             for child in node.children.values():
-                self.calculate_weights(child, node.leaf_count)  # עבור לכל ילד עם מספר העלים של הצומת הנוכחי כאב
+                child.weight = child.leaf_count / node.leaf_count if node.leaf_count > 0 else 0
+                child.log_weight = log_weight(child.weight)
+        self._dirty.clear()
 
     def calculate_sequence_probability(self, s):
         current = self.root
@@ -106,14 +247,202 @@ class LempelZivTree:
                         probability *= current.weight
         return probability
 
-    def print_tree(self, node=None, level=0):
+    def calculate_sequence_log_probability(self, s, per_symbol=False):
+        """Log of calculate_sequence_probability, summing the stored log-weights so it cannot underflow.
+
+        With per_symbol the sum of log-weights (without the initial scale) is divided by the length of s.
+        """
+        current = self.root
+        total = 0.0
+        for char in s:
+            if char in current.children:
+                current = current.children[char]
+                total += current.log_weight
+            else:
+                current = self.root
+                if char in current.children:
+                    current = current.children[char]
+                    if current.total_descendants > 0:
+                        total += current.log_weight
+        if per_symbol:
+            return total / len(s) if s else 0.0
+        return INITIAL_LOG + total
+
+    def transition_table(self):
+        if self._transition_table is None:
+            self._transition_table = self._build_transition_table()
+        return self._transition_table
+
+    def _build_transition_table(self):
+        # Every node with children gets a state (the root is state 0); all leaves share the last state,
+        # since from a leaf any symbol restarts the walk from the root
+        internal = [self.root]
+        alphabet = set()
+        for node in internal:
+            alphabet.update(node.children)
+            internal.extend(child for child in node.children.values() if child.children)
+        leaf_state = len(internal)
+        states = {id(node): i for i, node in enumerate(internal)}
+        alphabet = sorted(alphabet)
+        columns = {char: i for i, char in enumerate(alphabet)}
+
+        miss_state = np.zeros(len(alphabet), dtype=np.int32)
+        miss_factor = np.ones(len(alphabet), dtype=np.float64)
+        miss_log_factor = np.zeros(len(alphabet), dtype=np.float64)
+        for char, child in self.root.children.items():
+            # After a miss the walk moves to the root's child; an option leaf there costs nothing
+            miss_state[columns[char]] = states.get(id(child), leaf_state)
+            if child.total_descendants > 0:
+                miss_factor[columns[char]] = child.weight
+                miss_log_factor[columns[char]] = child.log_weight
+
+        next_state = np.tile(miss_state, (leaf_state + 1, 1))
+        factor = np.tile(miss_factor, (leaf_state + 1, 1))
+        log_factor = np.tile(miss_log_factor, (leaf_state + 1, 1))
+        rows, cols, targets, weights, log_weights = [], [], [], [], []
+        for row, node in enumerate(internal):
+            for char, child in node.children.items():
+                rows.append(row)
+                cols.append(columns[char])
+                targets.append(states.get(id(child), leaf_state))
+                weights.append(child.weight)
+                log_weights.append(child.log_weight)
+        next_state[rows, cols] = targets
+        factor[rows, cols] = weights
+        log_factor[rows, cols] = log_weights
+        return TransitionTable.from_rows([ord(char) for char in alphabet], next_state, factor, log_factor)
+
+    def calculate_sequence_probabilities(self, trips, space=PROBABILITY):
+        """Scores a batch of trip strings (or a TripBatch) at once, in the given score space.
+
+        The values are the same as calculate_sequence_probability / calculate_sequence_log_probability.
+        """
+        if self._transition_table is None and prefers_walk(trips, self.total_nodes):
+            return walk_trips(self, trips, space)
+        return self.transition_table().score(as_trip_batch(trips), space)
+
+    def tree_lines(self, node=None, level=0):
+        """Yields the print_tree lines in linear time.
+
+        The nodes are listed depth-first once; a node's subtree is the run of nodes after it that are
+        deeper than it, so every subtree size falls out of the same listing.
+        """
         if node is None:
             node = self.root
-        num_children = self.count_all_children(node)
-        print(
-            f"{'  ' * level}symbol {node.value} (num_child = {num_children}), weight = {node.weight}, leaf_count = {node.leaf_count}")
-        for child in node.children.values():
-            self.print_tree(child, level + 1)
+        nodes, depths = [], []
+        stack = [(node, level)]
+        while stack:
+            current, depth = stack.pop()
+            nodes.append(current)
+            depths.append(depth)
+            children = list(current.children.values())
+            children.reverse()
+            stack.extend([(child, depth + 1) for child in children])
+
+        # Close every open subtree when a node at the same or a smaller depth shows up
+        ends = [len(nodes)] * len(nodes)
+        open_nodes = []
+        for i, depth in enumerate(depths):
+            while open_nodes and depths[open_nodes[-1]] >= depth:
+                ends[open_nodes.pop()] = i
+            open_nodes.append(i)
+
+        for i, current in enumerate(nodes):
+            yield (f"{'  ' * depths[i]}symbol {current.value} (num_child = {ends[i] - i - 1}), "
+                   f"weight = {current.weight}, leaf_count = {current.leaf_count}")
+
+    def print_tree(self, node=None, level=0):
+        for line in self.tree_lines(node, level):
+            print(line)
+
+    def summary(self):
+        """Size statistics of the tree, from one pass over its nodes."""
+        nodes = leaves = phrase_nodes = max_depth = 0
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            max_depth = max(max_depth, depth)
+            if node is not self.root:
+                nodes += 1
+                phrase_nodes += self._is_phrase_node(node)
+            leaves += self.is_leaf(node)
+            stack.extend((child, depth + 1) for child in node.children.values())
+        return {"nodes": nodes, "phrase_nodes": phrase_nodes, "leaves": leaves, "option_leaves": self.leaves_count,
+                "options": len(self.options), "max_depth": max_depth, "pending": len(self.pending)}
+
+    def add_options(self, chars):
+        """Adds symbols to the options of the tree before they occur in its input.
+
+        A symbol the tree has never seen costs nothing when scored (the walk restarts at the root), so
+        an encoding with a large alphabet offers all of it up front. Weights are recalculated when an
+        option is added. Returns the number of options added.
+        """
+        new = set(chars) - self.options
+        if not new:
+            return 0
+        self.options |= new
+        self._reweight_all = True
+        self.add_options_to_leaves()
+        self.calculate_weights()
+        return len(new)
+
+    def prune(self, max_nodes, target=None):
+        """Collapses low-mass subtrees until at most target phrase nodes remain (target defaults to
+        PRUNE_TARGET * max_nodes); does nothing while total_nodes <= max_nodes. Returns the nodes removed.
+
+        The subtree with the fewest leaves (as of the last weighting) whose children are all phrase
+        leaves is collapsed first: its phrase children become option leaves again (or are dropped when
+        their symbol is not an option), and the parent may become the next candidate. The phrases of
+        the pending parse are kept. Weights are then recomputed from the new leaf counts, so every
+        node's children still share a total weight of 1.
+        """
+        if self.total_nodes <= max_nodes:
+            return 0
+        if target is None:
+            target = int(max_nodes * PRUNE_TARGET)
+
+        pending_path = {id(self.root)}
+        current = self.root
+        for char in self.pending[:-1]:
+            current = current.children[char]
+            pending_path.add(id(current))
+        parents = {}
+        candidates = []
+        for node in self._preorder(self.root):
+            phrase_children = [child for child in node.children.values() if self._is_phrase_node(child)]
+            for child in phrase_children:
+                parents[id(child)] = node
+            if phrase_children and id(node) not in pending_path and \
+                    not any(self._is_phrase_node(grandchild) for child in phrase_children
+                            for grandchild in child.children.values()):
+                heapq.heappush(candidates, (node.leaf_count, id(node), node))
+
+        removed = 0
+        while candidates and self.total_nodes > target:
+            _, _, node = heapq.heappop(candidates)
+            for char, child in list(node.children.items()):
+                if not self._is_phrase_node(child):
+                    continue
+                if char in self.options:
+                    leaf = Node(char)
+                    leaf.leaf_count = 1
+                    node.children[char] = leaf
+                else:
+                    del node.children[char]
+                self.total_nodes -= 1
+                removed += 1
+            parent = parents.get(id(node))
+            if parent is not None and id(parent) not in pending_path and not any(
+                    self._is_phrase_node(grandchild) for child in parent.children.values()
+                    for grandchild in child.children.values()):
+                heapq.heappush(candidates, (parent.leaf_count, id(parent), parent))
+
+        self._transition_table = None
+        self._dirty.clear()
+        self._reweight_all = True
+        self.add_options_to_leaves()
+        self.calculate_weights()
+        return removed
 
     def print_summary(self):
         # סה"כ עלים
@@ -0,0 +1,419 @@
+import math
+
+import numpy as np
+
+from batch_scoring import INITIAL_LOG, PROBABILITY, TransitionTable, as_trip_batch, prefers_walk, walk_trips
+
+
+class CompactLempelZivTree:
+    """LempelZivTree stored as flat arrays indexed by node id.
+
+    Node 0 is the root and a child always gets a larger id than its parent. Only
+    nodes created by the parse are stored; the option leaves that LempelZivTree
+    materializes under every option-reachable node are implicit here: such a
+    node is marked as expanded and its missing option children are derived when
+    needed (leaf count 1, weight 1 / parent leaf count).
+    """
+
+    def __init__(self, capacity=64, alphabet_capacity=32):
+        self.symbols = []  # Symbol id -> character
+        self._symbol_ids = {}  # Character -> symbol id
+        self.children = np.full((capacity, alphabet_capacity), -1, dtype=np.int32)  # Transition table
+        self.parent = np.full(capacity, -1, dtype=np.int32)
+        self.symbol = np.full(capacity, -1, dtype=np.int32)  # Symbol on the edge into the node
+        self.depth = np.zeros(capacity, dtype=np.int32)
+        self.total_descendants = np.zeros(capacity, dtype=np.int64)
+        self.leaf_count = np.zeros(capacity, dtype=np.int64)
+        self.weight = np.zeros(capacity, dtype=np.float64)
+        self.log_weight = np.zeros(capacity, dtype=np.float64)
+        self.option_log_weight = np.zeros(capacity, dtype=np.float64)  # Log-weight of the node's implicit leaves
+        self.expanded = np.zeros(capacity, dtype=bool)  # Carries every option as a (possibly implicit) child
+        self.is_option = np.zeros(alphabet_capacity, dtype=bool)
+        self.node_count = 1
+        self.expanded[0] = True
+        self.leaves_count = 0  # Total implicit option leaves
+        self.total_nodes = 0  # Total nodes in the tree, root excluded
+        self.pending = ""  # Unfinished last phrase, continued by the next build_tree call
+        self._dirty = set()  # Nodes whose children need their weights refreshed
+        self._reweight_all = True  # Next calculate_weights must do a full pass
+        self._transition_table = None  # Cached scoring table, dropped whenever the tree changes
+
+    # Per-node arrays, in the order used by to_arrays/from_arrays
+    NODE_ARRAYS = ("parent", "symbol", "depth", "total_descendants", "leaf_count", "weight", "log_weight",
+                   "option_log_weight", "expanded")
+
+    def to_arrays(self):
+        """Returns (arrays, state): the trimmed arrays and the scalar state needed by from_arrays."""
+        n = self.node_count
+        arrays = {name: getattr(self, name)[:n] for name in self.NODE_ARRAYS}
+        arrays["children"] = self.children[:n, :len(self.symbols)]
+        arrays["is_option"] = self.is_option[:len(self.symbols)]
+        state = {
+            "symbols": "".join(self.symbols),
+            "pending": self.pending,
+            "leaves_count": int(self.leaves_count),
+            "total_nodes": int(self.total_nodes),
+            "reweight_all": bool(self._reweight_all or self._dirty),
+        }
+        return arrays, state
+
+    @classmethod
+    def from_arrays(cls, arrays, state):
+        """Rebuilds a tree around existing arrays (for example views into a memory map) without copying them."""
+        tree = cls.__new__(cls)
+        for name in cls.NODE_ARRAYS + ("children", "is_option"):
+            setattr(tree, name, arrays[name])
+        tree.symbols = list(state["symbols"])
+        tree._symbol_ids = {char: i for i, char in enumerate(tree.symbols)}
+        tree.node_count = len(tree.parent)
+        tree.leaves_count = state["leaves_count"]
+        tree.total_nodes = state["total_nodes"]
+        tree.pending = state["pending"]
+        tree._dirty = set()
+        tree._reweight_all = state["reweight_all"]
+        tree._transition_table = None
+        return tree
+
+    def copy(self):
+        """Independent copy of the tree; arrays are copied with their spare capacity."""
+        tree = CompactLempelZivTree.__new__(CompactLempelZivTree)
+        tree.__dict__.update(self.__dict__)
+        for name in self.NODE_ARRAYS + ("children", "is_option"):
+            setattr(tree, name, getattr(self, name).copy())
+        tree.symbols = list(self.symbols)
+        tree._symbol_ids = dict(self._symbol_ids)
+        tree._dirty = set(self._dirty)
+        return tree
+
+    @classmethod
+    def from_tree(cls, source):
+        """Converts a weighted LempelZivTree; the result scores exactly like the source."""
+        nodes = [source.root]
+        parents = [-1]
+        for index, node in enumerate(nodes):
+            for child in node.children.values():
+                if child.total_descendants > 0:  # Option leaves stay implicit
+                    nodes.append(child)
+                    parents.append(index)
+        # Options offered up front (LempelZivTree.add_options) may not label any phrase node yet
+        symbols = sorted({node.value for node in nodes[1:]} | source.options)
+        tree = cls(capacity=len(nodes), alphabet_capacity=max(len(symbols), 1))
+        tree.symbols = symbols
+        tree._symbol_ids = {char: i for i, char in enumerate(symbols)}
+        for char in source.options:
+            tree.is_option[tree._symbol_ids[char]] = True
+
+        for node_id, (node, parent) in enumerate(zip(nodes, parents)):
+            if node_id > 0:
+                sym = tree._symbol_ids[node.value]
+                tree.children[parent, sym] = node_id
+                tree.parent[node_id] = parent
+                tree.symbol[node_id] = sym
+                tree.depth[node_id] = tree.depth[parent] + 1
+                tree.expanded[node_id] = tree.expanded[parent] and tree.is_option[sym]
+            tree.total_descendants[node_id] = node.total_descendants
+            tree.leaf_count[node_id] = node.leaf_count
+            tree.weight[node_id] = node.weight
+            tree.log_weight[node_id] = node.log_weight
+            # Same expression LempelZivTree uses for the log-weight of an option leaf
+            tree.option_log_weight[node_id] = math.log(1 / node.leaf_count) if node.leaf_count > 0 else 0.0
+        tree.node_count = len(nodes)
+        tree.leaves_count = source.leaves_count
+        tree.total_nodes = source.total_nodes
+        tree.pending = source.pending
+        tree._reweight_all = source._reweight_all or bool(source._dirty)
+        return tree
+
+    @property
+    def options(self):
+        return {self.symbols[i] for i in np.flatnonzero(self.is_option[:len(self.symbols)])}
+
+    @property
+    def option_count(self):
+        return int(self.is_option.sum())
+
+    def _symbol_id(self, char):
+        sym = self._symbol_ids.get(char)
+        if sym is None:
+            sym = len(self.symbols)
+            self.symbols.append(char)
+            self._symbol_ids[char] = sym
+            if sym == self.children.shape[1]:
+                self._grow_alphabet()
+        return sym
+
+    def add_options(self, chars):
+        """LempelZivTree.add_options; the new options are implicit leaves, so no node is added.
+
+        Returns the number of options added.
+        """
+        # Sorted so the symbol ids do not depend on the iteration order of chars
+        new = sorted(char for char in set(chars)
+                     if char not in self._symbol_ids or not self.is_option[self._symbol_ids[char]])
+        if not new:
+            return 0
+        for char in new:
+            sym = self._symbol_id(char)  # May grow is_option
+            self.is_option[sym] = True
+        self._reweight_all = True
+        self.calculate_weights()
+        return len(new)
+
+    def _grow_alphabet(self):
+        width = self.children.shape[1]
+        children = np.full((self.children.shape[0], max(width * 2, 8)), -1, dtype=np.int32)
+        children[:, :width] = self.children
+        self.children = children
+        self.is_option = np.concatenate([self.is_option, np.zeros(children.shape[1] - width, dtype=bool)])
+
+    def _grow_nodes(self):
+        capacity = len(self.parent) * 2
+        children = np.full((capacity, self.children.shape[1]), -1, dtype=np.int32)
+        children[:self.node_count] = self.children[:self.node_count]
+        self.children = children
+        for name, fill in (("parent", -1), ("symbol", -1), ("depth", 0), ("total_descendants", 0),
+                           ("leaf_count", 0), ("weight", 0.0), ("log_weight", 0.0), ("option_log_weight", 0.0),
+                           ("expanded", False)):
+            old = getattr(self, name)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:self.node_count] = old[:self.node_count]
+            setattr(self, name, new)
+
+    def _implicit_leaves(self, node):
+        if not self.expanded[node]:
+            return 0
+        width = len(self.symbols)
+        option_children = np.count_nonzero((self.children[node, :width] >= 0) & self.is_option[:width])
+        return self.option_count - option_children
+
+    def _add_node(self, parent, char):
+        sym = self._symbol_id(char)
+        if parent == 0 and not self.is_option[sym]:
+            self.is_option[sym] = True
+            self._reweight_all = True  # A new option adds a leaf under every expanded node
+        parent_was_leaf = not (self.children[parent] >= 0).any() and self._implicit_leaves(parent) == 0
+        promoted = bool(self.expanded[parent] and self.is_option[sym])
+
+        if self.node_count == len(self.parent):
+            self._grow_nodes()
+        node = self.node_count
+        self.node_count += 1
+        self.total_nodes += 1
+        self.children[parent, sym] = node
+        self.parent[node] = parent
+        self.symbol[node] = sym
+        self.depth[node] = self.depth[parent] + 1
+        self.total_descendants[node] = 1
+        self.expanded[node] = promoted
+        if self._reweight_all:
+            return node
+
+        # Keep the leaf counts along the path current so calculate_weights can stay local
+        if promoted:
+            # The implicit option leaf turns into a node carrying every option
+            self.leaf_count[node] = self.option_count
+            delta = self.option_count - 1
+            self.leaves_count += delta
+            self._dirty.add(node)
+        else:
+            self.leaf_count[node] = 1
+            delta = 0 if parent_was_leaf else 1
+        self._dirty.add(parent)
+        ancestor = parent
+        while delta and ancestor >= 0:
+            self.leaf_count[ancestor] += delta
+            self._dirty.add(int(ancestor))
+            ancestor = self.parent[ancestor]
+        return node
+
+    def _undo_pending(self):
+        # Takes back the visit counts of the unfinished phrase so it can be parsed again with new input
+        current = 0
+        for char in self.pending:
+            current = self.children[current, self._symbol_ids[char]]
+            self.total_descendants[current] -= 1
+        pending, self.pending = self.pending, ""
+        return pending
+
+    def build_tree(self, s):
+        """Continues the LZ78 parse with s, exactly like LempelZivTree.build_tree."""
+        self._transition_table = None
+        s = self._undo_pending() + s
+        symbol_ids = self._symbol_ids
+        children = self.children
+        i = 0
+        while i < len(s):
+            current = 0
+            j = i
+            path = []
+            # Longest prefix that is already in the tree
+            while j < len(s):
+                sym = symbol_ids.get(s[j])
+                child = -1 if sym is None else children[current, sym]
+                if child < 0:
+                    break
+                current = child
+                path.append(current)
+                j += 1
+            self.total_descendants[np.asarray(path, dtype=np.intp)] += 1
+            if j == len(s):
+                # The input ended inside an existing phrase; keep it open for the next call
+                self.pending = s[i:]
+                break
+            self._add_node(current, s[j])
+            children = self.children  # May have been reallocated
+            i = j + 1
+
+    def _levels(self):
+        # Node ids grouped by depth, shallowest first
+        depth = self.depth[:self.node_count]
+        order = np.argsort(depth, kind="stable")
+        bounds = np.cumsum(np.bincount(depth))[:-1]
+        return np.split(order, bounds)
+
+    def calculate_weights(self):
+        self._transition_table = None
+        if not self._reweight_all:
+            self._reweight_dirty()
+            return
+        self._reweight_all = False
+        self._dirty.clear()
+
+        n = self.node_count
+        parent = self.parent[1:n]
+        symbol = self.symbol[1:n]
+        levels = self._levels()
+
+        # Nodes reached from the root through options only carry all options as children
+        expanded = self.expanded[:n]
+        expanded[0] = True
+        for level in levels[1:]:
+            expanded[level] = expanded[self.parent[level]] & self.is_option[self.symbol[level]]
+
+        option_children = np.bincount(parent, weights=self.is_option[symbol], minlength=n).astype(np.int64)
+        implicit = np.where(expanded, self.option_count - option_children, 0)
+        self.leaves_count = int(implicit.sum())
+
+        # Post-order accumulation, deepest level first
+        leaf_count = self.leaf_count[:n]
+        leaf_count[:] = implicit
+        for level in reversed(levels):
+            leaf_count[level] = np.maximum(leaf_count[level], 1)
+            if level[0] != 0:
+                np.add.at(leaf_count, self.parent[level], leaf_count[level])
+
+        self.weight[1:n] = leaf_count[1:] / leaf_count[parent]
+        self.weight[0] = leaf_count[0] / self.leaves_count if self.leaves_count > 0 else 0
+        with np.errstate(divide="ignore"):
+            self.log_weight[:n] = np.log(self.weight[:n])
+            self.option_log_weight[:n] = np.log(1 / leaf_count)
+
+    def _reweight_dirty(self):
+        self.weight[0] = self.leaf_count[0] / self.leaves_count if self.leaves_count > 0 else 0
+        with np.errstate(divide="ignore"):
+            self.log_weight[0] = np.log(self.weight[0])
+        for node in self._dirty:
+            kids = self.children[node]
+            kids = kids[kids >= 0]
+            self.weight[kids] = self.leaf_count[kids] / self.leaf_count[node]
+            self.log_weight[kids] = np.log(self.weight[kids])
+            self.option_log_weight[node] = np.log(1 / self.leaf_count[node])
+        self._dirty.clear()
+
+    def calculate_sequence_probability(self, s):
+        symbol_ids = self._symbol_ids
+        current = 0  # -1 stands for an implicit option leaf, which has no children
+        probability = 10000.0
+        for char in s:
+            sym = symbol_ids.get(char)
+            if sym is None:
+                current = 0
+                continue
+            child = self.children[current, sym] if current >= 0 else -1
+            if child >= 0:
+                current = child
+                probability *= self.weight[child]
+            elif current >= 0 and self.expanded[current] and self.is_option[sym]:
+                probability *= 1 / self.leaf_count[current]
+                current = -1
+            else:
+                # Symbol not under the current node: restart from the root
+                current = self.children[0, sym]
+                if current >= 0:
+                    probability *= self.weight[current]
+                elif self.is_option[sym]:
+                    current = -1  # The root's implicit option leaf, free after a miss as in LempelZivTree
+                else:
+                    current = 0
+        return float(probability)
+
+    def calculate_sequence_log_probability(self, s, per_symbol=False):
+        """Log-space calculate_sequence_probability, same contract as LempelZivTree's."""
+        symbol_ids = self._symbol_ids
+        current = 0
+        total = 0.0
+        for char in s:
+            sym = symbol_ids.get(char)
+            if sym is None:
+                current = 0
+                continue
+            child = self.children[current, sym] if current >= 0 else -1
+            if child >= 0:
+                current = child
+                total += self.log_weight[child]
+            elif current >= 0 and self.expanded[current] and self.is_option[sym]:
+                total += self.option_log_weight[current]
+                current = -1
+            else:
+                current = self.children[0, sym]
+                if current >= 0:
+                    total += self.log_weight[current]
+                elif self.is_option[sym]:
+                    current = -1
+                else:
+                    current = 0
+        if per_symbol:
+            return float(total / len(s)) if s else 0.0
+        return float(INITIAL_LOG + total)
+
+    def transition_table(self):
+        if self._transition_table is None:
+            self._transition_table = self._build_transition_table()
+        return self._transition_table
+
+    def _build_transition_table(self):
+        # States are the node ids plus one shared state for the implicit option leaves
+        n = self.node_count
+        leaf_state = n
+        order = np.argsort([ord(char) for char in self.symbols], kind="stable").astype(np.intp)
+        children = self.children[:n, order]
+        present = children >= 0
+
+        # A miss moves to the root's child: a node, or an implicit option leaf (at no cost)
+        miss_state = np.where(present[0], children[0], np.where(self.is_option[order], leaf_state, 0))
+        miss_factor = np.where(present[0], self.weight[children[0]], 1.0)
+        miss_log_factor = np.where(present[0], self.log_weight[children[0]], 0.0)
+        next_state = np.where(present, children, miss_state)
+        factor = np.where(present, self.weight[children], miss_factor)
+        log_factor = np.where(present, self.log_weight[children], miss_log_factor)
+
+        implicit = self.expanded[:n, None] & self.is_option[order][None, :] & ~present
+        next_state[implicit] = leaf_state
+        option_weight = 1 / np.maximum(self.leaf_count[:n], 1)
+        factor = np.where(implicit, option_weight[:, None], factor)
+        log_factor = np.where(implicit, self.option_log_weight[:n, None], log_factor)
+
+        next_state = np.vstack([next_state, miss_state])
+        factor = np.vstack([factor, miss_factor])
+        log_factor = np.vstack([log_factor, miss_log_factor])
+        alphabet = [ord(self.symbols[i]) for i in order]
+        return TransitionTable.from_rows(alphabet, next_state, factor, log_factor)
+
+    def calculate_sequence_probabilities(self, trips, space=PROBABILITY):
+        """Scores a batch of trip strings (or a TripBatch) at once, in the given score space."""
+        if self._transition_table is None and prefers_walk(trips, self.total_nodes):
+            return walk_trips(self, trips, space)
+        return self.transition_table().score(as_trip_batch(trips), space)
+
+    def print_summary(self):
+        print(f"Total number of leaves: {self.leaves_count}")
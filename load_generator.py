@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from create_file_process import TRIP_COLUMNS, create_vehicle_profiles, load_csv, process_dataframe
+from verification_service import TripVerificationService, start_server
+
+
+async def _client(socket_path, requests, latencies):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        for request in requests:
+            started = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            await reader.readline()
+            latencies.append(time.perf_counter() - started)
+    finally:
+        writer.close()
+
+
+async def run_load(vehicle_profiles, requests, clients: int = 64, **service_options) -> dict:
+    """Serves vehicle_profiles on a temporary Unix socket and sends requests from concurrent clients.
+
+    Each client sends its share of the requests one at a time and waits for every reply.
+    Returns throughput, latency percentiles and the service's batch statistics.
+    """
+    service = TripVerificationService(vehicle_profiles, **service_options)
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, "verify.sock")
+        server = await start_server(service, socket_path)
+        latencies = []
+        started = time.perf_counter()
+        async with server:
+            await asyncio.gather(*[_client(socket_path, requests[i::clients], latencies) for i in range(clients)])
+            elapsed = time.perf_counter() - started
+            await service.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "requests": len(requests),
+        "clients": clients,
+        "seconds": elapsed,
+        "requests_per_second": len(requests) / elapsed,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p99_ms": float(np.percentile(latencies, 99)),
+        "mean_batch_size": service.requests / max(service.batches, 1),
+        "accepted_trips": service.accepted_trips,
+    }
+
+
+def main(csv_file_path: str = 'data/Trips.csv', n_requests: int = 5000, clients: int = 64):
+    """Compares one-at-a-time verification with micro-batching, for trip strings and raw records."""
+    df = load_csv(csv_file_path)
+    rows = df[TRIP_COLUMNS].sample(n=n_requests, replace=True, random_state=42)
+    records = [{"vehicle_id": str(record.pop('vehicle_id')), "record": record} for record in rows.to_dict('records')]
+    df = process_dataframe(df)
+    rows = df.sample(n=n_requests, replace=True, random_state=42)
+    trips = [{"vehicle_id": str(vehicle_id), "trip": trip}
+             for vehicle_id, trip in zip(rows['vehicle_id'], rows['trip_description'])]
+
+    for kind, requests in (("trip strings", trips), ("raw records", records)):
+        for label, options in (("one at a time", {"max_batch_size": 1}), ("micro-batched", {})):
+            # Fresh profiles for every run, since accepted trips are written back
+            vehicle_profiles = create_vehicle_profiles(df)
+            vehicle_profiles.snapshots = True  # Write-back publishes new versions beside the scored ones
+            stats = asyncio.run(run_load(vehicle_profiles, requests, clients, **options))
+            print(f"{kind}, {label}: {stats['requests_per_second']:.0f} requests/s, "
+                  f"p50 {stats['latency_p50_ms']:.2f} ms, p99 {stats['latency_p99_ms']:.2f} ms, "
+                  f"mean batch {stats['mean_batch_size']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,125 @@
-from create_file_process import create_file
-from vehicle_profiles import VehicleProfiles
+import argparse
+import sys
 
+from batch_scoring import LETTERS, PROBABILITY, SCORE_SPACES, TRIP_ENCODINGS
+from report_formats import EXCEL, REPORT_FORMATS
 
-def main():
-    # Start the process of creating the file
-    create_file()
-    print("Process completed.")
+# The subcommands import what they use when they run: score and verify only need the profile and
+# scoring modules, while pandas, openpyxl and matplotlib come with build, calibrate and report.
+DEFAULT_CSV = 'data/Trips.csv'
+
+
+def build(args):
+    from create_file_process import build_profile_store
+    build_profile_store(args.csv, args.store, args.score_space, args.workers, args.chunk_size,
+                        not args.no_history, args.node_budget, args.trip_encoding)
+
+
+def update(args):
+    from create_file_process import update_profile_store
+    update_profile_store(args.csv, args.store)
+
+
+def calibrate(args):
+    from create_file_process import STALE_SAMPLE_FRACTION, calibrate_profile_store
+    stale_fraction = STALE_SAMPLE_FRACTION if args.stale_fraction is None else args.stale_fraction
+    calibrate_profile_store(args.csv, args.store, args.workers, not args.full, stale_fraction)
+
+
+def report(args):
+    from create_file_process import create_file
+    create_file(args.score_space, args.workers, args.store, args.chunk_size, not args.no_plot, args.report_format,
+                args.report_path, trip_encoding=args.trip_encoding, csv_file_path=args.csv, interactive=False)
+
+
+def score(args):
+    from trip_checks import score_trips
+    from vehicle_profiles import VehicleProfiles
+    trips = args.trips or [line.rstrip("\n") for line in sys.stdin if line.strip()]
+    with VehicleProfiles.load(args.store, memory_budget=args.memory_budget) as vehicle_profiles:
+        results = score_trips(vehicle_profiles, args.vehicle_id, trips)
+    for trip, (probability, threshold, accepted) in zip(trips, results):
+        print(f"{trip}\t{probability}\t{threshold}\t{'accepted' if accepted else 'rejected'}")
+
+
+def verify(args):
+    from trip_checks import check_trips_from_store
+    check_trips_from_store(args.store, args.memory_budget)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vehicle trip profiles: build, calibrate, report and score trips. "
+                                                 "Without a command, runs the whole pipeline on data/Trips.csv "
+                                                 "and starts the trip prompt.")
+    commands = parser.add_subparsers(dest="command")
+
+    command = commands.add_parser("build", help="build profiles from a trips CSV into a profile store")
+    command.add_argument("--csv", default=DEFAULT_CSV)
+    command.add_argument("--store", required=True, help="profile store to write")
+    command.add_argument("--score-space", choices=SCORE_SPACES, default=PROBABILITY)
+    command.add_argument("--workers", type=int, default=1)
+    command.add_argument("--chunk-size", type=int, help="stream the CSV in chunks of this many rows")
+    command.add_argument("--no-history", action="store_true", help="keep the trees without the raw trip strings")
+    command.add_argument("--node-budget", type=int, help="maximum phrase nodes per tree")
+    command.add_argument("--trip-encoding", choices=TRIP_ENCODINGS, default=LETTERS, help="see trip_tokens")
+    command.set_defaults(run=build)
+
+    command = commands.add_parser("update", help="add the trips of a CSV to the profiles of a profile store")
+    command.add_argument("--csv", required=True, help="new trips, in the Trips.csv format")
+    command.add_argument("--store", required=True, help="profile store to update")
+    command.set_defaults(run=update)
+
+    command = commands.add_parser("calibrate", help="calibrate the thresholds of a profile store against a CSV; "
+                                                    "only vehicles that changed since their last calibration")
+    command.add_argument("--csv", default=DEFAULT_CSV)
+    command.add_argument("--store", required=True, help="profile store to update")
+    command.add_argument("--workers", type=int, default=1)
+    command.add_argument("--full", action="store_true", help="recalibrate every vehicle")
+    # No default here: create_file_process.STALE_SAMPLE_FRACTION applies, and importing it would load pandas
+    command.add_argument("--stale-fraction", type=float,
+                         help="redo a vehicle once the pool of negative trips changed by more than this fraction "
+                              "(default: STALE_SAMPLE_FRACTION of create_file_process)")
+    command.set_defaults(run=calibrate)
+
+    command = commands.add_parser("report", help="run the pipeline and export the report (no trip prompt)")
+    command.add_argument("--csv", default=DEFAULT_CSV)
+    command.add_argument("--store", help="also save the calibrated profiles to this profile store")
+    command.add_argument("--score-space", choices=SCORE_SPACES, default=PROBABILITY)
+    command.add_argument("--workers", type=int, default=1)
+    command.add_argument("--chunk-size", type=int, help="stream the CSV in chunks of this many rows")
+    command.add_argument("--report-format", choices=REPORT_FORMATS, default=EXCEL, help="see report_writers")
+    command.add_argument("--report-path", help="defaults to data/output_with_roc.xlsx or data/report")
+    command.add_argument("--no-plot", action="store_true", help="calibrate without ROC figures (vectorized)")
+    command.add_argument("--trip-encoding", choices=TRIP_ENCODINGS, default=LETTERS, help="see trip_tokens")
+    command.set_defaults(run=report)
+
+    command = commands.add_parser("score", help="score trips against one vehicle of a profile store")
+    command.add_argument("--store", required=True)
+    command.add_argument("--memory-budget", type=int, help="bytes of profiles kept loaded")
+    command.add_argument("vehicle_id")
+    command.add_argument("trips", nargs="*", help="trip strings (read one per line from stdin if none)")
+    command.set_defaults(run=score)
+
+    command = commands.add_parser("verify", help="interactive trip prompt on a profile store")
+    command.add_argument("--store", required=True)
+    command.add_argument("--memory-budget", type=int, help="bytes of profiles kept loaded")
+    command.set_defaults(run=verify)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        from create_file_process import create_file
+
+        # Start the process of creating the file
+        create_file()
+        print("Process completed.")
+        return 0
+    try:
+        args.run(args)
+    except ValueError as error:
+        print(error)
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
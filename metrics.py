@@ -0,0 +1,163 @@
+import contextlib
+import cProfile
+import json
+import os
+import time
+
+# Stage timers, counters and gauges for the pipeline. Disabled by default: every call then returns
+# at its first line, and stage() hands back one shared no-op context manager.
+
+_NO_STAGE = contextlib.nullcontext()
+
+
+class JsonLinesSink:
+    """Appends every snapshot to a file as one JSON object per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, snapshot: dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+
+class PrometheusTextSink:
+    """Writes the latest snapshot in the Prometheus text exposition format (for node_exporter's textfile collector).
+
+    The file is written next to its final path and renamed, so a scrape never reads half of it.
+    """
+
+    def __init__(self, path: str, prefix: str = "vehicle_profiles_"):
+        self.path = path
+        self.prefix = prefix
+
+    def _lines(self, snapshot):
+        for name, value in snapshot["counters"].items():
+            yield f"# TYPE {self.prefix}{name}_total counter"
+            yield f"{self.prefix}{name}_total {value}"
+        for name, timer in snapshot["timers"].items():
+            yield f"# TYPE {self.prefix}{name}_seconds summary"
+            yield f"{self.prefix}{name}_seconds_sum {timer['seconds']}"
+            yield f"{self.prefix}{name}_seconds_count {timer['count']}"
+        for name, values in snapshot["gauges"].items():
+            yield f"# TYPE {self.prefix}{name} gauge"
+            for label, value in values.items():
+                if label is None or label == "":
+                    yield f"{self.prefix}{name} {value}"
+                else:
+                    yield f'{self.prefix}{name}{{vehicle_id="{label}"}} {value}'
+
+    def write(self, snapshot: dict):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as f:
+            f.write("\n".join(self._lines(snapshot)) + "\n")
+        os.replace(temporary, self.path)
+
+
+class Metrics:
+    """Timers (total seconds and count per name), counters and gauges (per vehicle or global).
+
+    Enable with enable(); flush() sends a snapshot to every sink. profile_stages names the stages
+    that also run under cProfile; each stage keeps one profiler over all its runs (e.g. the score
+    stage of every vehicle), and disable() dumps it once to profile_dir/<stage>.prof.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.profile_stages = set()
+        self.profile_dir = "."
+        self.profilers = {}  # Stage name -> cProfile.Profile accumulated since enable
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def enable(self, sinks=(), profile_stages=(), profile_dir: str = None):
+        self.enabled = True
+        self.sinks = list(sinks)
+        self.profile_stages = set(profile_stages)
+        self.profilers = {}
+        if profile_dir is not None:
+            self.profile_dir = profile_dir
+
+    def disable(self):
+        """Stops recording and dumps the statistics of every profiled stage."""
+        self.dump_profiles()
+        self.enabled = False
+        self.sinks = []
+        self.profile_stages = set()
+        self.profilers = {}
+
+    def dump_profiles(self):
+        for name, profiler in self.profilers.items():
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
+
+    def add_time(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        timer = self.timers.setdefault(name, [0.0, 0])
+        timer[0] += seconds
+        timer[1] += 1
+
+    def increment(self, name: str, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value, vehicle_id=None):
+        if not self.enabled:
+            return
+        self.gauges.setdefault(name, {})[vehicle_id] = value
+
+    def stage(self, name: str):
+        """Context manager timing a block under name (and profiling it when name is in profile_stages)."""
+        if not self.enabled:
+            return _NO_STAGE
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        profiler = None
+        if name in self.profile_stages:
+            profiler = self.profilers.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+            if profiler is not None:
+                profiler.disable()
+
+    def record_tree(self, vehicle_id, profile: dict):
+        """Size gauges of one vehicle's profile: tree nodes, leaves and length of the trip history."""
+        if not self.enabled:
+            return
+        tree = profile["tree"]
+        self.set_gauge("tree_nodes", tree.total_nodes, vehicle_id)
+        self.set_gauge("tree_leaves", tree.leaves_count, vehicle_id)
+        self.set_gauge("trip_string_chars", len(profile.get("trip_string", "")), vehicle_id)
+
+    def snapshot(self) -> dict:
+        """Everything recorded so far; scoring throughput is derived from the score timer and counter."""
+        timers = {name: {"seconds": seconds, "count": count} for name, (seconds, count) in self.timers.items()}
+        gauges = {name: dict(values) for name, values in self.gauges.items()}
+        scored, seconds = self.counters.get("trips_scored", 0), self.timers.get("score", [0.0])[0]
+        if scored and seconds > 0:
+            gauges["scoring_trips_per_second"] = {None: scored / seconds}
+        return {"timestamp": time.time(), "timers": timers, "counters": dict(self.counters), "gauges": gauges}
+
+    def flush(self):
+        if not self.enabled:
+            return
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+
+# The process-wide instance the pipeline reports to
+metrics = Metrics()
@@ -0,0 +1,298 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from lempel_ziv78_compact import CompactLempelZivTree
+
+# File layout: fixed prefix (magic, format version, JSON header length), the JSON header,
+# then the data section with every array aligned to _ALIGNMENT bytes. The header holds the
+# metadata and an index of vehicle id -> [offset, length] of the vehicle's own JSON entry
+# (threshold, version, calibration, array offsets), which sits in the data section, so opening
+# a store does not parse every vehicle's entry. Offsets are relative to the data section.
+STORE_MAGIC = b"VPSTORE\0"
+STORE_VERSION = 2
+_PREFIX = struct.Struct("<8sIQ")
+_ALIGNMENT = 64
+_NODE_BYTES = 400  # Rough resident size of one LempelZivTree node (object, dicts, floats)
+
+
+def _padding(offset):
+    return -offset % _ALIGNMENT
+
+
+def write_store(path, profiles, metadata=None):
+    """Writes profiles ({vehicle_id: {"trip_string", "tree", "threshold"}}) to a store file.
+
+    Profiles without a trip_string (kept without history) are stored without one. The tree version
+    and calibration record of a profile (see VehicleProfiles.record_calibration) go in its entry.
+
+    Trees are written in CompactLempelZivTree form (LempelZivTree profiles are converted).
+    The file is written next to path and moved into place, so readers never see a partial store.
+    """
+    blobs = []
+    offset = 0
+
+    def add_array(array):
+        nonlocal offset
+        array = np.ascontiguousarray(array)
+        offset += _padding(offset)
+        entry = [offset, array.dtype.str, list(array.shape)]
+        blobs.append((offset, array))
+        offset += array.nbytes
+        return entry
+
+    vehicles = {}
+    for vehicle_id, profile in profiles.items():
+        tree = profile["tree"]
+        if not isinstance(tree, CompactLempelZivTree):
+            tree = CompactLempelZivTree.from_tree(tree)
+        arrays, state = tree.to_arrays()
+        trip_string = profile.get("trip_string")
+        if trip_string is not None:
+            trip_string = add_array(np.frombuffer(trip_string.encode("utf-8"), dtype=np.uint8))
+        entry = json.dumps({
+            "threshold": float(profile["threshold"]),
+            "version": int(profile.get("version", 0)),
+            "calibration": profile.get("calibration"),
+            "trip_string": trip_string,
+            "tree": {"state": state, "arrays": {name: add_array(array) for name, array in arrays.items()}},
+        }).encode("utf-8")
+        vehicles[str(vehicle_id)] = [add_array(np.frombuffer(entry, dtype=np.uint8))[0], len(entry)]
+
+    header = json.dumps({"metadata": metadata or {}, "vehicles": vehicles}).encode("utf-8")
+    data_start = _PREFIX.size + len(header)
+    data_start += _padding(data_start)
+
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(_PREFIX.pack(STORE_MAGIC, STORE_VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * (data_start - f.tell()))
+        for blob_offset, array in blobs:
+            f.write(b"\0" * (data_start + blob_offset - f.tell()))
+            f.write(array.tobytes())
+    os.replace(temporary_path, path)
+
+
+class ProfileStore:
+    """Read access to a store file written by write_store.
+
+    With mmap=True the data section is memory-mapped copy-on-write: opening only parses the
+    header (metadata and the vehicle index) and each vehicle's entry is read when it is loaded,
+    tree arrays are views into the mapping that several processes share page by page,
+    and later updates to a loaded tree stay private to the process.
+    """
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with open(path, "rb") as f:
+            prefix = f.read(_PREFIX.size)
+            if len(prefix) < _PREFIX.size:
+                raise ValueError(f"{path} is not a profile store")
+            magic, version, header_length = _PREFIX.unpack(prefix)
+            if magic != STORE_MAGIC:
+                raise ValueError(f"{path} is not a profile store")
+            if version != STORE_VERSION:
+                raise ValueError(f"Profile store {path} has format version {version}, expected {STORE_VERSION}; "
+                                 f"rebuild it")
+            header = json.loads(f.read(header_length))
+        self.data_start = _PREFIX.size + header_length + _padding(_PREFIX.size + header_length)
+        self.metadata = header["metadata"]
+        self._index = header["vehicles"]
+        if mmap and os.path.getsize(path) > self.data_start:
+            self._data = np.memmap(path, dtype=np.uint8, mode="c", offset=self.data_start)
+        else:
+            self._data = np.fromfile(path, dtype=np.uint8, offset=self.data_start)
+
+    @property
+    def vehicle_ids(self):
+        return list(self._index)
+
+    def __contains__(self, vehicle_id):
+        return vehicle_id in self._index
+
+    def _entry(self, vehicle_id):
+        offset, length = self._index[vehicle_id]
+        return json.loads(self._data[offset:offset + length].tobytes())
+
+    def _array(self, entry):
+        offset, dtype, shape = entry
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        return self._data[offset:offset + count * dtype.itemsize].view(dtype).reshape(shape)
+
+    def load_profile(self, vehicle_id):
+        entry = self._entry(vehicle_id)
+        arrays = {name: self._array(array) for name, array in entry["tree"]["arrays"].items()}
+        profile = {
+            "tree": CompactLempelZivTree.from_arrays(arrays, entry["tree"]["state"]),
+            "threshold": entry["threshold"],
+            "version": entry.get("version", 0),  # Stores written before versions were kept have none
+        }
+        if entry.get("calibration") is not None:
+            profile["calibration"] = entry["calibration"]
+        if entry["trip_string"] is not None:
+            profile["trip_string"] = self._array(entry["trip_string"]).tobytes().decode("utf-8")
+        return profile
+
+    def load_profiles(self):
+        return {vehicle_id: self.load_profile(vehicle_id) for vehicle_id in self._index}
+
+
+def profile_nbytes(profile) -> int:
+    """Approximate memory held by a profile: tree arrays (and cached scoring table) plus trip history."""
+    tree = profile["tree"]
+    nbytes = sum(value.nbytes for value in vars(tree).values() if isinstance(value, np.ndarray))
+    if not isinstance(tree, CompactLempelZivTree):
+        nbytes += _NODE_BYTES * (tree.total_nodes + 1)
+    table = getattr(tree, "_transition_table", None)
+    if table is not None:
+        nbytes += sum(value.nbytes for value in vars(table).values() if isinstance(value, np.ndarray))
+    return nbytes + len(profile.get("trip_string", ""))
+
+
+class ProfileCache(MutableMapping):
+    """Profiles of a store file, loaded on first access and kept within a memory budget.
+
+    Works as the profiles dict of VehicleProfiles. Profiles are read from the store when first
+    looked up and the least recently used ones are dropped once the resident profiles take more
+    than memory_budget bytes (see profile_nbytes). A changed profile must be reported with
+    mark_dirty; when a dirty profile is evicted it is written to a spill directory and read back
+    from there next time. The spill files are working storage: save the profiles with write_store
+    (VehicleProfiles.save) to persist them, and close() removes the spill directory. Use the cache
+    as a context manager to close it; a spill directory it created is also removed when the cache
+    is garbage collected or the interpreter exits.
+    """
+
+    def __init__(self, path, memory_budget: int, mmap: bool = True, spill_dir: str = None):
+        self.store = ProfileStore(path, mmap)
+        self.memory_budget = memory_budget
+        self.mmap = mmap
+        self._spill_dir = spill_dir
+        self._owns_spill_dir = spill_dir is None
+        self._vehicle_ids = dict.fromkeys(self.store.vehicle_ids)  # Ordered set of every vehicle
+        self._spilled = set()
+        self._resident = OrderedDict()  # vehicle_id -> profile, least recently used first
+        self._sizes = {}
+        self._dirty = set()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self._remove_spill_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _spill_path(self, vehicle_id):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="profiles-", dir=os.path.dirname(os.path.abspath(self.store.path)))
+            self._remove_spill_dir = weakref.finalize(self, shutil.rmtree, self._spill_dir, ignore_errors=True)
+        return os.path.join(self._spill_dir, f"{vehicle_id}.vps")
+
+    def _load(self, vehicle_id):
+        if vehicle_id in self._spilled:
+            return ProfileStore(self._spill_path(vehicle_id), self.mmap).load_profile(vehicle_id)
+        return self.store.load_profile(vehicle_id)
+
+    def __getitem__(self, vehicle_id):
+        profile = self._resident.get(vehicle_id)
+        if profile is not None:
+            self.hits += 1
+            self._resident.move_to_end(vehicle_id)
+            return profile
+        if vehicle_id not in self._vehicle_ids:
+            raise KeyError(vehicle_id)
+        self.misses += 1
+        profile = self._load(vehicle_id)
+        self._add(vehicle_id, profile)
+        return profile
+
+    def __setitem__(self, vehicle_id, profile):
+        self._vehicle_ids[vehicle_id] = None
+        self._dirty.add(vehicle_id)
+        self._add(vehicle_id, profile)
+
+    def __delitem__(self, vehicle_id):
+        del self._vehicle_ids[vehicle_id]
+        if vehicle_id in self._resident:
+            del self._resident[vehicle_id]
+            self.resident_bytes -= self._sizes.pop(vehicle_id)
+        self._dirty.discard(vehicle_id)
+        self._spilled.discard(vehicle_id)
+
+    def __contains__(self, vehicle_id):
+        return vehicle_id in self._vehicle_ids
+
+    def __iter__(self):
+        return iter(list(self._vehicle_ids))
+
+    def __len__(self):
+        return len(self._vehicle_ids)
+
+    def _add(self, vehicle_id, profile):
+        if vehicle_id in self._resident:
+            self.resident_bytes -= self._sizes[vehicle_id]
+        self._resident[vehicle_id] = profile
+        self._resident.move_to_end(vehicle_id)
+        self._sizes[vehicle_id] = profile_nbytes(profile)
+        self.resident_bytes += self._sizes[vehicle_id]
+        self._evict()
+
+    def mark_dirty(self, vehicle_id):
+        """Records that a resident profile changed: it is written back before eviction and resized."""
+        self._dirty.add(vehicle_id)
+        if vehicle_id in self._resident:
+            self._add(vehicle_id, self._resident[vehicle_id])
+
+    def _write_back(self, vehicle_id, profile):
+        write_store(self._spill_path(vehicle_id), {vehicle_id: profile}, self.store.metadata)
+        self._spilled.add(vehicle_id)
+        self._dirty.discard(vehicle_id)
+        self.writebacks += 1
+
+    def _evict(self):
+        # The most recently used profile always stays, even when it alone exceeds the budget
+        while self.resident_bytes > self.memory_budget and len(self._resident) > 1:
+            vehicle_id, profile = self._resident.popitem(last=False)
+            self.resident_bytes -= self._sizes.pop(vehicle_id)
+            if vehicle_id in self._dirty:
+                self._write_back(vehicle_id, profile)
+            self.evictions += 1
+
+    def flush(self):
+        """Writes every dirty resident profile to the spill directory."""
+        for vehicle_id in list(self._dirty):
+            self._write_back(vehicle_id, self._resident[vehicle_id])
+
+    def close(self):
+        """Drops the resident profiles and removes the spill files (unsaved changes are lost)."""
+        self._resident.clear()
+        self._sizes.clear()
+        self.resident_bytes = 0
+        if self._owns_spill_dir and self._spill_dir is not None:
+            self._remove_spill_dir()
+            self._spill_dir = None
+        else:
+            for vehicle_id in self._spilled:
+                os.remove(self._spill_path(vehicle_id))
+        self._spilled.clear()
+        self._dirty.clear()
+
+    def info(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "writebacks": self.writebacks, "resident": len(self._resident),
+                "resident_bytes": self.resident_bytes, "memory_budget": self.memory_budget,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,7 @@
+# Report formats accepted by report_writers.open_report_writer. Kept apart from report_writers, which
+# imports pandas, so main.py can offer them without loading it
+EXCEL = "excel"  # The original layout: one openpyxl workbook built in memory, saved at the end
+EXCEL_STREAM = "excel_stream"  # Write-only workbook; every sheet goes to disk as soon as it is written
+PARQUET = "parquet"  # One file per vehicle plus summary.parquet (needs pyarrow or fastparquet)
+CSV = "csv"  # One file per vehicle plus summary.csv
+REPORT_FORMATS = (EXCEL, EXCEL_STREAM, PARQUET, CSV)
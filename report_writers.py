@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from report_formats import CSV, EXCEL, EXCEL_STREAM, PARQUET, REPORT_FORMATS
+from trash_hold_calc import CALIBRATION_COLUMNS, calibrate_thresholds
+
+ROC_IMAGE_CELL = "A10"
+
+
+def write_vehicle_sheet(writer: pd.ExcelWriter, df_output: pd.DataFrame, vehicle_id, roc_curve_image):
+    """Saves a vehicle's output DataFrame to its own Excel sheet and inserts the ROC curve image."""
+    # Save DataFrame to the specific sheet
+    sheet_name = f'Vehicle_{vehicle_id}'
+    df_output.to_excel(writer, sheet_name=sheet_name, index=False)
+
+    # Access the workbook and sheet via the writer
+    workbook = writer.book
+    if sheet_name in workbook.sheetnames:
+        sheet = workbook[sheet_name]
+    else:
+        sheet = workbook.create_sheet(sheet_name)
+
+    # Insert the image into the sheet
+    if roc_curve_image and os.path.exists(roc_curve_image):
+        from openpyxl.drawing.image import Image  # openpyxl is only imported by the Excel writers
+        img = Image(roc_curve_image)
+        # Adjust the position as needed; 'A10' is an example
+        sheet.add_image(img, ROC_IMAGE_CELL)
+    elif roc_curve_image is not None:
+        print(f"No ROC curve image to insert for vehicle {vehicle_id}.")
+
+
+def summary_row(vehicle_id, df_output: pd.DataFrame, calibration=None) -> dict:
+    """Summary of one vehicle's results: calibration values (computed from df_output if not given) and sizes."""
+    if calibration is None:
+        labels = df_output[f'Belongs to Vehicle {vehicle_id}'].to_numpy() == 'Belongs'
+        calibration = calibrate_thresholds(labels, df_output['Probability'].to_numpy(dtype=np.float64)).iloc[0]
+    row = {'vehicle_id': str(vehicle_id), 'trips': len(df_output)}
+    row.update({column: calibration[column] for column in CALIBRATION_COLUMNS})
+    return row
+
+
+class ReportWriter:
+    """Receives the results of one vehicle at a time; used as a context manager."""
+
+    def write_vehicle(self, vehicle_id, df_output: pd.DataFrame, roc_curve_image=None, calibration=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ExcelReportWriter(ReportWriter):
+    """The original report: pd.ExcelWriter with openpyxl, kept in memory until close. Fine for small runs."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = pd.ExcelWriter(path, engine='openpyxl')
+
+    def write_vehicle(self, vehicle_id, df_output, roc_curve_image=None, calibration=None):
+        write_vehicle_sheet(self._writer, df_output, vehicle_id, roc_curve_image)
+
+    def close(self):
+        self._writer.close()
+
+
+class StreamingExcelReportWriter(ReportWriter):
+    """Same sheets and images through a write-only openpyxl workbook.
+
+    Each sheet is closed right after its rows are appended, which writes it to a temporary file, so
+    memory does not grow with the number of vehicles; close assembles the final file.
+    """
+
+    def __init__(self, path: str):
+        from openpyxl import Workbook
+        self.path = path
+        self._workbook = Workbook(write_only=True)
+
+    def write_vehicle(self, vehicle_id, df_output, roc_curve_image=None, calibration=None):
+        sheet = self._workbook.create_sheet(f'Vehicle_{vehicle_id}')
+        sheet.append([str(column) for column in df_output.columns])
+        # Empty cells for missing values, as DataFrame.to_excel writes them
+        values = df_output.astype(object).where(df_output.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            sheet.append(row)
+        if roc_curve_image and os.path.exists(roc_curve_image):
+            from openpyxl.drawing.image import Image
+            sheet.add_image(Image(roc_curve_image), ROC_IMAGE_CELL)
+        elif roc_curve_image is not None:
+            print(f"No ROC curve image to insert for vehicle {vehicle_id}.")
+        sheet.close()
+
+    def close(self):
+        self._workbook.save(self.path)
+
+
+class ColumnarReportWriter(ReportWriter):
+    """Machine-readable report: one Parquet or CSV file per vehicle and a summary table.
+
+    The summary (vehicle, number of trips, AUC, threshold, confusion counts and rates) is written on
+    close as summary.parquet / summary.csv in the same directory. ROC images are not copied.
+    """
+
+    def __init__(self, output_dir: str, file_format: str = PARQUET):
+        if file_format not in (PARQUET, CSV):
+            raise ValueError(f"Unknown columnar format: {file_format}")
+        if file_format == PARQUET:
+            # Fail before the run rather than at the first vehicle when no Parquet engine is installed
+            pd.io.parquet.get_engine('auto')
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.file_format = file_format
+        self.summary = []
+
+    def _write(self, df: pd.DataFrame, name: str):
+        path = os.path.join(self.output_dir, f'{name}.{self.file_format}')
+        if self.file_format == PARQUET:
+            df.to_parquet(path, index=False)
+        else:
+            df.to_csv(path, index=False)
+
+    def write_vehicle(self, vehicle_id, df_output, roc_curve_image=None, calibration=None):
+        self._write(df_output, f'vehicle_{vehicle_id}')
+        self.summary.append(summary_row(vehicle_id, df_output, calibration))
+
+    def close(self):
+        self._write(pd.DataFrame(self.summary, columns=['vehicle_id', 'trips'] + CALIBRATION_COLUMNS), 'summary')
+
+
+def open_report_writer(report_format: str, path: str) -> ReportWriter:
+    """Report writer for one of REPORT_FORMATS; path is the .xlsx file or, for columnar formats, a directory."""
+    if report_format == EXCEL:
+        return ExcelReportWriter(path)
+    if report_format == EXCEL_STREAM:
+        return StreamingExcelReportWriter(path)
+    if report_format in (PARQUET, CSV):
+        return ColumnarReportWriter(path, report_format)
+    raise ValueError(f"Unknown report format: {report_format}")
@@ -1,69 +1,80 @@
-import pandas as pd
+import bisect
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
 from vehicle_profiles import VehicleProfiles
 
 
-def lat_lon_to_grid(lat, lon, grid_size_km=2):
-    earth_circumference_km = 40075.0
-    km_per_degree = earth_circumference_km / 360.0
+TIME_FORMAT = "%d/%m/%Y %H:%M"
+GRID_SIZE_KM = 2
+KM_PER_DEGREE = 40075.0 / 360.0
+
+TIME_THRESHOLDS = [270, 360, 480, 660, 780, 870, 990, 1140, 1260, 1440]
+TIME_CATEGORIES = ["j", "a", "b", "c", "d", "e", "f", "g", "h", "i"]
+DRIVE_THRESHOLDS = [7, 15, 25, 50, 100, 140, 240]
+DRIVE_CATEGORIES = ["a", "b", "c", "d", "e", "f", "g", "h"]
+IDLE_THRESHOLDS = [3, 5, 8, 11, 15, 18, 25]
+IDLE_CATEGORIES = ["a", "b", "c", "d", "e", "f", "g", "h"]
+MILEAGE_THRESHOLDS = [4, 8, 15, 30, 35, 38, 55, 70, 85, 100, 115]
+MILEAGE_CATEGORIES = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l"]
+INVALID_COORDINATES = "Invalid coordinates"
+ENCODING_CACHE_SIZE = 65536  # Entries per encoding cache
+
+
+def lat_lon_to_grid(lat, lon, grid_size_km=GRID_SIZE_KM):
+    km_per_degree = KM_PER_DEGREE
     try:
         lon, lat = float(lon), float(lat)
     except ValueError:
         return None, None
     return int(lon * km_per_degree / grid_size_km), int(lat * km_per_degree / grid_size_km)
 
-def grid_to_letters(x_index, y_index):
-    def index_to_letters(index):
-        letters = ""
-        while index >= 0:
-            letters = chr(index % 26 + ord('a')) + letters
-            index = index // 26 - 1
-        return letters
+@lru_cache(maxsize=ENCODING_CACHE_SIZE)
+def _index_to_letters(index):
+    letters = []
+    while index >= 0:
+        letters.append(chr(index % 26 + ord('a')))
+        index = index // 26 - 1
+    return "".join(reversed(letters))
 
-    return f"{index_to_letters(x_index)}{index_to_letters(y_index)}"
+def grid_to_letters(x_index, y_index):
+    return f"{_index_to_letters(x_index)}{_index_to_letters(y_index)}"
 
 def categorize_time(total_minutes):
-    categories = ["j", "a", "b", "c", "d", "e", "f", "g", "h", "i"]
-    thresholds = [270, 360, 480, 660, 780, 870, 990, 1140, 1260, 1440]
-    for i, threshold in enumerate(thresholds):
-        if total_minutes < threshold:
-            return categories[i]
-    return "Invalid time"
+    i = bisect.bisect_right(TIME_THRESHOLDS, total_minutes)
+    return TIME_CATEGORIES[i] if i < len(TIME_CATEGORIES) else "Invalid time"
 
 def process_duration(value, thresholds, categories):
     try:
         duration = float(value)
     except ValueError:
         return "n"
-    for i, threshold in enumerate(thresholds):
-        if duration < threshold:
-            return categories[i]
-    return categories[-1]
+    # The first threshold the value is below; NaN and values past the last threshold get the last category
+    return categories[min(bisect.bisect_right(thresholds, duration), len(categories) - 1)]
 
 def process_coordinates(lat, lon):
     if pd.isnull(lat) or pd.isnull(lon):
-        return "Invalid coordinates"
+        return INVALID_COORDINATES
     x_index, y_index = lat_lon_to_grid(lat, lon)
-    return grid_to_letters(x_index, y_index) if x_index is not None and y_index is not None else "Invalid coordinates"
+    return grid_to_letters(x_index, y_index) if x_index is not None and y_index is not None else INVALID_COORDINATES
 
 def process_drive_duration(duration):
-    thresholds = [7, 15, 25, 50, 100, 140, 240]
-    categories = ["a", "b", "c", "d", "e", "f", "g", "h"]
-    return process_duration(duration, thresholds, categories)
+    return process_duration(duration, DRIVE_THRESHOLDS, DRIVE_CATEGORIES)
 
 def process_idle_duration(duration):
-    thresholds = [3, 5, 8, 11, 15, 18, 25]
-    categories = ["a", "b", "c", "d", "e", "f", "g", "h"]
-    return process_duration(duration, thresholds, categories)
+    return process_duration(duration, IDLE_THRESHOLDS, IDLE_CATEGORIES)
 
 def process_mileage(mileage):
-    thresholds = [4, 8, 15, 30, 35, 38, 55, 70, 85, 100, 115]
-    categories = ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l"]
-    return process_duration(mileage, thresholds, categories)
+    return process_duration(mileage, MILEAGE_THRESHOLDS, MILEAGE_CATEGORIES)
 
 def process_row(row):
-    total_start_minutes = datetime.strptime(row['start_drive'], "%d/%m/%Y %H:%M").hour * 60 + datetime.strptime(row['start_drive'], "%d/%m/%Y %H:%M").minute
-    total_end_minutes = datetime.strptime(row['end_drive'], "%d/%m/%Y %H:%M").hour * 60 + datetime.strptime(row['end_drive'], "%d/%m/%Y %H:%M").minute
+    start_time = datetime.strptime(row['start_drive'], TIME_FORMAT)
+    end_time = datetime.strptime(row['end_drive'], TIME_FORMAT)
+    total_start_minutes = start_time.hour * 60 + start_time.minute
+    total_end_minutes = end_time.hour * 60 + end_time.minute
 
     start_coords = process_coordinates(row['start_latitude'], row['start_longitude'])
     end_coords = process_coordinates(row['end_latitude'], row['end_longitude'])
@@ -79,6 +90,214 @@ def process_row(row):
     )
 
 
+# Columnar counterparts of the row helpers above. Each one works on a whole
+# column at once and returns exactly what the row helper returns per value,
+# as (codes, labels): the piece of row i is labels[codes[i]].
+
+
+class EncodingCache:
+    """Bounded LRU map from a raw value (a timestamp, a grid index) to its encoded piece.
+
+    The fleet repeats the same cells and times over and over, so a cache shared by consecutive
+    encode_trips calls (ingest chunks, service batches) converts each value once. Hit, miss and
+    eviction counts are kept for info().
+    """
+
+    def __init__(self, maxsize: int = ENCODING_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, keys: np.ndarray, compute) -> np.ndarray:
+        """Pieces of the distinct keys; the missing ones come from a single compute(missing_keys) call."""
+        entries = self._entries
+        values = np.empty(len(keys), dtype=object)
+        missing = []
+        for i, key in enumerate(keys.tolist()):
+            value = entries.get(key)
+            if value is None:
+                missing.append(i)
+            else:
+                entries.move_to_end(key)
+                values[i] = value
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            missing = np.array(missing)
+            computed = compute(keys[missing])
+            values[missing] = computed
+            entries.update(zip(keys[missing].tolist(), computed.tolist()))
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self.evictions += 1
+        return values
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def info(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self._entries),
+                "maxsize": self.maxsize, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class EncodingCaches:
+    """The caches encode_trips uses: grid index -> letters.
+
+    Timestamps are not cached: nearly every trip starts at a different date and minute, so a
+    timestamp cache hardly ever hits, and binning the parsed minute of day is already vectorized.
+    """
+
+    def __init__(self, maxsize: int = ENCODING_CACHE_SIZE):
+        self.cells = EncodingCache(maxsize)
+
+    def clear(self):
+        self.cells.clear()
+
+    def info(self) -> dict:
+        return {"cells": self.cells.info()}
+
+
+# Shared by every encode_trips call that does not pass its own caches
+DEFAULT_CACHES = EncodingCaches()
+
+
+def encoding_cache_info() -> dict:
+    """Hit statistics of the shared columnar caches and of the row helpers' letter cache."""
+    letters = _index_to_letters.cache_info()
+    return {**DEFAULT_CACHES.info(), "row_letters": letters._asdict()}
+
+
+def _parse_floats(values: pd.Series):
+    """Returns (floats, invalid) where invalid marks values that float() rejects."""
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        floats = values.to_numpy(dtype=float, na_value=np.nan)
+        return floats, np.zeros(len(floats), dtype=bool)
+
+    # Text columns repeat a small set of values, so parse each distinct one once.
+    codes, uniques = pd.factorize(values)
+    parsed = np.empty(len(uniques), dtype=float)
+    rejected = np.zeros(len(uniques), dtype=bool)
+    for i, value in enumerate(uniques):
+        try:
+            parsed[i] = float(value)
+        except ValueError:
+            parsed[i] = np.nan
+            rejected[i] = True
+    missing = codes < 0
+    parsed = np.append(parsed, np.nan)
+    rejected = np.append(rejected, False)
+    return parsed[codes], rejected[codes] & ~missing
+
+
+def _bin_codes(values: np.ndarray, thresholds, n_categories) -> np.ndarray:
+    """Vectorized process_duration/categorize_time lookup: position of the first threshold the value is below."""
+    positions = np.searchsorted(np.asarray(thresholds, dtype=float), values, side='right')
+    return np.minimum(positions, n_categories - 1)
+
+
+def _indices_to_letters(indices: np.ndarray) -> np.ndarray:
+    """Vectorized index_to_letters from grid_to_letters (negative indices give '')."""
+    letters = np.full(len(indices), "", dtype=object)
+    alphabet = np.array([chr(ord('a') + i) for i in range(26)], dtype=object)
+    remaining = np.array(indices, dtype=np.int64)
+    active = remaining >= 0
+    while active.any():
+        letters[active] = alphabet[remaining[active] % 26] + letters[active]
+        remaining[active] = remaining[active] // 26 - 1
+        active = remaining >= 0
+    return letters
+
+
+def _encode_times(values: pd.Series):
+    """Codes into TIME_CATEGORIES + ["Invalid time"]: the bin of each timestamp's minute of day."""
+    # Missing timestamps parse to NaT, whose NaN minute falls in the "Invalid time" bin
+    times = pd.to_datetime(pd.Series(values, dtype=object), format=TIME_FORMAT)
+    minutes = (times.dt.hour * 60 + times.dt.minute).to_numpy(dtype=float)
+    labels = np.array(TIME_CATEGORIES + ["Invalid time"], dtype=object)
+    return _bin_codes(minutes, TIME_THRESHOLDS, len(labels)), labels
+
+
+def _encode_cells(indices: np.ndarray, invalid: np.ndarray, placeholder: str, caches: EncodingCaches):
+    codes, uniques = pd.factorize(indices)
+    labels = np.append(caches.cells.lookup(uniques, _indices_to_letters), placeholder)
+    codes[invalid] = len(labels) - 1
+    return codes, labels
+
+
+def _grid_indices(lat: pd.Series, lon: pd.Series):
+    """Vectorized lat_lon_to_grid: (x indices, y indices, invalid), with 0 indices where invalid."""
+    lat_values, lat_invalid = _parse_floats(lat)
+    lon_values, lon_invalid = _parse_floats(lon)
+    invalid = lat.isna().to_numpy() | lon.isna().to_numpy() | lat_invalid | lon_invalid
+    invalid |= ~np.isfinite(lat_values) | ~np.isfinite(lon_values)
+
+    x_index = np.zeros(len(lat_values), dtype=np.int64)
+    y_index = np.zeros(len(lat_values), dtype=np.int64)
+    valid = ~invalid
+    # Same float expression as lat_lon_to_grid, truncated toward zero like int().
+    x_index[valid] = np.trunc(lon_values[valid] * KM_PER_DEGREE / GRID_SIZE_KM).astype(np.int64)
+    y_index[valid] = np.trunc(lat_values[valid] * KM_PER_DEGREE / GRID_SIZE_KM).astype(np.int64)
+    return x_index, y_index, invalid
+
+
+def _encode_coordinates(lat: pd.Series, lon: pd.Series, caches: EncodingCaches):
+    """Two pieces, the x letters then the y letters; an invalid point gets INVALID_COORDINATES then ''."""
+    x_index, y_index, invalid = _grid_indices(lat, lon)
+    return (_encode_cells(x_index, invalid, INVALID_COORDINATES, caches),
+            _encode_cells(y_index, invalid, "", caches))
+
+
+def _encode_durations(values: pd.Series, thresholds, categories):
+    floats, invalid = _parse_floats(values)
+    labels = np.array(categories + ["n"], dtype=object)
+    codes = _bin_codes(floats, thresholds, len(categories))
+    codes[invalid] = len(labels) - 1
+    return codes, labels
+
+
+def encode_trips(df: pd.DataFrame, caches: EncodingCaches = None) -> pd.Series:
+    """Columnar equivalent of df.apply(process_row, axis=1), one trip string per row.
+
+    Every piece of a trip is a code into a small vocabulary, so each distinct combination of pieces
+    (a route at a time of day) is joined into a string once and shared by all the rows that have it.
+    caches defaults to DEFAULT_CACHES, shared by all calls.
+    """
+    if len(df) == 0:
+        return pd.Series([], index=df.index, dtype=object)
+    if caches is None:
+        caches = DEFAULT_CACHES
+
+    pieces = [
+        _encode_times(df['start_drive']),
+        *_encode_coordinates(df['start_latitude'], df['start_longitude'], caches),
+        _encode_times(df['end_drive']),
+        *_encode_coordinates(df['end_latitude'], df['end_longitude'], caches),
+        _encode_durations(df['drive_duration'], DRIVE_THRESHOLDS, DRIVE_CATEGORIES),
+        _encode_durations(df['idle_duration'], IDLE_THRESHOLDS, IDLE_CATEGORIES),
+        _encode_durations(df['mileage'], MILEAGE_THRESHOLDS, MILEAGE_CATEGORIES),
+    ]
+
+    # One integer per row for its combination of codes, compacted whenever it could overflow
+    key = np.zeros(len(df), dtype=np.int64)
+    size = 1
+    for codes, labels in pieces:
+        if size * len(labels) >= 2 ** 62:
+            key, uniques = pd.factorize(key)
+            size = len(uniques)
+        key = key * len(labels) + codes
+        size *= len(labels)
+    key, _ = pd.factorize(key)
+    _, first = np.unique(key, return_index=True)  # A row holding each combination
+
+    encoded = np.full(len(first), "", dtype=object)
+    for codes, labels in pieces:
+        encoded = encoded + labels[codes[first]]
+    return pd.Series(encoded[key], index=df.index, dtype=object)
+
 
 #
 # # Load the CSV file into a DataFrame
@@ -0,0 +1,67 @@
+import os
+import pstats
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from create_file_process import (create_file, create_vehicle_profiles, create_vehicle_profiles_from_chunks,
+                                 iter_trip_chunks, load_csv, process_dataframe)
+from metrics import metrics
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+
+
+@pytest.fixture
+def dirty_csv(tmp_path):
+    # Values the encoder turns into "n" or INVALID_COORDINATES, in some chunks but not others
+    df = pd.read_csv(TRIPS_CSV, low_memory=False)
+    df[['drive_duration', 'idle_duration', 'mileage', 'start_latitude']] = \
+        df[['drive_duration', 'idle_duration', 'mileage', 'start_latitude']].astype(object)
+    df.loc[3, 'drive_duration'] = 'N/A?'
+    df.loc[1200, 'idle_duration'] = 'unknown'
+    df.loc[1201, 'mileage'] = ''
+    df.loc[2400, 'start_latitude'] = 'abc'
+    path = tmp_path / 'Trips.csv'
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", [500, 1000, 100000])
+def test_chunked_build_matches_whole_file(dirty_csv, chunk_size):
+    df = process_dataframe(load_csv(dirty_csv))
+    chunks = list(iter_trip_chunks(dirty_csv, chunk_size))
+    assert pd.concat(chunks)['trip_description'].tolist() == df['trip_description'].tolist()
+
+    whole = create_vehicle_profiles(df)
+    chunked = create_vehicle_profiles_from_chunks(chunks)
+    assert list(chunked.profiles) == list(whole.profiles)
+    trips = df['trip_description'].to_numpy()
+    for vehicle_id in whole.profiles:
+        assert chunked.profiles[vehicle_id]['trip_string'] == whole.profiles[vehicle_id]['trip_string']
+        np.testing.assert_array_equal(chunked.calculate_probabilities_for_vehicle(vehicle_id, trips),
+                                      whole.calculate_probabilities_for_vehicle(vehicle_id, trips))
+
+
+@pytest.fixture
+def small_csv(tmp_path):
+    path = tmp_path / 'Trips.csv'
+    pd.read_csv(TRIPS_CSV, low_memory=False).groupby('vehicle_id').head(60).to_csv(path, index=False)
+    return str(path)
+
+
+def test_profiled_stages_are_dumped_once_for_all_vehicles(tmp_path, small_csv, monkeypatch):
+    monkeypatch.setattr(metrics, "profile_dir", str(tmp_path / "profiles"))
+    vehicle_profiles = create_file(plot_roc=False, report_format="csv", report_path=str(tmp_path / "report"),
+                                   profile_stages=("score",), csv_file_path=small_csv, interactive=False)
+    assert not metrics.enabled
+    stats = pstats.Stats(str(tmp_path / "profiles" / "score.prof"))
+    calls = [count for (_, _, function), (count, *_) in stats.stats.items() if function == "calculate_probabilities"]
+    # One profile holds the scoring of every vehicle, not only the last one's
+    assert calls == [len(vehicle_profiles.profiles)] and len(vehicle_profiles.profiles) > 1
+
+
+def test_metrics_are_disabled_when_the_pipeline_fails(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        create_file(profile_stages=("score",), csv_file_path=str(tmp_path / "missing.csv"), interactive=False)
+    assert not metrics.enabled
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+from batch_scoring import INITIAL_LOG, LOG, LOG_PER_SYMBOL, PROBABILITY, SCORE_SPACES, TripBatch, prefers_walk
+from lempel_ziv78 import LempelZivTree
+from lempel_ziv78_compact import CompactLempelZivTree
+from vehicle_profiles import VehicleProfiles
+
+ALPHABET = list("abcde")
+
+
+def random_string(rng, alphabet, low, high):
+    return "".join(rng.choice(alphabet, size=rng.integers(low, high)))
+
+
+def node_table(tree):
+    """Every node of the tree by its path from the root: (visits, leaf count, weight)."""
+    if isinstance(tree, CompactLempelZivTree):
+        paths = {0: ""}
+        table = {}
+        for node in range(1, tree.node_count):
+            paths[node] = paths[tree.parent[node]] + tree.symbols[tree.symbol[node]]
+            table[paths[node]] = (int(tree.total_descendants[node]), int(tree.leaf_count[node]),
+                                  float(tree.weight[node]), float(tree.option_log_weight[node]))
+        return table
+    table = {}
+    stack = [(tree.root, "")]
+    while stack:
+        node, path = stack.pop()
+        if path:
+            table[path] = (node.total_descendants, node.leaf_count, node.weight)
+        stack.extend((child, path + char) for char, child in node.children.items())
+    return table
+
+
+@pytest.mark.parametrize("tree_class", [LempelZivTree, CompactLempelZivTree])
+def test_adding_trips_one_by_one_matches_a_full_build(tree_class):
+    rng = np.random.default_rng(2)
+    open_phrases = 0
+    for _ in range(40):
+        # The first trip holds every symbol, so later trips only reweight the paths they touched
+        first = "".join(rng.permutation(ALPHABET)) + random_string(rng, ALPHABET, 0, 10)
+        trips = [first] + [random_string(rng, ALPHABET, 0, 15) for _ in range(rng.integers(1, 30))]
+        vehicle_profiles = VehicleProfiles(tree_class)
+        for trip in trips:
+            vehicle_profiles.add_trip("1", trip)
+            assert vehicle_profiles.profiles["1"]["tree"].options == set(ALPHABET)  # No new option, no full pass
+        tree = vehicle_profiles.profiles["1"]["tree"]
+        full = tree_class()
+        full.build_tree("".join(trips))
+        full.calculate_weights()
+
+        assert tree.pending == full.pending
+        open_phrases += bool(tree.pending)
+        assert tree.total_nodes == full.total_nodes
+        assert tree.leaves_count == full.leaves_count
+        assert node_table(tree) == node_table(full)
+        queries = [random_string(rng, ALPHABET + ["z"], 0, 12) for _ in range(20)]
+        for space in ("probability", "log"):
+            np.testing.assert_array_equal(tree.calculate_sequence_probabilities(TripBatch.from_strings(queries), space),
+                                          full.calculate_sequence_probabilities(TripBatch.from_strings(queries), space))
+        assert [tree.calculate_sequence_probability(query) for query in queries] == \
+               [full.calculate_sequence_probability(query) for query in queries]
+    assert open_phrases  # Some histories ended inside a phrase that the next trip continued
+
+
+def check_weights(tree):
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        if node.children:
+            assert sum(child.weight for child in node.children.values()) == pytest.approx(1.0)
+        stack.extend(node.children.values())
+    assert tree.total_nodes == tree.summary()["phrase_nodes"]
+
+
+def test_pruned_trees_stay_consistent():
+    rng = np.random.default_rng(3)
+    removed = 0
+    for _ in range(40):
+        budget = int(rng.integers(5, 40))
+        tree = LempelZivTree()
+        for _ in range(rng.integers(1, 30)):
+            # Adding a trip to a pruned tree only reweights the paths it touched; a full pass must agree
+            tree.build_tree(random_string(rng, ALPHABET, 0, 20))
+            tree.calculate_weights()
+            reweighted = tree.copy()
+            reweighted._reweight_all = True
+            reweighted.calculate_weights()
+            assert node_table(tree) == pytest.approx(node_table(reweighted))
+
+            removed += tree.prune(budget)
+            check_weights(tree)
+            queries = [random_string(rng, ALPHABET + ["z"], 0, 12) for _ in range(10)]
+            batch = TripBatch.from_strings(queries)
+            for space in ("probability", "log"):
+                if space == "probability":
+                    expected = [tree.calculate_sequence_probability(query) for query in queries]
+                else:
+                    expected = [tree.calculate_sequence_log_probability(query) for query in queries]
+                np.testing.assert_allclose(tree.calculate_sequence_probabilities(batch, space), expected, rtol=1e-9)
+                np.testing.assert_allclose(CompactLempelZivTree.from_tree(tree).calculate_sequence_probabilities(
+                    batch, space), expected, rtol=1e-9)
+    assert removed
+
+
+def scalar_scores(tree, trips, space):
+    if space == PROBABILITY:
+        return [tree.calculate_sequence_probability(trip) for trip in trips]
+    return [tree.calculate_sequence_log_probability(trip, per_symbol=space == LOG_PER_SYMBOL) for trip in trips]
+
+
+@pytest.mark.parametrize("tree_class", [LempelZivTree, CompactLempelZivTree])
+def test_batch_scores_match_scalar_scores(tree_class):
+    rng = np.random.default_rng(5)
+    walked = 0
+    for _ in range(40):
+        history = random_string(rng, ALPHABET, 1, 300)
+        tree = tree_class()
+        tree.build_tree(history)
+        tree.calculate_weights()
+        # Unknown symbols, the empty trip and pieces of the history, which end inside a phrase
+        starts = rng.integers(0, len(history), size=10)
+        trips = [random_string(rng, ALPHABET + ["y", "z"], 0, 15) for _ in range(10)] + [""] + \
+                [history[start:start + rng.integers(1, 10)] for start in starts]
+        short = trips[:2]
+        walked += prefers_walk(short, tree.total_nodes)
+        for space in SCORE_SPACES:
+            expected = {len(trips): scalar_scores(tree, trips, space), len(short): scalar_scores(tree, short, space)}
+            # A fresh tree walks the few short trips and builds the table for the rest; then the table scores all
+            for batch in (short, trips, TripBatch.from_strings(trips), short):
+                np.testing.assert_allclose(tree.calculate_sequence_probabilities(batch, space), expected[len(batch)],
+                                           rtol=1e-9)
+            tree._transition_table = None
+    assert walked  # The TripBatch always takes the table, so both were used
+
+
+@pytest.mark.parametrize("tree_class", [LempelZivTree, CompactLempelZivTree])
+def test_log_scores_are_logs_of_probabilities(tree_class):
+    rng = np.random.default_rng(6)
+    for _ in range(40):
+        tree = tree_class()
+        tree.build_tree(random_string(rng, ALPHABET, 1, 300))
+        tree.calculate_weights()
+        trips = [random_string(rng, ALPHABET + ["z"], 1, 15) for _ in range(20)]
+        log_probabilities = np.log(tree.calculate_sequence_probabilities(trips, PROBABILITY))
+        lengths = np.array([len(trip) for trip in trips])
+        np.testing.assert_allclose(tree.calculate_sequence_probabilities(trips, LOG), log_probabilities, rtol=1e-9)
+        # Per symbol leaves out the initial scale of the walk
+        np.testing.assert_allclose(tree.calculate_sequence_probabilities(trips, LOG_PER_SYMBOL),
+                                   (log_probabilities - INITIAL_LOG) / lengths, rtol=1e-9, atol=1e-12)
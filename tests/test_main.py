@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks import HEAVY_MODULES, MAIN_PATH
+from create_file_process import create_vehicle_profiles, load_csv, process_dataframe
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+
+# Runs main.py as a script with the given arguments, then prints which heavy modules got imported
+SCORE_SCRIPT = """
+import json, os, runpy, sys
+main_path, heavy_modules, arguments = sys.argv[1], json.loads(sys.argv[2]), json.loads(sys.argv[3])
+sys.argv = [main_path] + arguments
+sys.path.insert(0, os.path.dirname(main_path))  # As `python main.py` would
+try:
+    runpy.run_path(main_path, run_name="__main__")
+except SystemExit as exit:
+    if exit.code:
+        raise
+print(json.dumps([module for module in heavy_modules if module in sys.modules]))
+"""
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    df = process_dataframe(load_csv(TRIPS_CSV))
+    path = str(tmp_path_factory.mktemp("store") / "profiles.vps")
+    create_vehicle_profiles(df).save(path)
+    vehicle_id = str(df['vehicle_id'].iloc[0])
+    trips = df.loc[df['vehicle_id'].astype(str) == vehicle_id, 'trip_description'].iloc[:3].tolist()
+    return path, vehicle_id, trips
+
+
+@pytest.mark.parametrize("options", [[], ["--memory-budget", "100000"]])
+def test_score_does_not_import_heavy_modules(store, options):
+    path, vehicle_id, trips = store
+    arguments = ["score", "--store", path, *options, vehicle_id, *trips]
+    result = subprocess.run([sys.executable, "-c", SCORE_SCRIPT, MAIN_PATH, json.dumps(HEAVY_MODULES),
+                             json.dumps(arguments)], capture_output=True, text=True, check=True)
+    *scores, imported = result.stdout.splitlines()
+    assert json.loads(imported) == []
+    assert len(scores) == len(trips) and all(line.startswith(trip + "\t") for line, trip in zip(scores, trips))
+
+
+def test_unknown_report_format_is_rejected_by_the_parser(capsys):
+    from main import main
+    with pytest.raises(SystemExit) as exit:
+        main(["report", "--report-format", "xlsx"])
+    assert exit.value.code == 2
+    assert "invalid choice: 'xlsx'" in capsys.readouterr().err
@@ -0,0 +1,89 @@
+import gc
+import os
+
+import pytest
+
+from create_file_process import create_vehicle_profiles, load_csv, process_dataframe
+from profile_store import _PREFIX, ProfileStore
+from trip_checks import check_trips_from_store
+from vehicle_profiles import VehicleProfiles
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+
+
+@pytest.fixture(scope="module")
+def df():
+    return process_dataframe(load_csv(TRIPS_CSV))
+
+
+@pytest.fixture
+def store(df, tmp_path):
+    vehicle_profiles = create_vehicle_profiles(df)
+    for profile in vehicle_profiles.profiles.values():
+        profile["threshold"] = 0.0  # Accept every trip
+    path = str(tmp_path / "profiles.vps")
+    vehicle_profiles.save(path)
+    return path
+
+
+def spill_dirs(path):
+    return [name for name in os.listdir(os.path.dirname(path)) if name.startswith("profiles-")]
+
+
+def add_to_every_vehicle(vehicle_profiles, trip):
+    for vehicle_id in list(vehicle_profiles.profiles):
+        vehicle_profiles.add_trip(vehicle_id, trip)
+
+
+def test_spill_dir_is_removed_on_close(store, df):
+    with VehicleProfiles.load(store, memory_budget=1) as vehicle_profiles:
+        add_to_every_vehicle(vehicle_profiles, df['trip_description'].iloc[0])
+        assert vehicle_profiles.profiles.writebacks and spill_dirs(store)
+    assert not spill_dirs(store)
+
+
+def test_spill_dir_is_removed_with_the_cache(store, df):
+    vehicle_profiles = VehicleProfiles.load(store, memory_budget=1)
+    add_to_every_vehicle(vehicle_profiles, df['trip_description'].iloc[0])
+    assert spill_dirs(store)
+    del vehicle_profiles
+    gc.collect()
+    assert not spill_dirs(store)
+
+
+def test_verify_saves_accepted_trips(store, df, monkeypatch):
+    vehicle_ids = list(VehicleProfiles.load(store).profiles)
+    trip = df['trip_description'].iloc[0]
+    answers = []
+    for vehicle_id in vehicle_ids:
+        answers += [vehicle_id, trip, "yes"]
+    answers = iter(answers)
+
+    def prompt(_):
+        # Input ends after the last answer, as when stdin is closed
+        try:
+            return next(answers)
+        except StopIteration:
+            raise EOFError
+
+    monkeypatch.setattr("builtins.input", prompt)
+    check_trips_from_store(store, memory_budget=1)
+
+    assert not spill_dirs(store)
+    saved = VehicleProfiles.load(store)
+    for vehicle_id in vehicle_ids:
+        assert saved.profiles[vehicle_id]["trip_string"].endswith(trip)
+        assert saved.version(vehicle_id) == 2
+
+
+def test_opening_reads_only_the_vehicle_index(store):
+    profile_store = ProfileStore(store)
+    with open(store, "rb") as f:
+        _, _, header_length = _PREFIX.unpack(f.read(_PREFIX.size))
+    # A few dozen bytes per vehicle: the entries stay in the data section until a profile is loaded
+    assert header_length < 100 + 64 * len(profile_store.vehicle_ids)
+    saved = VehicleProfiles.load(store)
+    for vehicle_id in profile_store.vehicle_ids:
+        profile = profile_store.load_profile(vehicle_id)
+        assert profile["trip_string"] == saved.profiles[vehicle_id]["trip_string"]
+        assert profile["threshold"] == 0.0 and profile["version"] == 1
@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from string_create import EncodingCaches, encode_trips, process_row
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+
+
+def row_wise(df):
+    return df.apply(process_row, axis=1)
+
+
+@pytest.fixture(scope="module")
+def trips():
+    return pd.read_csv(TRIPS_CSV, low_memory=False)
+
+
+def edge_cases(trips):
+    df = trips.head(12).copy().astype({column: object for column in
+                                       ['start_latitude', 'start_longitude', 'end_latitude', 'end_longitude',
+                                        'drive_duration', 'idle_duration', 'mileage']})
+    df.loc[0, 'start_latitude'] = np.nan
+    df.loc[1, 'end_longitude'] = np.nan
+    df.loc[2, 'start_latitude'] = 'abc'
+    df.loc[3, 'end_latitude'] = ''
+    df.loc[4, 'drive_duration'] = 'N/A?'
+    df.loc[5, 'idle_duration'] = np.nan
+    df.loc[6, 'mileage'] = '12,5'
+    df.loc[7, ['start_latitude', 'start_longitude']] = [-33.45, -70.66]  # Both grid indices negative
+    df.loc[8, ['end_latitude', 'end_longitude']] = [51.5, 0.12]  # Both positive
+    df.loc[9, ['drive_duration', 'idle_duration', 'mileage']] = [1e9, -5, 0]  # Past the last threshold
+    df.loc[10, 'start_drive'] = '01/06/2023 23:59'
+    df.loc[11, 'end_drive'] = '01/06/2023 00:00'
+    return df
+
+
+def test_matches_process_row_on_trips_csv(trips):
+    assert encode_trips(trips).tolist() == row_wise(trips).tolist()
+
+
+def test_matches_process_row_on_edge_cases(trips):
+    df = edge_cases(trips)
+    assert encode_trips(df, EncodingCaches()).tolist() == row_wise(df).tolist()
+
+
+def test_small_caches_give_the_same_strings(trips):
+    # Entries are evicted between and within calls; the strings must not depend on what is cached
+    caches = EncodingCaches(maxsize=2)
+    expected = row_wise(trips).tolist()
+    for chunk in (trips.iloc[:700], trips.iloc[700:1500], trips.iloc[1500:], trips):
+        assert encode_trips(chunk, caches).tolist() == expected[chunk.index[0]:chunk.index[-1] + 1]
+    assert encode_trips(edge_cases(trips), caches).tolist() == row_wise(edge_cases(trips)).tolist()
+
+
+def test_keeps_the_index(trips):
+    df = trips.iloc[::7]
+    encoded = encode_trips(df)
+    assert encoded.index.equals(df.index)
+    assert len(encode_trips(df.iloc[:0])) == 0
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from batch_scoring import INITIAL_LOG, LOG, LOG_PER_SYMBOL, PROBABILITY
+from lempel_ziv78 import LempelZivTree
+from trash_hold_calc import calibrate_thresholds, roc_curves
+
+sklearn_metrics = pytest.importorskip("sklearn.metrics")
+
+
+def test_matches_sklearn_with_ties_and_many_vehicles():
+    rng = np.random.default_rng(4)
+    for _ in range(50):
+        n_groups = int(rng.integers(1, 6))
+        size = int(rng.integers(2, 200))
+        groups = rng.integers(0, n_groups, size=size)
+        labels = rng.random(size) < rng.uniform(0.1, 0.9)
+        # Few distinct scores, so many trips tie; positives score a little higher on average
+        scores = np.round(rng.random(size) + 0.3 * labels, int(rng.integers(0, 3)))
+        names = [f"vehicle {group}" for group in groups]
+        calibration = calibrate_thresholds(labels, scores, names)
+        curves = roc_curves(labels, scores, groups, n_groups)
+
+        for group in range(n_groups):
+            mask = groups == group
+            if not mask.any():
+                continue
+            row = calibration.loc[f"vehicle {group}"]
+            if labels[mask].all() or not labels[mask].any():
+                assert row['Error'] is not None and np.isnan(row['AUC'])
+                continue
+            fpr, tpr, thresholds = sklearn_metrics.roc_curve(labels[mask], scores[mask])
+            ours = curves[group]
+            np.testing.assert_allclose(ours[0], fpr)
+            np.testing.assert_allclose(ours[1], tpr)
+            np.testing.assert_array_equal(ours[2][1:], thresholds[1:])  # The first is inf in both
+
+            assert row['Error'] is None
+            assert row['AUC'] == pytest.approx(sklearn_metrics.roc_auc_score(labels[mask], scores[mask]))
+            best = np.argmax(tpr - fpr)
+            assert row['Threshold'] == thresholds[best]
+            predicted = scores[mask] >= thresholds[best]
+            assert row['TP'] == np.sum(predicted & labels[mask])
+            assert row['FP'] == np.sum(predicted & ~labels[mask])
+            assert row['FN'] == np.sum(~predicted & labels[mask])
+            assert row['TN'] == np.sum(~predicted & ~labels[mask])
+
+
+def distinct_scores(tree, trips):
+    # Trips with the same weights in another order score the same, but the product and the sum of
+    # logs round differently, so such ties may break one way in one space and not in the other
+    log_probabilities = np.log(tree.calculate_sequence_probabilities(trips, PROBABILITY))
+    order = np.argsort(log_probabilities)
+    keep = np.concatenate(([True], np.diff(log_probabilities[order]) > 1e-9))
+    return np.sort(order[keep])
+
+
+def test_log_space_thresholds_select_the_same_trips():
+    rng = np.random.default_rng(7)
+    alphabet = list("abcde")
+    for _ in range(20):
+        # Each vehicle favours its own symbols; its trips are drawn the same way
+        habits = rng.dirichlet(np.ones(len(alphabet)), size=3)
+        trees = []
+        for habit in habits:
+            tree = LempelZivTree()
+            tree.build_tree("".join(rng.choice(alphabet, size=300, p=habit)))
+            tree.calculate_weights()
+            trees.append(tree)
+        owners = rng.integers(0, len(trees), size=150)
+        # Trips of one length, so dividing by it keeps the order in log_per_symbol space too
+        trips = np.array(["".join(rng.choice(alphabet, size=7, p=habits[owner])) for owner in owners])
+        for vehicle, tree in enumerate(trees):
+            kept = distinct_scores(tree, trips)
+            labels = owners[kept] == vehicle
+            if labels.all() or not labels.any():
+                continue
+            calibrations, selected = {}, {}
+            for space in (PROBABILITY, LOG, LOG_PER_SYMBOL):
+                scores = tree.calculate_sequence_probabilities(list(trips[kept]), space)
+                calibrations[space] = calibrate_thresholds(labels, scores).iloc[0]
+                selected[space] = scores >= calibrations[space]['Threshold']
+            threshold = calibrations[PROBABILITY]['Threshold']
+            assert calibrations[LOG]['Threshold'] == pytest.approx(np.log(threshold), rel=1e-9)
+            assert calibrations[LOG_PER_SYMBOL]['Threshold'] == pytest.approx((np.log(threshold) - INITIAL_LOG) / 7,
+                                                                              rel=1e-9)
+            for space in (LOG, LOG_PER_SYMBOL):
+                assert calibrations[space]['AUC'] == calibrations[PROBABILITY]['AUC']
+                np.testing.assert_array_equal(selected[space], selected[PROBABILITY])
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from batch_scoring import TOKENS, TripBatch
+from create_file_process import (build_profile_store, calibrate_profile_store, create_vehicle_profiles, load_csv,
+                                 process_dataframe, update_profile_store)
+from lempel_ziv78 import LempelZivTree
+from lempel_ziv78_compact import CompactLempelZivTree
+from trip_tokens import TokenVocabulary
+from vehicle_profiles import VehicleProfiles
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+
+
+@pytest.fixture(scope="module")
+def token_trips():
+    vocabulary = TokenVocabulary()
+    return process_dataframe(load_csv(TRIPS_CSV), vocabulary), vocabulary
+
+
+def test_compact_token_trees_score_like_node_trees(token_trips):
+    df, vocabulary = token_trips
+    compact = create_vehicle_profiles(df, vocabulary=vocabulary)
+    parallel = create_vehicle_profiles(df, workers=2, vocabulary=vocabulary)
+    nodes = VehicleProfiles(LempelZivTree, vocabulary=vocabulary)
+    for vehicle_id, trip_string in df.groupby('vehicle_id')['trip_description'].apply(''.join).items():
+        nodes.add_trip(vehicle_id, trip_string)
+
+    trips = df['trip_description'].to_numpy()
+    for vehicle_id, profile in compact.profiles.items():
+        # The option leaves stay implicit: only the phrase nodes are stored
+        assert isinstance(profile["tree"], CompactLempelZivTree)
+        assert profile["tree"].node_count == profile["tree"].total_nodes + 1
+        assert profile["tree"].options == vocabulary.alphabet()
+        for space in ("probability", "log"):
+            scores = profile["tree"].calculate_sequence_probabilities(trips, space)
+            np.testing.assert_allclose(scores, nodes.profiles[vehicle_id]["tree"].calculate_sequence_probabilities(
+                trips, space), rtol=1e-9)
+            np.testing.assert_array_equal(scores, parallel.profiles[vehicle_id]["tree"]
+                                          .calculate_sequence_probabilities(trips, space))
+
+
+@pytest.fixture
+def new_cell_csv(tmp_path):
+    # One trip of the first vehicle to a place none of the trips goes to
+    df = pd.read_csv(TRIPS_CSV, low_memory=False)
+    trip = df[df['vehicle_id'] == df['vehicle_id'].iloc[0]].head(1).copy()
+    trip[['end_latitude', 'end_longitude']] = [60.0, 20.0]
+    path = tmp_path / 'new_trips.csv'
+    trip.to_csv(path, index=False)
+    return str(path), str(trip['vehicle_id'].iloc[0])
+
+
+@pytest.mark.parametrize("step", ["update", "calibrate"])
+def test_stored_trees_take_new_cells(tmp_path, new_cell_csv, step):
+    csv_path, vehicle_id = new_cell_csv
+    store = str(tmp_path / 'profiles.vps')
+    build_profile_store(TRIPS_CSV, store, trip_encoding=TOKENS)
+    before = VehicleProfiles.load(store)
+    if step == "update":
+        update_profile_store(csv_path, store)
+    else:
+        calibrate_profile_store(csv_path, store)
+
+    after = VehicleProfiles.load(store)
+    if step == "update":
+        assert len(after.profiles[vehicle_id]["trip_string"]) > len(before.profiles[vehicle_id]["trip_string"])
+    assert len(after.vocabulary) == len(before.vocabulary) + 1
+    new_cell = after.vocabulary.alphabet() - before.vocabulary.alphabet()
+    for other_id, profile in after.profiles.items():
+        # Every tree, not only the one that got the trip, scores the new cell with its option weight
+        assert new_cell <= profile["tree"].options
+        assert after.version(other_id) == before.version(other_id) + 1
+
+
+def scores_one_by_one(tree, trips, space):
+    if space == "probability":
+        return np.array([tree.calculate_sequence_probability(trip) for trip in trips])
+    return np.array([tree.calculate_sequence_log_probability(trip) for trip in trips])
+
+
+@pytest.mark.parametrize("tree_class", [LempelZivTree, CompactLempelZivTree])
+def test_token_trees_score_the_same_one_by_one_and_in_batches(token_trips, tree_class):
+    df, vocabulary = token_trips
+    vehicle_profiles = VehicleProfiles(tree_class, vocabulary=vocabulary)
+    for vehicle_id, trip_string in df.groupby('vehicle_id')['trip_description'].apply(''.join).items():
+        vehicle_profiles.add_trip(vehicle_id, trip_string)
+
+    trips = df['trip_description'].tolist()
+    batch = TripBatch.from_strings(trips)  # Always scored with the transition table
+    for profile in vehicle_profiles.profiles.values():
+        for space in ("probability", "log"):
+            np.testing.assert_allclose(profile["tree"].calculate_sequence_probabilities(batch, space),
+                                       scores_one_by_one(profile["tree"], trips, space), rtol=1e-9)
+
+
+def test_offered_options_score_the_same_on_every_path():
+    # Options offered before they occur sit under the root as option leaves, which a missed symbol
+    # moves to without cost; every walk and table must agree on that
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        tree, compact = LempelZivTree(), CompactLempelZivTree()
+        extra = set(rng.choice(list("wxyz"), size=rng.integers(1, 4), replace=False))
+        for _ in range(rng.integers(1, 4)):
+            if rng.random() < 0.5:
+                tree.add_options(extra)
+                compact.add_options(extra)
+            history = "".join(rng.choice(list("abcd"), size=rng.integers(0, 30)))
+            for each in (tree, compact):
+                each.build_tree(history)
+                each.calculate_weights()
+        trips = ["".join(rng.choice(list("abcdwxyzq"), size=rng.integers(0, 12))) for _ in range(20)]
+        batch = TripBatch.from_strings(trips)
+        for space in ("probability", "log"):
+            expected = scores_one_by_one(tree, trips, space)
+            for scores in (scores_one_by_one(compact, trips, space),
+                           tree.calculate_sequence_probabilities(batch, space),
+                           compact.calculate_sequence_probabilities(batch, space),
+                           CompactLempelZivTree.from_tree(tree).calculate_sequence_probabilities(batch, space)):
+                np.testing.assert_allclose(scores, expected, rtol=1e-9)
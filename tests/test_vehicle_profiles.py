@@ -0,0 +1,137 @@
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+from create_file_process import load_csv, process_dataframe
+from lempel_ziv78 import LempelZivTree
+from lempel_ziv78_compact import CompactLempelZivTree
+from trip_tokens import TokenVocabulary
+from vehicle_profiles import VehicleProfiles
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+READERS = 4
+INITIAL_TRIPS = 40
+
+
+@pytest.fixture(scope="module")
+def trips():
+    df = process_dataframe(load_csv(TRIPS_CSV))
+    vehicle_id = df['vehicle_id'].iloc[0]
+    return str(vehicle_id), df.loc[df['vehicle_id'] == vehicle_id, 'trip_description'].tolist()[:150]
+
+
+@pytest.fixture
+def fast_switching():
+    # Switch threads far more often than the default 5 ms, so reads land in the middle of updates
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+@pytest.mark.parametrize("tree_class", [LempelZivTree, CompactLempelZivTree])
+def test_snapshot_reads_are_never_torn(trips, tree_class, fast_switching):
+    vehicle_id, vehicle_trips = trips
+    vehicle_profiles = VehicleProfiles(tree_class, snapshots=True)
+    vehicle_profiles.add_trip(vehicle_id, "".join(vehicle_trips[:INITIAL_TRIPS]))
+    history = "".join(vehicle_trips)
+    queries = vehicle_trips[::10]
+    done = threading.Event()
+    errors, reads = [], []
+
+    def write():
+        try:
+            for trip in vehicle_trips[INITIAL_TRIPS:]:
+                vehicle_profiles.add_trip(vehicle_id, trip)
+        finally:
+            done.set()
+
+    def read():
+        versions = set()
+        try:
+            while not done.is_set() or not versions:
+                profile = vehicle_profiles.snapshot(vehicle_id)
+                scores = profile["tree"].calculate_sequence_probabilities(queries)
+                # The version this reader saw, rebuilt from scratch from its own trip string
+                fresh = tree_class()
+                fresh.build_tree(profile["trip_string"])
+                fresh.calculate_weights()
+                assert history.startswith(profile["trip_string"])
+                np.testing.assert_allclose(scores, fresh.calculate_sequence_probabilities(queries), rtol=1e-9)
+                versions.add(profile["version"])
+        except Exception as e:
+            errors.append(e)
+        reads.append(versions)
+
+    threads = [threading.Thread(target=read) for _ in range(READERS)] + [threading.Thread(target=write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors[0]
+    # The readers saw the profile change under them, and the last version holds every trip
+    assert len(set().union(*reads)) > 1
+    assert vehicle_profiles.snapshot(vehicle_id)["trip_string"] == history
+    assert vehicle_profiles.version(vehicle_id) == len(vehicle_trips) - INITIAL_TRIPS + 1
+
+
+def test_refresh_options_only_changes_trees_that_gain_options():
+    df = load_csv(TRIPS_CSV).head(300)
+    vocabulary = TokenVocabulary()
+    df = process_dataframe(df, vocabulary)
+    vehicle_profiles = VehicleProfiles(vocabulary=vocabulary)
+    for vehicle_id, trips in df.groupby('vehicle_id')['trip_description']:
+        vehicle_profiles.add_trip(vehicle_id, ''.join(trips))
+    versions = {vehicle_id: vehicle_profiles.version(vehicle_id) for vehicle_id in vehicle_profiles.profiles}
+
+    vehicle_profiles.refresh_options()
+    assert {vehicle_id: vehicle_profiles.version(vehicle_id) for vehicle_id in versions} == versions
+
+    vocabulary.cell_tokens(np.array([10 ** 6]), np.array([10 ** 6]), np.array([False]))  # A cell no tree has
+    vehicle_profiles.refresh_options()
+    assert {vehicle_id: vehicle_profiles.version(vehicle_id) - 1 for vehicle_id in versions} == versions
+
+
+def test_publishing_replaces_only_the_vehicle_entry(trips, fast_switching):
+    vehicle_id, vehicle_trips = trips
+    vehicle_profiles = VehicleProfiles(snapshots=True)
+    for other_id in range(50):
+        vehicle_profiles.add_trip(str(other_id), vehicle_trips[other_id])
+    profiles = vehicle_profiles.profiles
+    vehicle_profiles.add_trip("0", vehicle_trips[50])
+    vehicle_profiles.set_threshold("1", 0.5)
+    # Existing vehicles are swapped in place; the other entries are the same objects
+    assert vehicle_profiles.profiles is profiles
+    assert vehicle_profiles.snapshot("0")["trip_string"] == vehicle_trips[0] + vehicle_trips[50]
+    assert vehicle_profiles.snapshot("1")["threshold"] == 0.5
+
+    done = threading.Event()
+    errors = []
+
+    def write():
+        try:
+            for i, trip in enumerate(vehicle_trips[:100]):
+                vehicle_profiles.add_trip(str(i % 60), trip)  # Ten of the vehicles are new
+        finally:
+            done.set()
+
+    def read():
+        try:
+            while not done.is_set():
+                for profile in vehicle_profiles.profiles.values():
+                    assert profile["version"] >= 1
+                vehicle_profiles.score_matrix(vehicle_trips[:3])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(READERS)] + [threading.Thread(target=write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors[0]
+    assert len(vehicle_profiles.profiles) == 60
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from batch_scoring import TOKENS
+from create_file_process import build_profile_store, create_vehicle_profiles, load_csv, process_dataframe
+from verification_service import _RECORD_COLUMNS, TripVerificationService
+from vehicle_profiles import VehicleProfiles
+
+TRIPS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'Trips.csv')
+
+
+@pytest.fixture(scope="module")
+def df():
+    return process_dataframe(load_csv(TRIPS_CSV).head(400))
+
+
+class RecordingProfiles(VehicleProfiles):
+    """Remembers the thread every add_trip ran in."""
+
+    def add_trip(self, vehicle_id, trip):
+        self.threads = getattr(self, "threads", []) + [threading.current_thread()]
+        super().add_trip(vehicle_id, trip)
+
+
+def test_write_back_needs_snapshot_mode(df):
+    with pytest.raises(ValueError):
+        TripVerificationService(create_vehicle_profiles(df))
+    TripVerificationService(create_vehicle_profiles(df), write_back=False)
+
+
+def test_accepted_trips_are_added_off_the_event_loop(df):
+    vehicle_profiles = create_vehicle_profiles(df)
+    vehicle_profiles.__class__ = RecordingProfiles
+    vehicle_profiles.snapshots = True
+    vehicle_id = str(df['vehicle_id'].iloc[0])
+    trips = df.loc[df['vehicle_id'] == df['vehicle_id'].iloc[0], 'trip_description'].tolist()[:20]
+    before = vehicle_profiles.snapshot(vehicle_id)
+
+    async def run():
+        service = TripVerificationService(vehicle_profiles)
+        await service.start()
+        replies = await asyncio.gather(*[service.verify(vehicle_id, trip) for trip in trips])
+        await service.stop()
+        return service, replies, threading.current_thread()
+
+    service, replies, loop_thread = asyncio.run(run())
+    accepted = [reply["trip"] for reply in replies if reply["accepted"]]
+    assert accepted and service.accepted_trips == len(accepted)
+    assert vehicle_profiles.threads and loop_thread not in vehicle_profiles.threads
+    # The published version is replaced, never changed in place
+    after = vehicle_profiles.snapshot(vehicle_id)
+    assert after is not before
+    assert after["trip_string"] == before["trip_string"] + "".join(accepted)
+    assert after["version"] > before["version"]
+
+
+def test_raw_records_are_token_encoded_for_token_profiles(tmp_path):
+    store = str(tmp_path / "profiles.vps")
+    build_profile_store(TRIPS_CSV, store, trip_encoding=TOKENS)
+    vehicle_profiles = VehicleProfiles.load(store, snapshots=True)
+    for profile in vehicle_profiles.profiles.values():
+        profile["threshold"] = 0.0  # Accept every trip
+    raw = load_csv(TRIPS_CSV).head(400)
+    vehicle_id = str(raw['vehicle_id'].iloc[0])
+    rows = raw[raw['vehicle_id'].astype(str) == vehicle_id].head(5)
+    records = rows[list(_RECORD_COLUMNS)].to_dict('records')
+    expected = process_dataframe(rows.copy(), vehicle_profiles.vocabulary)['trip_description'].tolist()
+    before = vehicle_profiles.snapshot(vehicle_id)
+
+    async def run():
+        service = TripVerificationService(vehicle_profiles)
+        await service.start()
+        replies = await asyncio.gather(*[service.verify(vehicle_id, record=record) for record in records])
+        await service.stop()
+        return replies
+
+    replies = asyncio.run(run())
+    assert [reply["trip"] for reply in replies] == expected
+    scores = before["tree"].calculate_sequence_probabilities(expected)
+    assert [reply["probability"] for reply in replies] == scores.tolist()
+    assert all(reply["accepted"] for reply in replies)
+    # The trees only ever get token strings
+    assert vehicle_profiles.snapshot(vehicle_id)["trip_string"] == before["trip_string"] + "".join(expected)
@@ -1,69 +1,156 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.metrics import roc_curve, roc_auc_score
 import os
 from vehicle_profiles import VehicleProfiles
+from metrics import metrics
+
+CALIBRATION_COLUMNS = ['AUC', 'Threshold', 'TP', 'TN', 'FP', 'FN', 'Recall', 'Precision', 'Specificity', 'Error']
+
+
+class RocCurves:
+    """ROC curves of many groups, stored back to back: group g owns points bounds[g]:bounds[g + 1]."""
+
+    def __init__(self, bounds, fpr, tpr, thresholds, tps, fps):
+        self.bounds = bounds
+        self.fpr = fpr
+        self.tpr = tpr
+        self.thresholds = thresholds
+        self.tps = tps  # True positives at each threshold (scores >= threshold)
+        self.fps = fps  # False positives at each threshold
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __getitem__(self, group):
+        """(fpr, tpr, thresholds) of one group, as sklearn's roc_curve returns them."""
+        points = slice(self.bounds[group], self.bounds[group + 1])
+        return self.fpr[points], self.tpr[points], self.thresholds[points]
+
+
+def roc_curves(labels, scores, groups=None, n_groups=None) -> RocCurves:
+    """ROC curves of every group with a single sort of all the scores.
+
+    labels are booleans (True = positive), groups are integer codes 0..n_groups-1 (one group when
+    omitted). Each group gets the points sklearn's roc_curve gives for it: collinear points dropped,
+    a leading (0, 0) point with threshold inf, and NaN rates when a class is missing.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    groups = np.zeros(len(scores), dtype=np.intp) if groups is None else np.asarray(groups, dtype=np.intp)
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+
+    # Group by group, highest score first
+    order = np.lexsort((-scores, groups))
+    sorted_scores, sorted_labels, sorted_groups = scores[order], labels[order], groups[order]
+    sizes = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    positives = np.bincount(groups, weights=labels, minlength=n_groups)
+    negatives = sizes - positives
+
+    # One point per distinct score of a group, at the last sample holding it
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (sorted_scores[1:] != sorted_scores[:-1]) | (sorted_groups[1:] != sorted_groups[:-1])
+    points = np.flatnonzero(last)
+    point_groups = sorted_groups[points]
+    cumulative = np.concatenate(([0], np.cumsum(sorted_labels)))
+    tps = (cumulative[points + 1] - cumulative[starts[point_groups]]).astype(np.float64)
+    fps = points + 1 - starts[point_groups] - tps
+    thresholds = sorted_scores[points]
+
+    # Drop the points in the middle of a straight segment, as roc_curve(drop_intermediate=True) does
+    keep = np.ones(len(points), dtype=bool)
+    if len(points) > 2:
+        interior = (point_groups[:-2] == point_groups[1:-1]) & (point_groups[1:-1] == point_groups[2:])
+        bends = (np.diff(fps, 2) != 0) | (np.diff(tps, 2) != 0)
+        keep[1:-1] = ~interior | bends
+    point_groups, tps, fps, thresholds = point_groups[keep], tps[keep], fps[keep], thresholds[keep]
+
+    # Room for the (0, 0) point at the start of every group
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(point_groups, minlength=n_groups) + 1)))
+    positions = np.arange(len(point_groups)) + point_groups + 1
+    all_tps = np.zeros(bounds[-1])
+    all_fps = np.zeros(bounds[-1])
+    all_thresholds = np.full(bounds[-1], np.inf)
+    all_tps[positions], all_fps[positions], all_thresholds[positions] = tps, fps, thresholds
+    all_groups = np.repeat(np.arange(n_groups), np.diff(bounds))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fpr = np.where(negatives[all_groups] > 0, all_fps / negatives[all_groups], np.nan)
+        tpr = np.where(positives[all_groups] > 0, all_tps / positives[all_groups], np.nan)
+    return RocCurves(bounds, fpr, tpr, all_thresholds, all_tps, all_fps)
+
+
+def calibrate_thresholds(labels, scores, groups=None, return_curves=False):
+    """AUC, Youden-optimal threshold and confusion counts of every group (e.g. vehicle), in one pass.
+
+    Returns a DataFrame indexed by group with CALIBRATION_COLUMNS; counts use score >= threshold, as
+    process_excel_with_roc always did. Groups whose ROC is not defined get NaN values and the reason
+    in 'Error'. With return_curves, the RocCurves (in the same group order) are returned as well.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    if groups is None:
+        codes, names = np.zeros(len(scores), dtype=np.intp), pd.Index([0])
+    else:
+        codes, names = pd.factorize(np.asarray(groups), sort=False)
+        names = pd.Index(names)
+    n_groups = len(names)
+    curves = roc_curves(labels, scores, codes, n_groups)
+
+    sizes = np.bincount(codes, minlength=n_groups)
+    positives = np.bincount(codes, weights=labels, minlength=n_groups)
+    negatives = sizes - positives
+    finite = np.bincount(codes, weights=np.isfinite(scores), minlength=n_groups) == sizes
+    errors = np.full(n_groups, None, dtype=object)
+    errors[~finite] = "Probability column contains invalid values."
+    errors[(positives == 0) | (negatives == 0)] = \
+        "Only one class present in y_true. ROC AUC score is not defined in that case."
+    valid = pd.isnull(errors)
+
+    # Trapezoidal area under every curve
+    widths = np.diff(curves.fpr)
+    heights = (curves.tpr[1:] + curves.tpr[:-1]) / 2
+    inside = np.ones(len(widths), dtype=bool)
+    inside[curves.bounds[1:-1] - 1] = False  # Segments joining two groups
+    point_groups = np.repeat(np.arange(n_groups), np.diff(curves.bounds))
+    auc = np.bincount(point_groups[1:][inside], weights=(widths * heights)[inside], minlength=n_groups)
+
+    # Youden's J: the first point with the highest tpr - fpr in each group
+    j_scores = curves.tpr - curves.fpr
+    best = np.lexsort((np.arange(len(j_scores)), -j_scores, point_groups))[curves.bounds[:-1]]
+    tp = curves.tps[best]
+    fp = curves.fps[best]
+    fn = positives - tp
+    tn = negatives - fp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0)
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0)
+        specificity = np.where(tn + fp > 0, tn / (tn + fp), 0)
+
+    summary = pd.DataFrame({
+        'AUC': auc, 'Threshold': curves.thresholds[best], 'TP': tp, 'TN': tn, 'FP': fp, 'FN': fn,
+        'Recall': recall, 'Precision': precision, 'Specificity': specificity,
+        # object dtype keeps None for valid groups (a string column would turn it into NaN)
+        'Error': pd.Series(errors, index=names, dtype=object),
+    }, index=names)
+    summary.loc[~valid, CALIBRATION_COLUMNS[:-1]] = np.nan
+    if return_curves:
+        return summary, curves
+    return summary
+
+
+def apply_calibration(vehicle_profiles: VehicleProfiles, calibration: pd.DataFrame):
+    """Stores every calibrated threshold in the profiles (vehicles without a valid ROC are left as they are)."""
+    for vehicle_id, threshold in calibration['Threshold'].dropna().items():
+        vehicle_profiles.set_threshold(str(vehicle_id), threshold)
+
+
+def plot_roc_curve(fpr, tpr, auc_value, vehicle_id, output_dir: str = 'media') -> str:
+    """Renders one ROC curve to PNG and returns the image path (matplotlib is only imported here)."""
+    import matplotlib.pyplot as plt
 
-
-def process_excel_with_roc(df: pd.DataFrame, vehicle_col: str, belongs_value="Belongs", vehicle_id: str = "unknown",
-                           output_dir: str = 'media', vehicle_profiles: VehicleProfiles = None) -> str:
-    """Process the DataFrame, calculate ROC, and save the ROC curve image. Returns the image path."""
-
-    # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
-
-    # Check if both classes are present
-    unique_classes = df[vehicle_col].unique()
-    if len(unique_classes) < 2:
-        raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
-
-    # Add new headers if not present
-    new_headers = ['Threshold', 'TP', 'TN', 'FP', 'FN', 'Recall', 'Precision', 'Specificity']
-    for header in new_headers:
-        df[header] = np.nan
-
-    # Convert labels to binary
-    true_labels = np.where(df[vehicle_col] == belongs_value, 1, 0)
-    probabilities = df['Probability'].values
-
-    # Check if probabilities are valid numbers
-    if np.any(np.isnan(probabilities)) or np.any(np.isinf(probabilities)):
-        raise ValueError("Probability column contains invalid values.")
-
-    # Compute ROC curve and AUC
-    fpr, tpr, thresholds = roc_curve(true_labels, probabilities)
-    auc_value = roc_auc_score(true_labels, probabilities)
-
-    # Find the optimal threshold using Youden's J statistic
-    j_scores = tpr - fpr
-    optimal_idx = np.argmax(j_scores)
-    optimal_threshold = thresholds[optimal_idx]
-
-    print(f"Optimal threshold for vehicle {vehicle_id}: {optimal_threshold}")
-    if vehicle_profiles is not None:
-        vehicle_profiles.set_threshold(vehicle_id, optimal_threshold)
-        vehicle_profiles.display_profile(vehicle_id)  # Print the updated threshold for checking
-
-    #  TP, TN, FP, FN
-    tp = np.sum((true_labels == 1) & (probabilities >= optimal_threshold))
-    tn = np.sum((true_labels == 0) & (probabilities < optimal_threshold))
-    fp = np.sum((true_labels == 0) & (probabilities >= optimal_threshold))
-    fn = np.sum((true_labels == 1) & (probabilities < optimal_threshold))
-
-    #  Recall, Precision ו-Specificity
-    recall = tp / (tp + fn) if (tp + fn) > 0 else 0
-    precision = tp / (tp + fp) if (tp + fp) > 0 else 0
-    specificity = tn / (tn + fp) if (tn + fp) > 0 else 0
-
-    # Add values to the DataFrame for the optimal threshold
-    new_data = {'Threshold': optimal_threshold, 'TP': tp, 'TN': tn, 'FP': fp, 'FN': fn,
-                'Recall': recall, 'Precision': precision, 'Specificity': specificity}
-    first_empty_row = df[df['Threshold'].isna()].index[0]
-    for header, value in new_data.items():
-        df.at[first_empty_row, header] = value
-
-    # Plot the ROC curve
     plt.figure()
     plt.plot(fpr, tpr, label=f'ROC curve (AUC = {auc_value:.2f})')
     plt.plot([0, 1], [0, 1], linestyle='--')
@@ -78,5 +165,49 @@ def process_excel_with_roc(df: pd.DataFrame, vehicle_col: str, belongs_value="Be
     roc_curve_image = os.path.join(output_dir, f'roc_curve_vehicle_{vehicle_id}.png')
     plt.savefig(roc_curve_image)
     plt.close()
-
     return roc_curve_image
+
+
+def add_calibration_columns(df: pd.DataFrame, calibration_row):
+    """Adds the calibration columns to df: the values go in the first row, the other rows stay empty."""
+    for header in CALIBRATION_COLUMNS[1:-1]:
+        df[header] = np.nan
+    if len(df):
+        df.loc[df.index[0], CALIBRATION_COLUMNS[1:-1]] = [calibration_row[header] for header in CALIBRATION_COLUMNS[1:-1]]
+    return df
+
+
+def process_excel_with_roc(df: pd.DataFrame, vehicle_col: str, belongs_value="Belongs", vehicle_id: str = "unknown",
+                           output_dir: str = 'media', vehicle_profiles: VehicleProfiles = None, plot: bool = True) -> str:
+    """Process the DataFrame, calculate ROC, and save the ROC curve image. Returns the image path.
+
+    With plot=False no figure is rendered and None is returned.
+    """
+
+    # Ensure the output directory exists
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Convert labels to binary
+    true_labels = (df[vehicle_col] == belongs_value).to_numpy()
+    probabilities = df['Probability'].to_numpy(dtype=np.float64)
+
+    # ROC, AUC, optimal threshold (Youden's J) and confusion counts from one sort
+    calibration, curves = calibrate_thresholds(true_labels, probabilities, return_curves=True)
+    result = calibration.iloc[0]
+    if result['Error'] is not None:
+        raise ValueError(result['Error'])
+    optimal_threshold = result['Threshold']
+    metrics.set_gauge("auc", result['AUC'], vehicle_id)
+
+    print(f"Optimal threshold for vehicle {vehicle_id}: {optimal_threshold}")
+    if vehicle_profiles is not None:
+        vehicle_profiles.set_threshold(vehicle_id, optimal_threshold)
+        vehicle_profiles.display_profile(vehicle_id)  # Print the updated threshold for checking
+
+    # Add values to the DataFrame for the optimal threshold
+    add_calibration_columns(df, result)
+
+    if not plot:
+        return None
+    fpr, tpr, _ = curves[0]
+    return plot_roc_curve(fpr, tpr, result['AUC'], vehicle_id, output_dir)
@@ -0,0 +1,96 @@
+from vehicle_profiles import VehicleProfiles
+
+# Checking trips against profiles: the interactive prompt and one-shot scoring. Only the profile and
+# scoring modules are imported here (no pandas, Excel or plotting), so main.py score / verify start fast.
+
+
+# פונקציה לבדיקת הסתברות מחרוזת עבור מספר רכב
+def check_trip_and_add_to_tree(vehicle_profiles, vehicle_id, trip_string):
+    # לחשב את ההסתברות של הנסיעה
+    probability = vehicle_profiles.calculate_probability_for_vehicle(vehicle_id, trip_string)
+
+    # ערך הסף של הרכב
+    threshold = vehicle_profiles.get_threshold(vehicle_id)
+
+    # הדפסת ההסתברות והסף
+    print(f"Probability of trip: {probability}, Threshold for vehicle {vehicle_id}: {threshold}")
+
+    # בדיקה אם ההסתברות גבוהה מהסף
+    if probability > threshold:
+        print(f"Trip accepted for vehicle {vehicle_id}, adding to tree.")
+        vehicle_profiles.add_trip(vehicle_id, trip_string)  # הוספת הנסיעה לעץ
+    else:
+        print(f"Trip rejected for vehicle {vehicle_id}. Probability too low.")
+
+    return probability > threshold  # מחזיר אם הנסיעה התקבלה או לא
+
+
+def check_trips_from_store(profile_store_path: str, memory_budget: int = None):
+    """Answers trip checks from a saved profile store, skipping the CSV and the tree building.
+
+    With memory_budget (bytes) profiles are loaded as vehicles are asked for and evicted beyond it.
+    Accepted trips are saved back to the store when the prompt exits.
+    """
+    with VehicleProfiles.load(profile_store_path, memory_budget=memory_budget) as vehicle_profiles:
+        accepted = check_trips(vehicle_profiles)
+        if accepted:
+            vehicle_profiles.save(profile_store_path)
+            print(f"Saved {accepted} accepted trips to {profile_store_path}")
+
+
+def check_trips(vehicle_profiles: VehicleProfiles) -> int:
+    """Interactive loop: checks trip strings against a vehicle's profile until the user exits.
+
+    Returns the number of accepted trips (added to the profiles).
+    """
+    accepted_trips = 0
+    try:
+        while True:
+            # קבלת מספר רכב מהמשתמש
+            vehicle_id = input("Please enter the vehicle ID (or 'exit' to quit): ")
+            if vehicle_id.lower() == 'exit':
+                print("Exiting the program.")
+                break
+
+            # וידוא שמספר הרכב קיים בפרופילים
+            if vehicle_id not in vehicle_profiles.profiles:
+                print(f"No profile found for vehicle ID: {vehicle_id}")
+                continue
+
+            # קבלת מחרוזת נסיעה מהמשתמש
+            trip_string = input("Please enter the trip string to check: ")
+            if vehicle_profiles.vocabulary is not None:
+                # Token profiles: the trip is typed in the report's readable form
+                try:
+                    trip_string = vehicle_profiles.vocabulary.parse(trip_string)
+                except ValueError as error:
+                    print(error)
+                    continue
+
+            # חישוב הסתברות למחרוזת והשוואה לערך הסף
+            accepted_trips += check_trip_and_add_to_tree(vehicle_profiles, vehicle_id, trip_string)
+
+            # שאלת המשתמש אם ברצונו לבדוק נסיעה נוספת
+            check_another = input("Do you want to check another trip? (yes/no): ")
+            if check_another.lower() != 'yes':
+                print("Exiting the program.")
+                break
+    except (EOFError, KeyboardInterrupt):
+        # End of input or Ctrl-C ends the prompt like 'exit', so the accepted trips can still be saved
+        print("\nExiting the program.")
+    return accepted_trips
+
+
+def score_trips(vehicle_profiles: VehicleProfiles, vehicle_id: str, trips) -> list:
+    """Scores trips against one vehicle without changing its profile.
+
+    Returns (score, threshold, accepted) per trip. Token profiles take the trips in their readable
+    form (see TokenVocabulary.parse). Raises ValueError for an unknown vehicle.
+    """
+    if vehicle_id not in vehicle_profiles.profiles:
+        raise ValueError(f"No profile found for vehicle ID: {vehicle_id}")
+    if vehicle_profiles.vocabulary is not None:
+        trips = [vehicle_profiles.vocabulary.parse(trip) for trip in trips]
+    scores = vehicle_profiles.calculate_probabilities_for_vehicle(vehicle_id, list(trips))
+    threshold = vehicle_profiles.get_threshold(vehicle_id)
+    return [(float(score), threshold, bool(score > threshold)) for score in scores]
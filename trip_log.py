@@ -0,0 +1,44 @@
+import os
+
+
+class TripLog:
+    """Append-only file of the trips added to profiles, one "vehicle_id<TAB>trip" line each.
+
+    Lets profiles drop their in-memory trip history (VehicleProfiles(keep_history=False)) while the
+    raw trips stay available on disk for replay, e.g. to rebuild the trees with other settings.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, vehicle_id, trip: str):
+        if "\t" in trip or "\n" in trip:
+            raise ValueError("Trip strings in the log cannot contain tabs or newlines")
+        self._file.write(f"{vehicle_id}\t{trip}\n")
+        self._file.flush()
+
+    def replay(self, vehicle_id=None):
+        """Yields (vehicle_id, trip) in the order they were appended, optionally for one vehicle only."""
+        self._file.flush()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                logged_id, _, trip = line.rstrip("\n").partition("\t")
+                if vehicle_id is None or logged_id == vehicle_id:
+                    yield logged_id, trip
+
+    def history(self, vehicle_id) -> str:
+        """Every trip logged for one vehicle, concatenated (the old profile trip_string)."""
+        return "".join(trip for _, trip in self.replay(str(vehicle_id)))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
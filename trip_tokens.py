@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+
+from string_create import (DRIVE_CATEGORIES, DRIVE_THRESHOLDS, IDLE_CATEGORIES, IDLE_THRESHOLDS, INVALID_COORDINATES,
+                           MILEAGE_CATEGORIES, MILEAGE_THRESHOLDS, TIME_CATEGORIES,
+                           _encode_durations, _encode_times, _grid_indices, _indices_to_letters)
+
+# A trip is TRIP_WIDTH tokens, one per field value, in this order
+TRIP_FIELDS = ("start_time", "start_cell", "end_time", "end_cell", "drive_duration", "idle_duration", "mileage")
+TRIP_WIDTH = len(TRIP_FIELDS)
+
+# Token ids of the binned fields are fixed (bin position + offset); grid cells are numbered by a
+# TokenVocabulary from CELL_TOKEN_START on. Each field has its own range, so a value of one field
+# can never be read as a value of another.
+TIME_LABELS = TIME_CATEGORIES + ["Invalid time"]
+DRIVE_LABELS = DRIVE_CATEGORIES + ["n"]
+IDLE_LABELS = IDLE_CATEGORIES + ["n"]
+MILEAGE_LABELS = MILEAGE_CATEGORIES + ["n"]
+TIME_TOKEN_START = 0
+DRIVE_TOKEN_START = 16
+IDLE_TOKEN_START = 32
+MILEAGE_TOKEN_START = 48
+CELL_TOKEN_START = 64
+INVALID_CELL = (None, None)
+TEXT_SEPARATOR = "/"  # Between the fields of to_text; no field label contains it
+
+# Tokens travel as code points, so trip strings, TripBatch and the trees need no changes: a token
+# string has exactly one character per field. Ids start above Latin-1 and skip the surrogates.
+_CODE_POINT_OFFSET = 0x100
+_SURROGATES = (0xD800, 0xE000)
+MAX_TOKENS = 0x110000 - _CODE_POINT_OFFSET - (_SURROGATES[1] - _SURROGATES[0])
+
+
+def token_code_points(token_ids: np.ndarray) -> np.ndarray:
+    code_points = np.asarray(token_ids, dtype=np.uint32) + _CODE_POINT_OFFSET
+    return np.where(code_points >= _SURROGATES[0], code_points + (_SURROGATES[1] - _SURROGATES[0]), code_points)
+
+
+def token_ids(code_points: np.ndarray) -> np.ndarray:
+    code_points = np.asarray(code_points, dtype=np.uint32)
+    code_points = np.where(code_points >= _SURROGATES[1], code_points - (_SURROGATES[1] - _SURROGATES[0]), code_points)
+    return code_points - _CODE_POINT_OFFSET
+
+
+class TokenVocabulary:
+    """Grid cell <-> token id, shared by every trip encoded with it (save it with the profiles).
+
+    Cells get ids in the order they are first seen, so a vocabulary only grows and tokens already
+    in trees keep their meaning.
+    """
+
+    def __init__(self, cells=()):
+        self.cells = [INVALID_CELL]  # Id CELL_TOKEN_START is the invalid point
+        self._ids = {INVALID_CELL: CELL_TOKEN_START}
+        self._alphabet = None
+        for cell in cells:
+            self._add(tuple(cell))
+
+    def _add(self, cell):
+        if CELL_TOKEN_START + len(self.cells) >= MAX_TOKENS:
+            raise ValueError("Token vocabulary is full")
+        self._ids[cell] = CELL_TOKEN_START + len(self.cells)
+        self.cells.append(cell)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def alphabet(self) -> frozenset:
+        """Every token of the vocabulary as its character (what the trees are offered as options)."""
+        # Cached with the number of cells it covers: a cell added by another thread (the verification
+        # service encodes on its event loop while trees are updated in a worker) makes it stale
+        cells = len(self.cells)
+        if self._alphabet is None or self._alphabet[0] != cells:
+            ids = np.concatenate([TIME_TOKEN_START + np.arange(len(TIME_LABELS)),
+                                  DRIVE_TOKEN_START + np.arange(len(DRIVE_LABELS)),
+                                  IDLE_TOKEN_START + np.arange(len(IDLE_LABELS)),
+                                  MILEAGE_TOKEN_START + np.arange(len(MILEAGE_LABELS)),
+                                  CELL_TOKEN_START + np.arange(cells)])
+            self._alphabet = (cells, frozenset(map(chr, token_code_points(ids).tolist())))
+        return self._alphabet[1]
+
+    def cell_tokens(self, x_index: np.ndarray, y_index: np.ndarray, invalid: np.ndarray) -> np.ndarray:
+        """Token id of every point (adding new cells to the vocabulary)."""
+        keys = np.stack([x_index, y_index], axis=1)
+        uniques, inverse = np.unique(keys[~invalid], axis=0, return_inverse=True)
+        ids = np.empty(len(uniques), dtype=np.uint32)
+        for i, (x, y) in enumerate(uniques.tolist()):
+            if (x, y) not in self._ids:
+                self._add((x, y))
+            ids[i] = self._ids[(x, y)]
+        tokens = np.full(len(x_index), CELL_TOKEN_START, dtype=np.uint32)
+        tokens[~invalid] = ids[inverse.reshape(-1)]
+        return tokens
+
+    def to_state(self) -> list:
+        """JSON-friendly form for profile store metadata (the invalid point is implicit)."""
+        return [list(cell) for cell in self.cells[1:]]
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state)
+
+    def labels(self, tokens) -> list:
+        """Letter form of every token of a trip, field by field (the pieces process_row would join)."""
+        ids = token_ids(np.frombuffer(tokens.encode("utf-32-le"), dtype=np.uint32)) if isinstance(tokens, str) \
+            else token_ids(tokens)
+        labels = []
+        for token in ids.tolist():
+            if token >= CELL_TOKEN_START:
+                x, y = self.cells[token - CELL_TOKEN_START]
+                if x is None:
+                    labels.append(INVALID_COORDINATES)
+                else:
+                    labels.append("".join(_indices_to_letters(np.array([x, y]))))
+            elif token >= MILEAGE_TOKEN_START:
+                labels.append(MILEAGE_LABELS[token - MILEAGE_TOKEN_START])
+            elif token >= IDLE_TOKEN_START:
+                labels.append(IDLE_LABELS[token - IDLE_TOKEN_START])
+            elif token >= DRIVE_TOKEN_START:
+                labels.append(DRIVE_LABELS[token - DRIVE_TOKEN_START])
+            else:
+                labels.append(TIME_LABELS[token - TIME_TOKEN_START])
+        return labels
+
+    def to_letters(self, trip: str) -> str:
+        """The letter string process_row gives for the same trip (for Excel output and display)."""
+        return "".join(self.labels(trip))
+
+    def to_text(self, trip: str) -> str:
+        """The fields of a token trip separated by TEXT_SEPARATOR; parse reads this form back."""
+        return TEXT_SEPARATOR.join(self.labels(trip))
+
+    def parse(self, text: str) -> str:
+        """Token trip string from the fields of to_text (e.g. typed at the prompt).
+
+        Raises ValueError for a field value the vocabulary does not know.
+        """
+        fields = [field.strip() for field in text.split(TEXT_SEPARATOR)]
+        if len(fields) != TRIP_WIDTH:
+            raise ValueError(f"A trip has {TRIP_WIDTH} fields: {', '.join(TRIP_FIELDS)}")
+        cells = {}
+        for token, (x, y) in enumerate(self.cells, start=CELL_TOKEN_START):
+            label = INVALID_COORDINATES if x is None else "".join(_indices_to_letters(np.array([x, y])))
+            cells.setdefault(label, token)
+        tables = [(TIME_LABELS, TIME_TOKEN_START), None, (TIME_LABELS, TIME_TOKEN_START), None,
+                  (DRIVE_LABELS, DRIVE_TOKEN_START), (IDLE_LABELS, IDLE_TOKEN_START),
+                  (MILEAGE_LABELS, MILEAGE_TOKEN_START)]
+        ids = []
+        for name, field, table in zip(TRIP_FIELDS, fields, tables):
+            if table is None:
+                if field not in cells:
+                    raise ValueError(f"Unknown grid cell for {name}: {field}")
+                ids.append(cells[field])
+            else:
+                labels, start = table
+                if field not in labels:
+                    raise ValueError(f"Unknown value for {name}: {field}")
+                ids.append(start + labels.index(field))
+        return token_code_points(np.array(ids)).astype("<u4").tobytes().decode("utf-32-le")
+
+
+class TripTokens:
+    """Trips as one contiguous (trips x TRIP_WIDTH) uint32 buffer of token code points.
+
+    Every trip has the same width, so trip i is row i and the offsets are implicit (i * TRIP_WIDTH
+    into the flat buffer). strings() gives the token strings that the DataFrames and trees hold.
+    """
+
+    def __init__(self, code_points: np.ndarray):
+        self.code_points = np.ascontiguousarray(code_points, dtype="<u4").reshape(-1, TRIP_WIDTH)
+
+    def __len__(self):
+        return len(self.code_points)
+
+    def __getitem__(self, rows):
+        return TripTokens(self.code_points[rows])
+
+    def strings(self) -> np.ndarray:
+        """One token string per trip."""
+        return self.code_points.view(f"<U{TRIP_WIDTH}").reshape(-1).astype(object)
+
+
+def encode_trip_tokens(df: pd.DataFrame, vocabulary: TokenVocabulary) -> TripTokens:
+    """Token counterpart of string_create.encode_trips: the same field values, one token each."""
+    ids = np.empty((len(df), TRIP_WIDTH), dtype=np.uint32)
+    for column, field in ((0, 'start_drive'), (2, 'end_drive')):
+        codes, _ = _encode_times(df[field])  # Codes follow TIME_LABELS
+        ids[:, column] = TIME_TOKEN_START + codes
+    ids[:, 1] = vocabulary.cell_tokens(*_grid_indices(df['start_latitude'], df['start_longitude']))
+    ids[:, 3] = vocabulary.cell_tokens(*_grid_indices(df['end_latitude'], df['end_longitude']))
+    for column, (field, thresholds, categories, start) in enumerate((
+            ('drive_duration', DRIVE_THRESHOLDS, DRIVE_CATEGORIES, DRIVE_TOKEN_START),
+            ('idle_duration', IDLE_THRESHOLDS, IDLE_CATEGORIES, IDLE_TOKEN_START),
+            ('mileage', MILEAGE_THRESHOLDS, MILEAGE_CATEGORIES, MILEAGE_TOKEN_START)), start=4):
+        codes, _ = _encode_durations(df[field], thresholds, categories)
+        ids[:, column] = start + codes
+    return TripTokens(token_code_points(ids))
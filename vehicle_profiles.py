@@ -1,25 +1,255 @@
+import math
+import threading
+
+import numpy as np
+
+from batch_scoring import LOG_PER_SYMBOL, PROBABILITY, SCORE_SPACES, TransitionTable, as_trip_batch, top_k
 from lempel_ziv78 import LempelZivTree
+from lempel_ziv78_compact import CompactLempelZivTree
+from metrics import metrics
+from profile_store import ProfileCache, ProfileStore, write_store
+
+DEFAULT_THRESHOLD = 0.02  # In probability space
+
+
+def _load_vocabulary(metadata):
+    if metadata.get("vocabulary") is None:
+        return None
+    from trip_tokens import TokenVocabulary  # Imports pandas; only stores of token trips need it
+    return TokenVocabulary.from_state(metadata["vocabulary"])
 
 
 class VehicleProfiles:
 
-    def __init__(self):
+    def __init__(self, tree_class=LempelZivTree, score_space=PROBABILITY, snapshots=False, keep_history=True,
+                 trip_log=None, node_budget=None, vocabulary=None):
+        # tree_class can be CompactLempelZivTree to keep resident profiles small
+        # score_space selects probability, log or log_per_symbol scores; thresholds live in the same space
+        # snapshots publishes every change as a new version instead of changing profiles in place (see add_trip)
+        # keep_history=False drops the raw trip_string: the tree and its pending phrase are all scoring needs,
+        # so memory follows the tree size instead of the distance driven
+        # trip_log (a trip_log.TripLog) receives every added trip, for replay when there is no history
+        # node_budget caps the phrase nodes of every tree; low-mass subtrees are pruned beyond it (LempelZivTree.prune)
+        # vocabulary (a trip_tokens.TokenVocabulary) is set when the trips are token strings; it is saved with the profiles
+        if score_space not in SCORE_SPACES:
+            raise ValueError(f"Unknown score space: {score_space}")
+        if node_budget is not None and not hasattr(tree_class, "prune"):
+            raise ValueError(f"{tree_class.__name__} trees cannot be pruned to a node budget")
         self.profiles = {}
+        self.tree_class = tree_class
+        self.score_space = score_space
+        self.snapshots = snapshots
+        self.keep_history = keep_history
+        self.trip_log = trip_log
+        self.node_budget = node_budget
+        self.vocabulary = vocabulary
+        self._write_locks = {}
+        self._publish_lock = threading.Lock()
+        self._reported_missing = set()  # Vehicles whose missing profile was already printed
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_write_locks"], state["_publish_lock"]
+        state["trip_log"] = None  # An open file; copies (e.g. in evaluation workers) do not log
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("_reported_missing", set())
+        self.__dict__.setdefault("keep_history", True)
+        self.__dict__.setdefault("trip_log", None)
+        self.__dict__.setdefault("node_budget", None)
+        self.__dict__.setdefault("vocabulary", None)
+        self._write_locks = {}
+        self._publish_lock = threading.Lock()
+
+    def _write_lock(self, vehicle_id):
+        # setdefault is atomic, so two writers of a new vehicle get the same lock
+        return self._write_locks.setdefault(vehicle_id, threading.Lock())
+
+    def _publish(self, vehicle_id, profile):
+        # A published profile is never changed, so swapping a vehicle's entry is a single store that
+        # readers see before or after, and costs the same for any fleet size. Only a new vehicle
+        # copies the dict: a dict that grows would break readers iterating over it
+        with self._publish_lock:
+            if vehicle_id in self.profiles:
+                self.profiles[vehicle_id] = profile
+            else:
+                profiles = dict(self.profiles)
+                profiles[vehicle_id] = profile
+                self.profiles = profiles
+
+    def save(self, path: str):
+        """Saves every profile (tree, trip history, threshold) to a binary profile store."""
+        metadata = {"score_space": self.score_space, "keep_history": self.keep_history}
+        if self.vocabulary is not None:
+            metadata["vocabulary"] = self.vocabulary.to_state()
+        write_store(path, self.profiles, metadata)
+
+    def close(self):
+        """Releases the working files of profiles loaded with a memory budget (see ProfileCache.close).
+
+        Changes not saved with save are lost. Also closed at the end of a with block.
+        """
+        if isinstance(self.profiles, ProfileCache):
+            self.profiles.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True, snapshots: bool = False, memory_budget: int = None):
+        """Loads a profile store written by save.
+
+        Trees come back as CompactLempelZivTree backed by a copy-on-write memory map of the file,
+        so loading is fast and processes that load the same store share its pages.
+        With memory_budget (bytes), profiles is a ProfileCache: each profile is read on first use and
+        the least recently used ones are evicted to stay within the budget (changed ones are written
+        back first). Snapshot mode needs every profile in memory and cannot be combined with it.
+        """
+        if memory_budget is not None:
+            if snapshots:
+                raise ValueError("Snapshot mode cannot be combined with a memory budget")
+            profiles = ProfileCache(path, memory_budget, mmap)
+            metadata = profiles.store.metadata
+            vehicle_profiles = cls(CompactLempelZivTree, metadata.get("score_space", PROBABILITY),
+                                   keep_history=metadata.get("keep_history", True),
+                                   vocabulary=_load_vocabulary(metadata))
+            vehicle_profiles.profiles = profiles
+            return vehicle_profiles
+        store = ProfileStore(path, mmap)
+        vehicle_profiles = cls(CompactLempelZivTree, store.metadata.get("score_space", PROBABILITY), snapshots,
+                               store.metadata.get("keep_history", True), vocabulary=_load_vocabulary(store.metadata))
+        vehicle_profiles.profiles = store.load_profiles()
+        return vehicle_profiles
+
+    @classmethod
+    def from_trip_log(cls, trip_log, buffer_chars: int = 10_000_000, **options):
+        """Rebuilds profiles by replaying a TripLog; options go to the constructor (thresholds start at the default).
+
+        Trips are buffered per vehicle and added up to buffer_chars at a time; the trees resume their
+        parse, so this equals adding the logged trips one by one. Trips added afterwards go to the same log.
+        """
+        vehicle_profiles = cls(**options)
+        pending, buffered = {}, 0
+        for vehicle_id, trip in trip_log.replay():
+            pending.setdefault(vehicle_id, []).append(trip)
+            buffered += len(trip)
+            if buffered >= buffer_chars:
+                for pending_id, trips in pending.items():
+                    vehicle_profiles.add_trip(pending_id, "".join(trips))
+                pending, buffered = {}, 0
+        for pending_id, trips in pending.items():
+            vehicle_profiles.add_trip(pending_id, "".join(trips))
+        vehicle_profiles.trip_log = trip_log
+        return vehicle_profiles
+
+    def _changed(self, vehicle_id):
+        # A lazily loaded profile has to be written back before it can be evicted
+        if isinstance(self.profiles, ProfileCache):
+            self.profiles.mark_dirty(vehicle_id)
+
+    def _missing_profile(self, vehicle_id):
+        # Scoring asks for the same unknown vehicle over and over; count every lookup, print once
+        metrics.increment("missing_profile_lookups")
+        if vehicle_id not in self._reported_missing:
+            self._reported_missing.add(vehicle_id)
+            print(f"No profile found for vehicle number: {vehicle_id}")
+
+    def default_threshold(self):
+        if self.score_space == PROBABILITY:
+            return DEFAULT_THRESHOLD
+        return math.log(DEFAULT_THRESHOLD)
+
+    def _missing_score(self):
+        # Score of a trip against a vehicle without a profile (probability 0)
+        return 0.0 if self.score_space == PROBABILITY else -math.inf
+
+    def _new_profile(self):
+        # הוספת שדה threshold עם ערך דיפולטיבי 0.02
+        profile = {"tree": self.tree_class(), "threshold": self.default_threshold(), "version": 0}
+        if self.keep_history:
+            profile["trip_string"] = ""
+        return profile
 
     def add_trip(self, vehicle_id: str, trip: str):
         vehicle_id = str(vehicle_id)
+        if self.trip_log is not None:
+            self.trip_log.append(vehicle_id, trip)
+        if self.snapshots:
+            self._add_trip_snapshot(vehicle_id, trip)
+            return
         if vehicle_id not in self.profiles:
-            # הוספת שדה threshold עם ערך דיפולטיבי 0.02
-            self.profiles[vehicle_id] = {
-                "trip_string": "",
-                "tree": LempelZivTree(),
-                "threshold": 0.02  # ערך דיפולטיבי
-            }
+            self.profiles[vehicle_id] = self._new_profile()
         # הוספת הנתונים לפרופיל הקיים
-        self.profiles[vehicle_id]["trip_string"] += trip
+        if self.keep_history:
+            self.profiles[vehicle_id]["trip_string"] += trip
+        # העץ ממשיך את הניתוח מהמקום שבו עצר, כך שרק הנסיעה החדשה מעובדת
         tree = self.profiles[vehicle_id]["tree"]
-        tree.build_tree(self.profiles[vehicle_id]["trip_string"])
+        self._offer_vocabulary(tree)
+        tree.build_tree(trip)
         tree.calculate_weights()
+        self._enforce_budget(tree)
+        self._tree_changed(vehicle_id)
+
+    def _tree_changed(self, vehicle_id):
+        # A new version invalidates the vehicle's calibration (see calibration_is_stale)
+        profile = self.profiles[vehicle_id]
+        profile["version"] = profile.get("version", 0) + 1
+        self._changed(vehicle_id)
+
+    def version(self, vehicle_id) -> int:
+        """Number of changes to the vehicle's tree so far (0 for profiles saved before versions were kept)."""
+        return self.profiles[vehicle_id].get("version", 0)
+
+    def _offer_vocabulary(self, tree):
+        # Returns the number of options the tree gained
+        if self.vocabulary is not None:
+            return tree.add_options(self.vocabulary.alphabet())
+        return 0
+
+    def refresh_options(self):
+        """Offers the whole vocabulary to every tree again, after it grew (e.g. over the chunks of a build).
+
+        Only the trees that gain options get a new version, so the others keep their calibration.
+        """
+        for vehicle_id, profile in self.profiles.items():
+            if self._offer_vocabulary(profile["tree"]):
+                self._tree_changed(vehicle_id)
+
+    def _enforce_budget(self, tree):
+        if self.node_budget is not None and tree.total_nodes > self.node_budget:
+            metrics.increment("pruned_nodes", tree.prune(self.node_budget))
+
+    def _add_trip_snapshot(self, vehicle_id, trip):
+        # Writers of one vehicle take turns; the next version is built on a copy while readers keep
+        # scoring the published one, then swapped in with a single assignment
+        with self._write_lock(vehicle_id):
+            current = self.profiles.get(vehicle_id)
+            if current is None:
+                current = self._new_profile()
+                tree = current["tree"]
+            else:
+                tree = current["tree"].copy()
+            self._offer_vocabulary(tree)
+            tree.build_tree(trip)
+            tree.calculate_weights()
+            self._enforce_budget(tree)
+            profile = {**current, "tree": tree, "version": current.get("version", 0) + 1}
+            if self.keep_history:
+                profile["trip_string"] = current["trip_string"] + trip
+            self._publish(vehicle_id, profile)
+
+    def snapshot(self, vehicle_id: str):
+        """The current version of a vehicle's profile (None if it has none).
+
+        In snapshot mode the returned profile is never changed afterwards, so its tree, trip string and
+        threshold stay consistent with each other while new versions are published.
+        """
+        return self.profiles.get(vehicle_id)
 
     def display_profile(self, vehicle_id: str):
         if vehicle_id in self.profiles:
@@ -30,10 +260,52 @@ class VehicleProfiles:
 
     def calculate_probability_for_vehicle(self, vehicle_id: str, string: str):
         if vehicle_id in self.profiles:
-            return self.profiles[vehicle_id]["tree"].calculate_sequence_probability(string)
+            tree = self.profiles[vehicle_id]["tree"]
+            if self.score_space == PROBABILITY:
+                return tree.calculate_sequence_probability(string)
+            return tree.calculate_sequence_log_probability(string, per_symbol=self.score_space == LOG_PER_SYMBOL)
         else:
-            print(f"No profile found for vehicle number: {vehicle_id}")
-            return 0.0
+            self._missing_profile(vehicle_id)
+            return self._missing_score()
+
+    def calculate_probabilities_for_vehicle(self, vehicle_id: str, trips):
+        """Scores a sequence of trip strings (or a TripBatch) in one call and returns a NumPy array."""
+        if vehicle_id in self.profiles:
+            return self.profiles[vehicle_id]["tree"].calculate_sequence_probabilities(trips, self.score_space)
+        else:
+            self._missing_profile(vehicle_id)
+            return np.full(len(as_trip_batch(trips)), self._missing_score())
+
+    def score_matrix(self, trips, vehicle_ids=None, chunk_size=1024, vehicles_per_pass=32):
+        """Scores every trip against every vehicle; returns (trips x vehicles array, vehicle ids).
+
+        Trips are encoded once. Each pass walks the trees of vehicles_per_pass vehicles side by side
+        over chunks of chunk_size trips, which bounds the working memory.
+        """
+        batch = as_trip_batch(trips)
+        vehicle_ids = list(self.profiles) if vehicle_ids is None else [str(v) for v in vehicle_ids]
+        scores = np.full((len(batch), len(vehicle_ids)), self._missing_score())
+        known = []
+        for column, vehicle_id in enumerate(vehicle_ids):
+            if vehicle_id in self.profiles:
+                known.append(column)
+            else:
+                self._missing_profile(vehicle_id)
+
+        for start in range(0, len(known), vehicles_per_pass):
+            columns = known[start:start + vehicles_per_pass]
+            table, roots = TransitionTable.stack(
+                [self.profiles[vehicle_ids[column]]["tree"].transition_table() for column in columns])
+            for row in range(0, len(batch), chunk_size):
+                chunk = batch[row:row + chunk_size]
+                scores[row:row + len(chunk), columns] = table.score_many(chunk, roots, self.score_space)
+        return scores, vehicle_ids
+
+    def top_k_vehicles(self, trips, k=3, vehicle_ids=None, chunk_size=1024):
+        """Most likely vehicles for each trip: returns (ids, scores), both trips x k, best first."""
+        scores, vehicle_ids = self.score_matrix(trips, vehicle_ids, chunk_size)
+        best = top_k(scores, k)
+        return np.asarray(vehicle_ids, dtype=object)[best], np.take_along_axis(scores, best, axis=1)
 
     def get_sorted_trip_probabilities(self, vehicle_id, trips):
         trip_probabilities = []
@@ -52,13 +324,35 @@ class VehicleProfiles:
 
     def set_threshold(self, vehicle_id, new_threshold):
         if vehicle_id in self.profiles:
-            self.profiles[vehicle_id]["threshold"] = new_threshold
+            self._store_threshold(vehicle_id, new_threshold)
         else:
             print(f"No profile found for vehicle number: {vehicle_id}")
 
     def update_threshold(self, vehicle_id, new_threshold):
         if vehicle_id in self.profiles:
-            self.profiles[vehicle_id]['threshold'] = new_threshold
+            self._store_threshold(vehicle_id, new_threshold)
         else:
             print(f"No profile found for vehicle {vehicle_id}")
 
+    def record_calibration(self, vehicle_id, new_threshold, calibration: dict):
+        """Stores a calibrated threshold together with what it was calibrated on.
+
+        calibration is a JSON-friendly dict (see create_file_process.calibrate_profile_store); it is
+        saved with the profile, so the next calibration can tell whether the vehicle needs redoing.
+        """
+        update = {"threshold": new_threshold, "calibration": calibration}
+        if not self.snapshots:
+            self.profiles[vehicle_id].update(update)
+            self._changed(vehicle_id)
+            return
+        with self._write_lock(vehicle_id):
+            self._publish(vehicle_id, {**self.profiles[vehicle_id], **update})
+
+    def _store_threshold(self, vehicle_id, new_threshold):
+        if not self.snapshots:
+            self.profiles[vehicle_id]["threshold"] = new_threshold
+            self._changed(vehicle_id)
+            return
+        with self._write_lock(vehicle_id):
+            self._publish(vehicle_id, {**self.profiles[vehicle_id], "threshold": new_threshold})
+
@@ -0,0 +1,252 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from create_file_process import TRIP_COLUMNS
+from string_create import encode_trips
+from trip_tokens import encode_trip_tokens
+from vehicle_profiles import VehicleProfiles
+
+MAX_BATCH_SIZE = 256
+# Seconds the batcher waits for more requests after the first one. With 0 a batch is whatever
+# queued up while the previous batch was scored, which keeps latency lowest under load.
+MAX_BATCH_DELAY = 0.0
+
+_RECORD_COLUMNS = frozenset(TRIP_COLUMNS) - {"vehicle_id"}  # Fields a raw trip record must have
+
+
+class TripVerificationService:
+    """Verifies trips against in-memory profiles, scoring concurrent requests in micro-batches.
+
+    Every request is a vehicle id with either a trip string or a raw trip record (a dict with the
+    Trips.csv columns). Records are encoded like the profiles' trips: with the profiles' vocabulary
+    when they hold token trips, in which case a grid cell never seen before gets a new token that
+    the trees take as an option on their next update. Requests that queue up while a batch is
+    being scored (or within max_batch_delay of each other) are encoded and scored together, one
+    batched call per vehicle. A trip is accepted when its score is above the vehicle's threshold, as in check_trip_and_add_to_tree; with write_back, accepted trips are then
+    added to the trees by a separate task, after the batch's replies have been released. Trips of
+    one batch are therefore all scored against the profiles as they were when the batch started,
+    and a later batch may be scored before the previous batch's trips have reached the trees.
+
+    Write-back builds each new tree version in a worker thread, off the event loop, so it needs
+    profiles in snapshot mode (VehicleProfiles(snapshots=True)): batches keep scoring the published
+    version until the new one is swapped in. Accepted trips only live in memory; save the profiles
+    after stop to keep them (run_service does).
+    """
+
+    def __init__(self, vehicle_profiles: VehicleProfiles, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_batch_delay: float = MAX_BATCH_DELAY, write_back: bool = True):
+        if write_back and not vehicle_profiles.snapshots:
+            raise ValueError("Write-back needs profiles in snapshot mode (VehicleProfiles(snapshots=True))")
+        self.vehicle_profiles = vehicle_profiles
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.write_back = write_back
+        self.requests = 0
+        self.batches = 0
+        self.accepted_trips = 0
+        self._requests = None
+        self._updates = None
+        self._tasks = []
+        self._writer = None
+
+    async def start(self):
+        self._requests = asyncio.Queue()
+        self._updates = asyncio.Queue()
+        # One thread, so the updates of a vehicle reach its tree in the order they were accepted
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trip-write-back")
+        self._tasks = [asyncio.create_task(self._run_batches()), asyncio.create_task(self._run_updates())]
+
+    async def stop(self):
+        """Applies the pending write-backs and stops the background tasks."""
+        await self._updates.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._writer.shutdown()
+
+    async def verify(self, vehicle_id, trip: str = None, record: dict = None) -> dict:
+        """Queues one trip and waits for its decision.
+
+        Returns a dict with vehicle_id, trip, accepted, probability and threshold, or with an error.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._requests.put((str(vehicle_id), trip, record, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self._requests.get()]
+        if self.max_batch_size > 1 and self.max_batch_delay > 0:
+            # Give concurrent requests a moment to arrive
+            await asyncio.sleep(self.max_batch_delay)
+        while len(batch) < self.max_batch_size and not self._requests.empty():
+            batch.append(self._requests.get_nowait())
+        return batch
+
+    async def _run_batches(self):
+        while True:
+            batch = await self._next_batch()
+            self.requests += len(batch)
+            self.batches += 1
+            try:
+                replies, accepted = self._score_batch(batch)
+            except Exception as e:
+                replies, accepted = [{"error": f"Scoring failed: {e}"}] * len(batch), {}
+            for (_, _, _, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+            for vehicle_id, trips in accepted.items():
+                # One string per vehicle; the tree resumes its parse, so this equals adding them one by one
+                self._updates.put_nowait((vehicle_id, "".join(trips)))
+
+    async def _run_updates(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            vehicle_id, trip = await self._updates.get()
+            try:
+                await loop.run_in_executor(self._writer, self.vehicle_profiles.add_trip, vehicle_id, trip)
+            except Exception as e:
+                print(f"Could not add accepted trips of vehicle {vehicle_id}: {e}")
+            finally:
+                self._updates.task_done()
+
+    def _encode(self, batch):
+        """Trip string of every request (None where it is missing or could not be encoded)."""
+        trips = [trip for _, trip, _, _ in batch]
+        records = [i for i, (_, trip, record, _) in enumerate(batch)
+                   if trip is None and isinstance(record, dict) and _RECORD_COLUMNS.issubset(record)]
+        if records:
+            try:
+                encoded = self._encode_records([batch[i][2] for i in records])
+            except (KeyError, TypeError, ValueError):
+                # Encode one by one so a single bad record does not fail the others
+                encoded = []
+                for i in records:
+                    try:
+                        encoded.extend(self._encode_records([batch[i][2]]))
+                    except (KeyError, TypeError, ValueError):
+                        encoded.append(None)
+            for i, trip in zip(records, encoded):
+                trips[i] = trip
+        return trips
+
+    def _encode_records(self, records):
+        # Records are written the way the profiles' trips were: token strings when they have a vocabulary
+        df = pd.DataFrame(records)
+        if self.vehicle_profiles.vocabulary is None:
+            return encode_trips(df).tolist()
+        return encode_trip_tokens(df, self.vehicle_profiles.vocabulary).strings().tolist()
+
+    def _score_batch(self, batch):
+        profiles = self.vehicle_profiles.profiles
+        trips = self._encode(batch)
+        replies = [None] * len(batch)
+        positions = {}
+        for i, ((vehicle_id, _, _, _), trip) in enumerate(zip(batch, trips)):
+            if not isinstance(trip, str):
+                replies[i] = {"vehicle_id": vehicle_id, "error": "Request needs a trip string or a valid trip record"}
+            elif vehicle_id not in profiles:
+                replies[i] = {"vehicle_id": vehicle_id, "error": f"No profile found for vehicle ID: {vehicle_id}"}
+            else:
+                positions.setdefault(vehicle_id, []).append(i)
+
+        accepted = {}
+        for vehicle_id, rows in positions.items():
+            vehicle_trips = [trips[i] for i in rows]
+            # The version published when the batch started; write-backs publish new ones beside it
+            profile = profiles[vehicle_id]
+            scores = profile["tree"].calculate_sequence_probabilities(vehicle_trips, self.vehicle_profiles.score_space)
+            threshold = profile["threshold"]
+            decisions = scores > threshold
+            for i, trip, score, decision in zip(rows, vehicle_trips, scores.tolist(), decisions.tolist()):
+                replies[i] = {"vehicle_id": vehicle_id, "trip": trip, "accepted": decision,
+                              "probability": score, "threshold": float(threshold)}
+            if self.write_back and decisions.any():
+                accepted[vehicle_id] = [trip for trip, decision in zip(vehicle_trips, decisions) if decision]
+                self.accepted_trips += int(np.count_nonzero(decisions))
+        return replies, accepted
+
+    async def handle_connection(self, reader, writer):
+        """Serves one client: one JSON request per line, one JSON reply per line, in request order.
+
+        A client may send several requests before reading the replies; they are verified concurrently
+        (and can share a batch).
+        """
+        pending = asyncio.Queue()
+
+        async def reply_in_order():
+            while True:
+                task = await pending.get()
+                if task is None:
+                    return
+                writer.write(json.dumps(await task).encode() + b"\n")
+                await writer.drain()
+
+        replier = asyncio.create_task(reply_in_order())
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    await pending.put(asyncio.create_task(self._handle_line(line)))
+            await pending.put(None)
+            await replier
+        except ConnectionError:
+            replier.cancel()
+        finally:
+            writer.close()
+
+    async def _handle_line(self, line):
+        try:
+            request = json.loads(line)
+            vehicle_id = request["vehicle_id"]
+        except (ValueError, KeyError, TypeError):
+            return {"error": "Expected a JSON object with vehicle_id and trip or record"}
+        reply = await self.verify(vehicle_id, request.get("trip"), request.get("record"))
+        if "id" in request:
+            reply["id"] = request["id"]
+        return reply
+
+
+async def start_server(service: TripVerificationService, socket_path: str = None, host: str = "127.0.0.1",
+                       port: int = 8765):
+    """Starts the service and listens on a Unix socket when socket_path is given, otherwise on TCP."""
+    await service.start()
+    if socket_path:
+        return await asyncio.start_unix_server(service.handle_connection, path=socket_path)
+    return await asyncio.start_server(service.handle_connection, host=host, port=port)
+
+
+def run_service(profile_store_path: str, socket_path: str = None, host: str = "127.0.0.1", port: int = 8765,
+                memory_budget: int = None, **service_options):
+    """Loads a saved profile store and serves trip verification until interrupted.
+
+    On shutdown the pending write-backs are applied and, if any trip was accepted, the profiles are
+    saved back to the store. With memory_budget (bytes) only the recently verified vehicles'
+    profiles stay in memory; write-back needs every profile loaded, so it is turned off.
+    """
+    if memory_budget is not None:
+        service_options["write_back"] = False
+
+    async def serve():
+        vehicle_profiles = VehicleProfiles.load(profile_store_path, snapshots=memory_budget is None,
+                                                memory_budget=memory_budget)
+        service = TripVerificationService(vehicle_profiles, **service_options)
+        server = await start_server(service, socket_path, host, port)
+        print(f"Verifying trips on {socket_path or f'{host}:{port}'}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await service.stop()
+            if service.accepted_trips:
+                vehicle_profiles.save(profile_store_path)
+                print(f"Saved {service.accepted_trips} accepted trips to {profile_store_path}")
+            vehicle_profiles.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass